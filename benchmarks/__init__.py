@@ -0,0 +1,6 @@
+"""Benchmarks of the file loader, run from the root of the repository:
+
+    python -m benchmarks.load --help
+    python -m benchmarks.micro --help
+    python -m benchmarks.compare old.json new.json
+"""
@@ -0,0 +1,140 @@
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from argparse import ArgumentTypeError
+from pathlib import Path
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, \
+    Tuple
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)([KMG]?)B?', re.IGNORECASE)
+PERCENTILES = (50, 99, 99.9)
+# Clock ticks of the CPU time in /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def parse_size(value: str) -> int:
+    """Parses the size with the optional unit: 512, 64K, 1.5M, 2G
+    :raise ArgumentTypeError: the size is malformed
+    """
+    match = SIZE_PATTERN.fullmatch(value.strip())
+    if match is None:
+        raise ArgumentTypeError(f'Malformed size {value}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_weights(value: str) -> List[Tuple[str, float]]:
+    """Parses the weighted values: 4K:50,1M:40,64M:10. The value without
+    the weight has weight 1
+    :raise ArgumentTypeError: the weight is malformed
+    """
+    weights = []
+    for item in value.split(','):
+        name, _, weight = item.strip().partition(':')
+        try:
+            weights.append((name, float(weight) if weight else 1.0))
+        except ValueError:
+            raise ArgumentTypeError(f'Malformed weight {item}')
+    return weights
+
+
+def parse_sizes(value: str) -> List[Tuple[int, float]]:
+    """Parses the distribution of the file sizes: 4K:50,1M:40,64M:10"""
+    return [(parse_size(size), weight)
+            for size, weight in parse_weights(value)]
+
+
+def format_size(size: float) -> str:
+    for unit in ('', 'K', 'M'):
+        if size < 1024:
+            return f'{size:.4g}{unit}'
+        size /= 1024
+    return f'{size:.4g}G'
+
+
+def get_percentiles(values: Sequence[float],
+                    percentiles: Sequence[float] = PERCENTILES) \
+        -> Dict[str, Optional[float]]:
+    """Returns the percentiles of the values by the nearest rank"""
+    ordered = sorted(values)
+    result = {}
+    for percentile in percentiles:
+        name = f'p{percentile:g}'.replace('.', '')
+        if not ordered:
+            result[name] = None
+            continue
+        rank = math.ceil(percentile / 100 * len(ordered))
+        result[name] = ordered[max(rank, 1) - 1]
+    return result
+
+
+class ProcessUsage(NamedTuple):
+    """Resources used by the process
+    :param cpu_time: seconds of CPU time in the user and the kernel mode
+    :param peak_rss: the peak resident set size in bytes
+    """
+    cpu_time: float
+    peak_rss: int
+
+
+def get_process_usage(pid: int) -> ProcessUsage:
+    """Reads the resources used by the process from /proc, zeros where
+    /proc is not available"""
+    try:
+        stat = Path(f'/proc/{pid}/stat').read_text()
+        status = Path(f'/proc/{pid}/status').read_text()
+    except OSError:
+        return ProcessUsage(0.0, 0)
+
+    # The name of the process in parentheses may contain spaces
+    fields = stat.rpartition(')')[2].split()
+    cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    peak_rss = 0
+    for line in status.splitlines():
+        if line.startswith('VmHWM:'):
+            peak_rss = int(line.split()[1]) * 1024
+    return ProcessUsage(cpu_time, peak_rss)
+
+
+def get_environment() -> Dict:
+    """Returns what the results depend on besides the code: the commit,
+    the interpreter and the machine"""
+    root = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_results(path: Optional[Path], benchmark: str, options: Mapping,
+                  results: Mapping) -> None:
+    """Writes the results with the options and the environment as JSON,
+    to stdout when the path is not passed"""
+    document = {
+        'benchmark': benchmark,
+        'environment': get_environment(),
+        'options': {name: str(value) if isinstance(value, Path) else value
+                    for name, value in options.items()},
+        'results': results,
+    }
+    if path is None:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    path.write_text(json.dumps(document, indent=2) + '\n')
@@ -0,0 +1,96 @@
+"""Compares the results of two runs of the benchmark, e.g. of two
+commits. The numbers are matched by their path in the results, the change
+larger than the threshold for the worse is reported as the regression
+and the exit code is 1.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, Mapping, Tuple
+
+# The numbers are better when they are higher, the rest are better when
+# they are lower
+HIGHER_IS_BETTER = ('mib_s', 'per_s', 'files_s')
+# The numbers describing the run or the clients rather than
+# the performance of the server
+IGNORED = ('count', 'operations', 'bytes', 'buffer_size',
+           'client_cpu_seconds')
+
+parser = argparse.ArgumentParser(
+    description=__doc__, prog='python -m benchmarks.compare')
+parser.add_argument('old', type=Path, help='Results of the baseline')
+parser.add_argument('new', type=Path, help='Results of the change')
+parser.add_argument('--threshold', type=float, default=5.0,
+                    help='Percent of the change reported as the regression '
+                         '(default: %(default)s)')
+
+
+def flatten(results: Mapping, prefix: str = '') \
+        -> Iterator[Tuple[str, float]]:
+    """Yields the numbers of the results by their paths"""
+    for name, value in results.items():
+        path = f'{prefix}.{name}' if prefix else name
+        if isinstance(value, Mapping):
+            yield from flatten(value, path)
+        elif isinstance(value, (int, float)) \
+                and not isinstance(value, bool) and name not in IGNORED:
+            yield path, value
+
+
+def get_change(path: str, old: float, new: float) -> float:
+    """Returns the percent of the change, positive when it's better"""
+    if not old:
+        if not new:
+            return 0.0
+        # Any errors of the run without them are the regression
+        return 100.0 if path.endswith(HIGHER_IS_BETTER) else -100.0
+    change = (new - old) / old * 100
+    if path.endswith(HIGHER_IS_BETTER):
+        return change
+    return -change if change else 0.0
+
+
+def compare(old: Dict, new: Dict, threshold: float) -> int:
+    """Prints the changes of the numbers, returns the amount of
+    regressions"""
+    if old.get('benchmark') != new.get('benchmark'):
+        print(f'Results of different benchmarks: {old.get("benchmark")} '
+              f'and {new.get("benchmark")}', file=sys.stderr)
+    if old.get('options') != new.get('options'):
+        print('Results of different options, the numbers may differ '
+              'because of them', file=sys.stderr)
+
+    old_numbers = dict(flatten(old['results']))
+    new_numbers = dict(flatten(new['results']))
+    regressions = 0
+    for path, old_value in old_numbers.items():
+        if path not in new_numbers:
+            continue
+        new_value = new_numbers[path]
+        change = get_change(path, old_value, new_value)
+        mark = ''
+        if change < -threshold:
+            mark = ' REGRESSION'
+            regressions += 1
+        elif change > threshold:
+            mark = ' improvement'
+        print(f'{path}: {old_value:.6g} -> {new_value:.6g} '
+              f'({change:+.1f}%){mark}')
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    old = json.loads(args.old.read_text())
+    new = json.loads(args.new.read_text())
+    print(f'{old["environment"].get("commit")} -> '
+          f'{new["environment"].get("commit")}')
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print(f'{regressions} regressions', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
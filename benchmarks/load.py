@@ -0,0 +1,381 @@
+"""Load test of the file loader. The server is started from create_app()
+on the temporary store in the child process and driven over HTTP by
+the concurrent clients of this process. The phases are run one after
+another:
+
+    upload  -- uploads the files of the size distribution
+    mixed   -- reads, writes and deletes the files by the mix
+    delete  -- deletes the remaining files
+
+Each phase reports the throughput, the latency percentiles of each
+operation, the CPU time of the server per GiB transferred and its peak
+RSS. The results are written as JSON to be compared between commits by
+benchmarks.compare.
+"""
+import argparse
+import ast
+import asyncio
+import logging
+import multiprocessing
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, FormData, TCPConnector, \
+    hdrs
+
+from benchmarks.common import format_size, get_percentiles, \
+    get_process_usage, parse_sizes, parse_weights, write_results
+from file_loader.utils.argparse import positive_int
+
+OPERATION_READ = 'read'
+OPERATION_WRITE = 'write'
+OPERATION_DELETE = 'delete'
+OPERATIONS = (OPERATION_READ, OPERATION_WRITE, OPERATION_DELETE)
+
+PHASE_UPLOAD = 'upload'
+PHASE_MIXED = 'mixed'
+PHASE_DELETE = 'delete'
+PHASES = (PHASE_UPLOAD, PHASE_MIXED, PHASE_DELETE)
+
+# The content of the files is cut from the random block, each file starts
+# with its own number to have its own hash
+BLOCK_SIZE = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+START_TIMEOUT = 30.0
+GIB = 1024 ** 3
+
+logger = logging.getLogger(__name__)
+
+
+def parse_option(value: str) -> Tuple[str, object]:
+    """Parses the app option: key=value, the value is a Python literal or
+    a string"""
+    key, sep, text = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f'Option should be key=value: '
+                                         f'{value}')
+    try:
+        return key, ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return key, text
+
+
+def parse_mix(value: str) -> List[Tuple[str, float]]:
+    mix = parse_weights(value)
+    for operation, _ in mix:
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f'Unknown operation {operation}, expected one of '
+                f'{", ".join(OPERATIONS)}')
+    return mix
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__, prog='python -m benchmarks.load',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--sizes', type=parse_sizes,
+                    default='4K:40,64K:30,1M:25,16M:5',
+                    help='Sizes of the files with their weights '
+                         '(default: %(default)s)')
+parser.add_argument('--files', type=positive_int, default=200,
+                    help='Amount of files uploaded by the upload phase '
+                         '(default: %(default)s)')
+parser.add_argument('--requests', type=positive_int, default=1000,
+                    help='Amount of requests of the mixed phase '
+                         '(default: %(default)s)')
+parser.add_argument('--mix', type=parse_mix,
+                    default='read:80,write:15,delete:5',
+                    help='Operations of the mixed phase with their weights '
+                         '(default: %(default)s)')
+parser.add_argument('--concurrency', type=positive_int, default=16,
+                    help='Amount of requests in flight '
+                         '(default: %(default)s)')
+parser.add_argument('--phases', default=','.join(PHASES),
+                    type=lambda value: value.split(','),
+                    help='Phases to run (default: %(default)s)')
+parser.add_argument('--multipart', action='store_true',
+                    help='Upload the files as multipart forms instead of '
+                         'raw bodies')
+parser.add_argument('--set', dest='app_options', action='append',
+                    type=parse_option, default=[], metavar='KEY=VALUE',
+                    help='Sets the option of the app, e.g. '
+                         'durability=\'none\' or sendfile=False')
+parser.add_argument('--storage', type=Path,
+                    help='Directory of the store, a temporary directory '
+                         'removed afterwards by default. It should be on '
+                         'the disk under test')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed of the sizes, the operations and the content '
+                         '(default: %(default)s)')
+parser.add_argument('--output', type=Path,
+                    help='File the JSON results are written to, stdout by '
+                         'default')
+
+
+def serve(sock: socket.socket, storage_path: Path,
+          app_options: Mapping) -> None:
+    """Runs the server in the child process until it's terminated"""
+    from aiohttp.web import run_app
+    from file_loader.api.app import create_app
+
+    logging.basicConfig(level=logging.WARNING)
+    app = create_app()
+    app['storage_path'] = storage_path
+    app.update(app_options)
+    run_app(app, sock=sock, print=None)
+
+
+class Content:
+    """Generates the content of the files, the same seed gives the same
+    content"""
+
+    def __init__(self, seed: int):
+        generator = random.Random(seed)
+        self.block = generator.getrandbits(BLOCK_SIZE * 8) \
+            .to_bytes(BLOCK_SIZE, 'little')
+        self.seed = seed
+        self.files = 0
+
+    def make(self, size: int) -> bytes:
+        """Returns the content of the next file"""
+        self.files += 1
+        prefix = f'{self.seed}:{self.files}:'.encode()
+        parts = [prefix]
+        left = size - len(prefix)
+        while left > 0:
+            parts.append(self.block[:left])
+            left -= BLOCK_SIZE
+        return b''.join(parts)[:size]
+
+
+class PhaseStats:
+    """Latencies, transferred bytes and errors of the phase"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: Dict[str, List[float]] = {}
+        self.bytes = 0
+        self.errors = 0
+
+    def record(self, operation: str, latency: float, size: int) -> None:
+        self.latencies.setdefault(operation, []).append(latency)
+        self.bytes += size
+
+    def report(self, seconds: float, server_cpu: float, client_cpu: float,
+               peak_rss: int) -> Dict:
+        operations = sum(map(len, self.latencies.values()))
+        return {
+            'seconds': seconds,
+            'operations': operations,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'throughput_mib_s': self.bytes / 1024 ** 2 / seconds,
+            'operations_per_s': operations / seconds,
+            'server_cpu_seconds': server_cpu,
+            'server_cpu_seconds_per_gib': server_cpu / (self.bytes / GIB)
+            if self.bytes else None,
+            'server_peak_rss': peak_rss,
+            'client_cpu_seconds': client_cpu,
+            'latency': {
+                operation: {
+                    'count': len(latencies),
+                    'mean': sum(latencies) / len(latencies),
+                    **get_percentiles(latencies),
+                }
+                for operation, latencies in self.latencies.items()
+            },
+        }
+
+
+class LoadTest:
+    """Drives the server by the concurrent clients
+
+    :param url: the URL of the server
+    :param args: the options of the benchmark
+    """
+
+    def __init__(self, url: str, args: argparse.Namespace):
+        self.url = url
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.content = Content(args.seed)
+        self.stored: List[str] = []
+        self.session: Optional[ClientSession] = None
+
+    async def run(self, pid: int) -> Dict:
+        """Runs the phases, the resources of the server are measured by
+        its process id"""
+        connector = TCPConnector(limit=self.args.concurrency)
+        timeout = ClientTimeout(total=None)
+        async with ClientSession(connector=connector,
+                                 timeout=timeout) as self.session:
+            await self.wait_started()
+            results = {}
+            for phase in self.args.phases:
+                operations = self.get_operations(phase)
+                results[phase] = await self.run_phase(phase, operations,
+                                                      pid)
+                log_phase(phase, results[phase])
+            return results
+
+    async def wait_started(self) -> None:
+        """Waits until the server answers
+        :raise TimeoutError: the server has not started
+        """
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                async with self.session.get(f'{self.url}/status') as resp:
+                    if resp.status == 200:
+                        return
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError('The server has not started')
+            await asyncio.sleep(0.1)
+
+    def get_operations(self, phase: str) -> Iterator[str]:
+        if phase == PHASE_UPLOAD:
+            return (OPERATION_WRITE for _ in range(self.args.files))
+        if phase == PHASE_DELETE:
+            return (OPERATION_DELETE for _ in range(len(self.stored)))
+
+        names = [operation for operation, _ in self.args.mix]
+        weights = [weight for _, weight in self.args.mix]
+        return iter(self.random.choices(names, weights,
+                                        k=self.args.requests))
+
+    async def run_phase(self, phase: str, operations: Iterator[str],
+                        pid: int) -> Dict:
+        stats = PhaseStats(phase)
+        server_before = get_process_usage(pid)
+        client_before = time.process_time()
+        started = time.monotonic()
+
+        await asyncio.gather(*(
+            self.run_client(operations, stats)
+            for _ in range(self.args.concurrency)))
+
+        seconds = time.monotonic() - started
+        server_after = get_process_usage(pid)
+        return stats.report(
+            seconds, server_after.cpu_time - server_before.cpu_time,
+            time.process_time() - client_before, server_after.peak_rss)
+
+    async def run_client(self, operations: Iterator[str],
+                         stats: PhaseStats) -> None:
+        """Runs the operations one by one, the clients share
+        the iterator"""
+        for operation in operations:
+            if operation != OPERATION_WRITE and not self.stored:
+                operation = OPERATION_WRITE
+
+            try:
+                if operation == OPERATION_WRITE:
+                    await self.write(stats)
+                elif operation == OPERATION_READ:
+                    await self.read(stats)
+                else:
+                    await self.delete(stats)
+            except Exception as e:
+                logger.debug('%s has failed: %r', operation, e)
+                stats.errors += 1
+
+    async def write(self, stats: PhaseStats) -> None:
+        sizes = [size for size, _ in self.args.sizes]
+        weights = [weight for _, weight in self.args.sizes]
+        data = self.content.make(self.random.choices(sizes, weights)[0])
+
+        started = time.monotonic()
+        if self.args.multipart:
+            form = FormData()
+            form.add_field('file', data, filename='file')
+            request = self.session.post(f'{self.url}/files/', data=form)
+        else:
+            request = self.session.put(
+                f'{self.url}/files/', data=data,
+                headers={hdrs.CONTENT_TYPE: 'application/octet-stream'})
+        async with request as resp:
+            body = await resp.json()
+            if resp.status not in (200, 201):
+                raise ValueError(f'Upload has failed: {resp.status}')
+        stats.record(OPERATION_WRITE, time.monotonic() - started, len(data))
+        self.stored.append(body['file_hash'])
+
+    async def read(self, stats: PhaseStats) -> None:
+        file_hash = self.random.choice(self.stored)
+        size = 0
+        started = time.monotonic()
+        async with self.session.get(f'{self.url}/files/{file_hash}') as resp:
+            async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+                size += len(chunk)
+            if resp.status != 200:
+                raise ValueError(f'Download has failed: {resp.status}')
+        stats.record(OPERATION_READ, time.monotonic() - started, size)
+
+    async def delete(self, stats: PhaseStats) -> None:
+        file_hash = self.stored.pop(self.random.randrange(len(self.stored)))
+        started = time.monotonic()
+        async with self.session.delete(
+                f'{self.url}/files/{file_hash}') as resp:
+            if resp.status != 204:
+                raise ValueError(f'Delete has failed: {resp.status}')
+        stats.record(OPERATION_DELETE, time.monotonic() - started, 0)
+
+
+def log_phase(phase: str, result: Dict) -> None:
+    print(f'{phase}: {result["operations"]} requests, '
+          f'{result["errors"]} errors, '
+          f'{format_size(result["bytes"])}B in {result["seconds"]:.2f}s, '
+          f'{result["throughput_mib_s"]:.1f} MiB/s, '
+          f'{result["operations_per_s"]:.0f} req/s, '
+          f'server CPU {result["server_cpu_seconds"]:.2f}s, '
+          f'peak RSS {format_size(result["server_peak_rss"])}B',
+          file=sys.stderr)
+    for operation, latency in result['latency'].items():
+        print(f'  {operation}: ' + ', '.join(
+            f'{name} {value * 1000:.2f}ms' for name, value in latency.items()
+            if name != 'count' and value is not None), file=sys.stderr)
+
+
+def main():
+    args = parser.parse_args()
+    for phase in args.phases:
+        if phase not in PHASES:
+            parser.error(f'Unknown phase {phase}')
+
+    storage = args.storage
+    if storage is None:
+        storage = Path(tempfile.mkdtemp(prefix='file-loader-bench-'))
+    storage.mkdir(parents=True, exist_ok=True)
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+
+    server = multiprocessing.get_context('fork').Process(
+        target=serve, args=(sock, storage, dict(args.app_options)))
+    server.start()
+    sock.close()
+    try:
+        results = asyncio.run(LoadTest(url, args).run(server.pid))
+    finally:
+        server.terminate()
+        server.join()
+        if args.storage is None:
+            shutil.rmtree(storage, ignore_errors=True)
+
+    options = vars(args).copy()
+    options['app_options'] = dict(args.app_options)
+    write_results(args.output, 'load', options, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Micro-benchmarks of the stages of the upload and the download, each
+stage is measured on its own:
+
+    hashing -- Hasher of each algorithm over the chunks of the upload,
+               compared with hashing the whole buffer by one call
+    write   -- StagedFile writing the chunks and committing the file into
+               the store with each durability level
+    read    -- IOEngine reading the stored file by its buffers
+
+The median of the repeats is reported. The files are read from the page
+cache unless they are evicted between the repeats by the system.
+"""
+import argparse
+import asyncio
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks.common import parse_size, write_results
+from file_loader.storage.commit import DURABILITY_LEVELS, GroupCommit, \
+    StagedFile
+from file_loader.storage.hashing import ALGORITHMS, Hasher
+from file_loader.storage.io_engine import IOEngine
+from file_loader.utils.argparse import positive_int
+
+STAGE_HASHING = 'hashing'
+STAGE_WRITE = 'write'
+STAGE_READ = 'read'
+STAGES = (STAGE_HASHING, STAGE_WRITE, STAGE_READ)
+MIB = 1024 ** 2
+
+parser = argparse.ArgumentParser(
+    description=__doc__, prog='python -m benchmarks.micro',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--stages', default=','.join(STAGES),
+                    type=lambda value: value.split(','),
+                    help='Stages to measure (default: %(default)s)')
+parser.add_argument('--size', type=parse_size, default='64M',
+                    help='Size of the hashed and the read data '
+                         '(default: %(default)s)')
+parser.add_argument('--chunk-size', type=parse_size, default='64K',
+                    help='Size of the chunks of the upload, the chunk '
+                         'size of FileManager (default: %(default)s)')
+parser.add_argument('--file-size', type=parse_size, default='1M',
+                    help='Size of the files written by the write stage '
+                         '(default: %(default)s)')
+parser.add_argument('--files', type=positive_int, default=100,
+                    help='Amount of files written by the write stage '
+                         '(default: %(default)s)')
+parser.add_argument('--repeat', type=positive_int, default=5,
+                    help='Amount of repeats of each measurement '
+                         '(default: %(default)s)')
+parser.add_argument('--dir', type=Path,
+                    help='Directory the files are written to, it should be '
+                         'on the disk under test')
+parser.add_argument('--output', type=Path,
+                    help='File the JSON results are written to, stdout by '
+                         'default')
+
+
+async def measure(repeat: int, func: Callable) -> float:
+    """Returns the median seconds of running the coroutine function"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def chunk(data: bytes, size: int) -> List[bytes]:
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+async def bench_hashing(args: argparse.Namespace, data: bytes) -> Dict:
+    chunks = chunk(data, args.chunk_size)
+    results = {}
+    for name, algorithm in ALGORITHMS.items():
+        async def hash_chunks():
+            hasher = Hasher(algorithm)
+            for piece in chunks:
+                await hasher.update(piece)
+            await hasher.hexdigest()
+
+        async def hash_buffer():
+            algorithm.factory(data).hexdigest()
+
+        streamed = await measure(args.repeat, hash_chunks)
+        whole = await measure(args.repeat, hash_buffer)
+        results[name] = {
+            'mib_s': len(data) / MIB / streamed,
+            'buffer_mib_s': len(data) / MIB / whole,
+        }
+        print(f'hashing {name}: {results[name]["mib_s"]:.0f} MiB/s, '
+              f'one buffer {results[name]["buffer_mib_s"]:.0f} MiB/s',
+              file=sys.stderr)
+    return results
+
+
+async def bench_write(args: argparse.Namespace, data: bytes,
+                      path: Path) -> Dict:
+    chunks = chunk(data[:args.file_size], args.chunk_size)
+    results = {}
+    for durability in DURABILITY_LEVELS:
+        store = path / f'write-{durability}'
+        group_commit = GroupCommit(durability)
+
+        async def write_files():
+            shutil.rmtree(store, ignore_errors=True)
+            store.mkdir()
+
+            async def write_file(number: int):
+                async with StagedFile(store, args.file_size) as staged:
+                    for piece in chunks:
+                        await staged.write(piece)
+                    await staged.commit(store / f'{number:08d}',
+                                        group_commit)
+
+            await asyncio.gather(*map(write_file, range(args.files)))
+
+        seconds = await measure(args.repeat, write_files)
+        await group_commit.close()
+        results[durability] = {
+            'files_s': args.files / seconds,
+            'mib_s': args.files * len(data[:args.file_size]) / MIB / seconds,
+        }
+        print(f'write {durability}: '
+              f'{results[durability]["files_s"]:.0f} files/s, '
+              f'{results[durability]["mib_s"]:.0f} MiB/s', file=sys.stderr)
+    return results
+
+
+async def bench_read(args: argparse.Namespace, data: bytes,
+                     path: Path) -> Dict:
+    file_path = path / 'read'
+    file_path.write_bytes(data)
+    io_engine = IOEngine()
+
+    async def read_file():
+        async for _ in io_engine.read_file(file_path):
+            pass
+
+    seconds = await measure(args.repeat, read_file)
+    results = {
+        'mib_s': len(data) / MIB / seconds,
+        'buffer_size': io_engine.get_buffer_size(len(data)),
+    }
+    print(f'read: {results["mib_s"]:.0f} MiB/s by '
+          f'{results["buffer_size"] // 1024}K buffers', file=sys.stderr)
+    return results
+
+
+async def run(args: argparse.Namespace, path: Path) -> Dict:
+    data = random.Random(0).getrandbits(args.size * 8) \
+        .to_bytes(args.size, 'little')
+
+    results = {}
+    if STAGE_HASHING in args.stages:
+        results[STAGE_HASHING] = await bench_hashing(args, data)
+    if STAGE_WRITE in args.stages:
+        results[STAGE_WRITE] = await bench_write(args, data, path)
+    if STAGE_READ in args.stages:
+        results[STAGE_READ] = await bench_read(args, data, path)
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'Unknown stage {stage}')
+
+    path = Path(tempfile.mkdtemp(prefix='file-loader-micro-', dir=args.dir))
+    try:
+        results = asyncio.run(run(args, path))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    write_results(args.output, 'micro', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
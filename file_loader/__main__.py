@@ -12,9 +12,17 @@ from configargparse import ArgumentParser
 from setproctitle import setproctitle
 
 from file_loader.api.app import create_app
-from file_loader.utils.argparse import clear_environ, positive_int, \
+from file_loader.storage.commit import DURABILITY_GROUP, DURABILITY_LEVELS
+from file_loader.storage.compression import COMPRESSION_OFF, ENCODINGS
+from file_loader.storage.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+from file_loader.storage.index import INDEX_MEMORY, INDEX_MODES
+from file_loader.storage.io_engine import MAX_BUFFER_SIZE, MIN_BUFFER_SIZE
+from file_loader.storage.layout import DEFAULT_LAYOUT
+from file_loader.storage.packs import MAX_PACK_SIZE
+from file_loader.utils.argparse import clear_environ, fraction, \
+    non_negative_float, non_negative_int, positive_float, positive_int, \
     validate
-from file_loader.daemon import AbstractDaemon
+from file_loader.daemon import AbstractDaemon, WorkerSupervisor
 
 ENV_VAR_PREFIX = 'FILE_LOADER_'
 BASE_STORAGE_DIR \
@@ -32,6 +40,154 @@ group.add_argument('--api-address', default='0.0.0.0',
                    help='IPv4/IPv6 address API server would listen on')
 group.add_argument('--api-port', type=positive_int, default=8081,
                    help='TCP port API server would listen on')
+group.add_argument('--workers', type=positive_int, default=1,
+                   help='Amount of worker processes sharing the API socket')
+group.add_argument('--shutdown-timeout', type=positive_float, default=60.0,
+                   help='Seconds the requests in progress are waited for '
+                        'on stop and reload before they are aborted')
+group.add_argument('--upload-concurrency', type=non_negative_int, default=16,
+                   help='Amount of uploads served at once by each worker, '
+                        '0 disables the limit')
+group.add_argument('--upload-queue-size', type=non_negative_int, default=256,
+                   help='Amount of uploads waiting for their turn, the rest '
+                        'are rejected with 503')
+group.add_argument('--download-concurrency', type=non_negative_int,
+                   default=256,
+                   help='Amount of downloads served at once by each worker, '
+                        '0 disables the limit')
+group.add_argument('--download-queue-size', type=non_negative_int,
+                   default=1024,
+                   help='Amount of downloads waiting for their turn, '
+                        'the rest are rejected with 503')
+group.add_argument('--metadata-concurrency', type=non_negative_int,
+                   default=256,
+                   help='Amount of metadata requests (HEAD, DELETE, batches) '
+                        'served at once by each worker, 0 disables the limit')
+group.add_argument('--metadata-queue-size', type=non_negative_int,
+                   default=1024,
+                   help='Amount of metadata requests waiting for their '
+                        'turn, the rest are rejected with 503')
+group.add_argument('--admission-timeout', type=positive_float, default=10.0,
+                   help='Seconds the request may wait for its turn before '
+                        'it is rejected with 503')
+group.add_argument('--disable-sendfile', action='store_true',
+                   help='Stream downloads chunk by chunk instead of '
+                        'passing files to the kernel by sendfile')
+
+group = parser.add_argument_group('Storage options')
+group.add_argument('--hash-algorithm', default=DEFAULT_ALGORITHM,
+                   choices=tuple(ALGORITHMS),
+                   help='Algorithm hashing the uploaded files when it is '
+                        'not passed in the URL')
+group.add_argument('--index-mode', default=INDEX_MEMORY, choices=INDEX_MODES,
+                   help='Index of the stored files: built by the scan on '
+                        'start, saved to the store to be reused on restart '
+                        'or disabled')
+group.add_argument('--cache-size', type=non_negative_int, default=0,
+                   help='Size of the memory cache of small files in bytes, '
+                        'the cache of each worker is separate, 0 disables '
+                        'the cache')
+group.add_argument('--cache-max-file-size', type=positive_int,
+                   default=64 * 1024,
+                   help='Files larger than this are never cached')
+group.add_argument('--read-threads', type=non_negative_int, default=32,
+                   help='Amount of threads reading the files, 0 uses '
+                        'the default executor')
+group.add_argument('--write-threads', type=non_negative_int, default=8,
+                   help='Amount of threads writing and syncing the files, '
+                        '0 uses the default executor')
+group.add_argument('--min-buffer-size', type=positive_int,
+                   default=MIN_BUFFER_SIZE,
+                   help='Size of the buffers reading small files')
+group.add_argument('--max-buffer-size', type=positive_int,
+                   default=MAX_BUFFER_SIZE,
+                   help='Size of the buffers reading large files, buffers '
+                        'in between are chosen by the file size')
+group.add_argument('--compression', default=COMPRESSION_OFF,
+                   choices=(COMPRESSION_OFF, *ENCODINGS),
+                   help='Encoding compressible files are stored with, they '
+                        'are sent as is to clients accepting it')
+group.add_argument('--compression-level', type=non_negative_int, default=6,
+                   help='Level of compression of the stored files')
+group.add_argument('--shard-depth', type=positive_int,
+                   default=DEFAULT_LAYOUT.depth,
+                   help='Amount of nested directories the files are '
+                        'sharded by, the store with another layout is '
+                        'migrated in the background')
+group.add_argument('--shard-width', type=positive_int,
+                   default=DEFAULT_LAYOUT.width,
+                   help='Amount of hash characters naming each shard '
+                        'directory')
+group.add_argument('--durability', default=DURABILITY_GROUP,
+                   choices=DURABILITY_LEVELS,
+                   help='Saved files are synced to the disk before they are '
+                        'acknowledged: in batches of concurrent uploads '
+                        '(group), one by one (sync) or not synced (none)')
+group.add_argument('--commit-delay', type=non_negative_float, default=0.0,
+                   help='Seconds the group commit waits for more uploads '
+                        'to sync them together')
+group.add_argument('--pack-max-file-size', type=non_negative_int, default=0,
+                   help='Files not larger than this are appended into pack '
+                        'files instead of their own files, 0 disables '
+                        'packing')
+group.add_argument('--pack-size', type=positive_int, default=MAX_PACK_SIZE,
+                   help='New pack file is started when the active one '
+                        'reaches this size')
+group.add_argument('--compact-interval', type=positive_float, default=300.0,
+                   help='Seconds between compactions of the packs')
+group.add_argument('--compact-ratio', type=fraction, default=0.5,
+                   help='Packs with at least this part of deleted files '
+                        'are compacted')
+group.add_argument('--cold-storage', action='append', type=pathlib.Path,
+                   default=[],
+                   help='Directory of the colder tier of the store, e.g. on '
+                        'HDD, repeat for slower tiers. Files not read '
+                        'recently are moved there from the store')
+group.add_argument('--tier-idle-time', type=positive_float,
+                   default=7 * 24 * 3600.0,
+                   help='Seconds after which files not read are demoted to '
+                        'the next tier')
+group.add_argument('--tier-promote-reads', type=positive_int, default=2,
+                   help='Cold file read this many times within the idle '
+                        'time is promoted back into the store')
+group.add_argument('--tier-max-usage', type=fraction, default=0.9,
+                   help='Part of the disk of the tier that may be used, '
+                        'the least recently read files are demoted while '
+                        'it is exceeded')
+group.add_argument('--tier-interval', type=positive_float, default=3600.0,
+                   help='Seconds between demotions of the files')
+group.add_argument('--upload-ttl', type=positive_float, default=24 * 3600.0,
+                   help='Seconds after which resumable upload sessions '
+                        'without uploads expire')
+group.add_argument('--scrub', action='store_true',
+                   help='Verify the stored files in the background, each '
+                        'pass reads the whole store')
+group.add_argument('--scrub-interval', type=positive_float,
+                   default=7 * 24 * 3600.0,
+                   help='Seconds between verifications of each stored file, '
+                        'corrupt files are moved to the quarantine '
+                        'directory')
+group.add_argument('--scrub-processes', type=positive_int, default=1,
+                   help='Amount of processes hashing the files verified by '
+                        'the scrubber')
+group.add_argument('--scrub-rate', type=non_negative_int,
+                   default=32 * 1024 * 1024,
+                   help='Bytes per second read by the scrubber, 0 disables '
+                        'the limit')
+group.add_argument('--verify-reads', action='store_true',
+                   help='Verify files not verified within the scrub '
+                        'interval while they are downloaded whole, '
+                        'the download of a corrupt file is aborted')
+group.add_argument('--peer', action='append', default=[],
+                   help='URL of the peer node the saved and deleted files '
+                        'are replicated to, e.g. http://10.0.0.2:8081, '
+                        'repeat for more peers')
+group.add_argument('--replication-concurrency', type=positive_int,
+                   default=4,
+                   help='Amount of files sent to each peer at once')
+group.add_argument('--disable-read-repair', action='store_true',
+                   help='Do not fetch files missing in the store from '
+                        'the peers when they are downloaded')
 
 group = parser.add_argument_group('Logging options')
 group.add_argument('--log-level', default='INFO',
@@ -43,7 +199,11 @@ group.add_argument('--working_directory',
                    type=validate(pathlib.Path),
                    help='Directory for storage daemon files')
 group.add_argument('--status', default='start',
-                   choices=('start', 'stop', 'restart',))
+                   choices=('start', 'stop', 'restart', 'reload'),
+                   help='reload replaces the running daemon without '
+                        'refusing connections, the new daemon takes over '
+                        'its socket and it exits when its requests are '
+                        'finished')
 
 
 class FileLoaderDaemon(AbstractDaemon):
@@ -60,29 +220,119 @@ class FileLoaderDaemon(AbstractDaemon):
             flush_interval=0.3,
             loop=loop,
         )
-        logging.basicConfig(level=self.log_level, handlers=[handler, ])
+        logging.basicConfig(level=self.log_level, handlers=[handler, ],
+                            force=True)
 
     def run(self):
         self.init_logger()
         logger = logging.getLogger(__class__.__name__)
 
-        # Socket is allocated for ability change the OS user
-        try:
-            sock = bind_socket(address=self.api_address, port=self.api_port,
-                               proto_name='http')
-        except OSError as e:
-            logger.exception(e)
-            exit(1)
+        # Socket is allocated for ability change the OS user. It's taken
+        # over from the daemon being reloaded if it has the same address
+        sock = self.handoff.take_over()
+        if sock is not None \
+                and sock.getsockname()[:2] != (self.api_address,
+                                               self.api_port):
+            logger.warning('Socket of the running daemon is bound to %r, '
+                           'a new one is bound', sock.getsockname())
+            sock.close()
+            sock = None
+        if sock is None:
+            try:
+                sock = bind_socket(address=self.api_address,
+                                   port=self.api_port, proto_name='http')
+            except OSError as e:
+                logger.exception(e)
+                exit(1)
 
         if self.user is not None:
             logger.info('Changing user to %r', self.user.pw_name)
             os.setgid(self.user.pw_gid)
             os.setuid(self.user.pw_uid)
 
+        if self.workers == 1:
+            self.serve(sock, on_started=lambda: self.ready(sock))
+        else:
+            # The reloaded daemon is stopped when every worker is started
+            supervisor = WorkerSupervisor(
+                self.workers,
+                target=lambda number: self.run_worker(
+                    sock, number, supervisor.notify_started),
+                on_started=lambda: self.ready(sock))
+            supervisor.run()
+
+    def run_worker(self, sock, number, on_started):
+        """Runs the API server in the forked worker process"""
+        setproctitle('file-loader-worker')
+
+        # The event loop and the logging flusher thread of the parent
+        # are not usable after the fork
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.init_logger()
+
+        # The store is maintained (e.g. its layout is migrated) by
+        # the only worker
+        self.serve(sock, primary=number == 0, on_started=on_started)
+
+    def serve(self, sock, primary=True, on_started=None):
         app = create_app()
         app['storage_path'] = self.storage
+        app['upload_concurrency'] = self.upload_concurrency
+        app['upload_queue_size'] = self.upload_queue_size
+        app['download_concurrency'] = self.download_concurrency
+        app['download_queue_size'] = self.download_queue_size
+        app['metadata_concurrency'] = self.metadata_concurrency
+        app['metadata_queue_size'] = self.metadata_queue_size
+        app['admission_timeout'] = self.admission_timeout
+        app['sendfile'] = not self.disable_sendfile
+        app['hash_algorithm'] = self.hash_algorithm
+        app['workers'] = self.workers
+        app['index_mode'] = self.index_mode
+        app['cache_size'] = self.cache_size
+        app['cache_max_file_size'] = self.cache_max_file_size
+        app['read_threads'] = self.read_threads
+        app['write_threads'] = self.write_threads
+        app['min_buffer_size'] = self.min_buffer_size
+        app['max_buffer_size'] = self.max_buffer_size
+        app['compression'] = self.compression
+        app['compression_level'] = self.compression_level
+        app['shard_depth'] = self.shard_depth
+        app['shard_width'] = self.shard_width
+        app['migrate_layout'] = primary
+        app['durability'] = self.durability
+        app['commit_delay'] = self.commit_delay
+        app['cold_storage_paths'] = tuple(self.cold_storage)
+        app['tier_idle_time'] = self.tier_idle_time
+        app['tier_promote_reads'] = self.tier_promote_reads
+        app['tier_max_usage'] = self.tier_max_usage
+        app['tier_interval'] = self.tier_interval
+        app['migrate_tiers'] = primary
+        app['pack_max_file_size'] = self.pack_max_file_size
+        app['pack_size'] = self.pack_size
+        app['compact_packs'] = primary
+        app['compact_interval'] = self.compact_interval
+        app['compact_ratio'] = self.compact_ratio
+        app['upload_ttl'] = self.upload_ttl
+        app['expire_uploads'] = primary
+        app['scrub'] = self.scrub and primary
+        app['scrub_interval'] = self.scrub_interval
+        app['scrub_processes'] = self.scrub_processes
+        app['scrub_rate'] = self.scrub_rate
+        app['verify_reads'] = self.verify_reads
+        app['replication_peers'] = tuple(peer.rstrip('/')
+                                         for peer in self.peer)
+        app['replication_concurrency'] = self.replication_concurrency
+        app['replicate'] = primary
+        app['read_repair'] = not self.disable_read_repair
+
+        # run_app reports the server is running after the socket is
+        # served, the reloaded daemon is stopped then
+        def on_running(_):
+            if on_started is not None:
+                on_started()
 
-        run_app(app, sock=sock)
+        run_app(app, sock=sock, shutdown_timeout=self.shutdown_timeout,
+                print=on_running)
 
 
 def main():
@@ -93,6 +343,8 @@ def main():
 
     # Create daemon storage dir
     args.working_directory.mkdir(parents=True, exist_ok=True)
+    # The daemon changes its working directory
+    args.cold_storage = [path.resolve() for path in args.cold_storage]
 
     # Give the process a name
     setproctitle('file-loader-daemon')
@@ -109,6 +361,9 @@ def main():
     elif 'restart' == args.status:
         print('Daemon restarting..')
         daemon.restart()
+    elif 'reload' == args.status:
+        print('Daemon reloading..')
+        daemon.reload()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict
+
+OPERATION_UPLOAD = 'upload'
+OPERATION_DOWNLOAD = 'download'
+OPERATION_METADATA = 'metadata'
+OPERATIONS = (OPERATION_UPLOAD, OPERATION_DOWNLOAD, OPERATION_METADATA)
+
+# Weight of the last wait in the moving average the retry delay is
+# estimated by
+WAIT_SMOOTHING = 0.2
+
+
+class OverloadedError(Exception):
+    """The request is shed, the queue of its operation is full or it has
+    waited too long
+
+    Attributes:
+        retry_after -- seconds the client should wait before retrying
+    """
+
+    def __init__(self, operation: str, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(f'Too many {operation} requests')
+
+
+class AdmissionPool:
+    """Limits the amount of the requests of one operation served at once,
+    the rest wait in the bounded queue in the order of arrival. Requests
+    which don't fit into the queue or wait longer than the timeout are
+    shed, so one kind of work can't starve the others.
+
+    :param operation: the name of the operation
+    :param concurrency: the amount of requests served at once
+    :param queue_size: the amount of requests waiting for their turn
+    :param timeout: seconds the request may wait for its turn
+    """
+
+    def __init__(self, operation: str, concurrency: int, queue_size: int,
+                 timeout: float):
+        self.operation = operation
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._mean_wait = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        """The amount of requests waiting for their turn"""
+        return len(self._waiters)
+
+    @property
+    def is_full(self) -> bool:
+        """The next request would be shed"""
+        return self.active >= self.concurrency \
+            and self.queued >= self.queue_size
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds the shed request should wait before retrying"""
+        return max(1, math.ceil(self._mean_wait))
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'mean_wait': self.wait_time / self.admitted
+            if self.admitted else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def check(self) -> None:
+        """Sheds the request in advance when it would be shed
+        :raise OverloadedError: the queue is full
+        """
+        if self.is_full:
+            self.shed += 1
+            raise OverloadedError(self.operation, self.retry_after)
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Waits for the turn of the request, the request is served
+        inside the context
+        :raise OverloadedError: the request is shed
+        """
+        await self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self) -> None:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._record_wait(0.0)
+            return
+
+        if self.queued >= self.queue_size:
+            self.shed += 1
+            raise OverloadedError(self.operation, self.retry_after)
+
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                self.shed += 1
+                self._record_wait(time.monotonic() - started,
+                                  admitted=False)
+                raise OverloadedError(self.operation, self.retry_after)
+        except asyncio.CancelledError:
+            if waiter.done():
+                # The turn was passed to the cancelled request
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+        self._record_wait(time.monotonic() - started)
+
+    def _release(self) -> None:
+        # The turn is passed to the next request, it's served in place
+        # of the released one
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.active -= 1
+
+    def _record_wait(self, wait: float, admitted: bool = True) -> None:
+        if admitted:
+            self.admitted += 1
+            self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._mean_wait += (wait - self._mean_wait) * WAIT_SMOOTHING
@@ -1,27 +1,606 @@
+import asyncio
 import logging
+import time
+from contextlib import suppress
+from functools import partial
 from types import MappingProxyType
-from typing import Mapping
+from typing import AsyncIterator, Mapping, Optional
 
 from aiohttp import PAYLOAD_REGISTRY, JsonPayload
 from aiohttp.web_app import Application
 
-from file_loader.api.middleware import error_middleware
+from file_loader.api.admission import OPERATIONS, AdmissionPool
+from file_loader.api.file_manager import FileManager
+from file_loader.api.metrics import LOOP_LAG_INTERVAL, Metrics
+from file_loader.api.middleware import admission_middleware, \
+    error_middleware, metrics_middleware
 from file_loader.api.handlers import HANDLERS
+from file_loader.replication.journal import ReplicationJournal
+from file_loader.replication.replicator import Replicator
+from file_loader.storage.cache import FileCache
+from file_loader.storage.commit import DURABILITY_GROUP, GroupCommit
+from file_loader.storage.compression import COMPRESSION_OFF
+from file_loader.storage.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+from file_loader.storage.io_engine import MAX_BUFFER_SIZE, \
+    MIN_BUFFER_SIZE, IOEngine
+from file_loader.storage.index import INDEX_MEMORY, INDEX_OFF, \
+    INDEX_PERSISTENT, StorageIndex
+from file_loader.storage.layout import DEFAULT_LAYOUT, LayoutMigration, \
+    StoreLayout, load_layouts, save_layouts
+from file_loader.storage.packs import MAX_PACK_SIZE, PACKS_DIR, PackStore
+from file_loader.storage.scrubber import QUARANTINE_DIR, SYNC_INTERVAL, \
+    Scrubber, VerificationLog
+from file_loader.storage.tiers import StorageTiers, TieredIndex
+from file_loader.storage.uploads import EXPIRE_INTERVAL, UPLOADS_DIR, \
+    UploadSessions
 
 logger = logging.getLogger(__name__)
 
 
+async def setup_admission(app: Application) -> AsyncIterator[None]:
+    """
+    Creates the admission pools of the operations, the operation without
+    the concurrency limit is not limited.
+    """
+    app['admission_pools'] = {
+        operation: AdmissionPool(operation,
+                                 app[f'{operation}_concurrency'],
+                                 app[f'{operation}_queue_size'],
+                                 app['admission_timeout'])
+        for operation in OPERATIONS
+        if app[f'{operation}_concurrency']
+    }
+    yield
+
+    for operation, pool in app['admission_pools'].items():
+        logger.info('Admission of %s requests: %r', operation, pool.stats)
+
+
+async def setup_io_engine(app: Application) -> AsyncIterator[None]:
+    """
+    Starts the thread pools doing the disk I/O of the store, waits for
+    the I/O in progress on shutdown.
+    """
+    io_engine = IOEngine(app['read_threads'], app['write_threads'],
+                         app['min_buffer_size'], app['max_buffer_size'])
+    io_engine.open()
+    app['io_engine'] = io_engine
+    yield
+
+    await io_engine.close()
+
+
+async def setup_metrics(app: Application) -> AsyncIterator[None]:
+    """
+    Creates the metrics of the process, the executor queues and
+    the admission pools are read when the metrics are rendered. The lag
+    of the event loop is measured in the background.
+    """
+    metrics = Metrics()
+    metrics.add_gauge(
+        'file_loader_executor_queue_depth',
+        'Calls waiting for a thread of the executor', ('executor',),
+        lambda: {(name,): depth for name, depth
+                 in app['io_engine'].queue_depths.items()})
+    pools = app['admission_pools']
+    metrics.add_gauge(
+        'file_loader_admission_active',
+        'Requests served by the admission pool', ('operation',),
+        lambda: {(name,): pool.active for name, pool in pools.items()})
+    metrics.add_gauge(
+        'file_loader_admission_queued',
+        'Requests waiting for their turn', ('operation',),
+        lambda: {(name,): pool.queued for name, pool in pools.items()})
+    metrics.add_gauge(
+        'file_loader_admission_shed',
+        'Requests shed by the admission pool', ('operation',),
+        lambda: {(name,): pool.shed for name, pool in pools.items()})
+    app['metrics'] = metrics
+
+    monitor = asyncio.ensure_future(monitor_loop_lag(metrics))
+    yield
+
+    monitor.cancel()
+    with suppress(asyncio.CancelledError):
+        await monitor
+
+
+async def monitor_loop_lag(metrics: Metrics) -> None:
+    """
+    Measures how late the event loop wakes up the sleeping task, the loop
+    is late when the callbacks block it.
+    """
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.monotonic() - started - LOOP_LAG_INTERVAL
+        metrics.loop_lag.observe(max(lag, 0.0))
+
+
+async def setup_storage_index(app: Application) -> AsyncIterator[None]:
+    """
+    Builds the index of the store before the server starts serving
+    requests, saves it on shutdown.
+    """
+    index = None
+    if app['index_mode'] != INDEX_OFF:
+        index = StorageIndex(
+            app['storage_path'],
+            # Files saved by other workers are not in the index
+            authoritative=app['workers'] == 1,
+            persistent=app['index_mode'] == INDEX_PERSISTENT,
+            excluded=(PACKS_DIR, UPLOADS_DIR, QUARANTINE_DIR))
+        if app['cold_storage_paths']:
+            # Each tier has its own index saved to the tier
+            index = TieredIndex([index, *(
+                StorageIndex(cold_path,
+                             authoritative=app['workers'] == 1,
+                             persistent=index.persistent,
+                             excluded=(QUARANTINE_DIR,))
+                for cold_path in app['cold_storage_paths']
+            )])
+        await index.open()
+
+    app['storage_index'] = index
+    yield
+
+    if index is not None:
+        await index.close()
+
+
+async def setup_file_cache(app: Application) -> AsyncIterator[None]:
+    """
+    Creates the memory cache of small files, its usage is read when
+    the metrics are rendered.
+    """
+    cache = None
+    if app['cache_size']:
+        cache = FileCache(app['cache_size'], app['cache_max_file_size'])
+        metrics = app['metrics']
+        metrics.add_counter(
+            'file_loader_file_cache_requests_total',
+            'Reads of the files looked up in the memory cache', ('result',),
+            lambda: {('hit',): cache.hits, ('miss',): cache.misses})
+        metrics.add_counter(
+            'file_loader_file_cache_evictions_total',
+            'Files evicted from the memory cache', (),
+            lambda: {(): cache.evictions})
+        metrics.add_gauge(
+            'file_loader_file_cache_bytes',
+            'Bytes of the files in the memory cache', (),
+            lambda: {(): cache.size})
+        metrics.add_gauge(
+            'file_loader_file_cache_files',
+            'Files in the memory cache', (),
+            lambda: {(): len(cache)})
+
+    app['file_cache'] = cache
+    yield
+
+    if cache is not None:
+        logger.info('File cache stats: %r', cache.stats)
+
+
+async def setup_store_layout(app: Application) -> AsyncIterator[None]:
+    """
+    Resolves the layout of the store. When the store has another layout,
+    its files are migrated in the background and looked for in the old
+    layout until the migration completes.
+    """
+    layout = StoreLayout(app['shard_depth'], app['shard_width'])
+    min_hex_length = min(algorithm.hex_length
+                         for algorithm in ALGORITHMS.values())
+    if layout.prefix_length >= min_hex_length:
+        raise ValueError(f'Shard directories should use less than '
+                         f'{min_hex_length} hash characters')
+
+    loop = asyncio.get_event_loop()
+    storage_path = app['storage_path']
+    layouts = await loop.run_in_executor(None, load_layouts, storage_path)
+    app['layout'] = layout
+    app['fallback_layouts'] = tuple(old for old in layouts if old != layout)
+
+    migration = None
+    if app['fallback_layouts'] and app['migrate_layout']:
+        await loop.run_in_executor(None, save_layouts, storage_path,
+                                   (layout, *app['fallback_layouts']))
+        migration = asyncio.ensure_future(migrate_store_layout(app))
+    yield
+
+    if migration is not None:
+        migration.cancel()
+        with suppress(asyncio.CancelledError):
+            await migration
+
+
+async def migrate_store_layout(app: Application) -> None:
+    """
+    Moves the files of the store and its colder tiers into its layout,
+    the old layouts are forgotten when all files are moved.
+    """
+    logger.info('Migrating the store from %r to %r',
+                app['fallback_layouts'], app['layout'])
+    for tier_path in (app['storage_path'], *app['cold_storage_paths']):
+        migration = LayoutMigration(tier_path, app['layout'],
+                                    index=app['storage_index'],
+                                    cache=app['file_cache'])
+        try:
+            await migration.run()
+        except Exception:
+            logger.exception('Migration of the store has failed after '
+                             'moving %d files of %s, it is resumed on '
+                             'restart', migration.moved, tier_path)
+            return
+
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, save_layouts, app['storage_path'],
+                               (app['layout'],))
+    app['fallback_layouts'] = ()
+
+
+async def setup_group_commit(app: Application) -> AsyncIterator[None]:
+    """
+    Creates the group commit syncing the saved files to the disk.
+    """
+    group_commit = GroupCommit(app['durability'], app['commit_delay'],
+                               app['io_engine'].write_executor)
+    app['group_commit'] = group_commit
+    yield
+
+    await group_commit.close()
+
+
+async def setup_storage_tiers(app: Application) -> AsyncIterator[None]:
+    """
+    Creates the tiers of the store when it has colder storage, the files
+    not read recently are demoted in the background by the process
+    migrating the tiers. Each process promotes the cold files it reads.
+    """
+    tiers = None
+    migration = None
+    if app['cold_storage_paths']:
+        tiers = StorageTiers((app['storage_path'],
+                              *app['cold_storage_paths']),
+                             app['tier_idle_time'], app['tier_promote_reads'],
+                             app['tier_max_usage'],
+                             index=app['storage_index'],
+                             cache=app['file_cache'],
+                             group_commit=app['group_commit'])
+        await tiers.open()
+        if app['migrate_tiers']:
+            migration = asyncio.ensure_future(migrate_tiers(app, tiers))
+
+    app['storage_tiers'] = tiers
+    yield
+
+    if migration is not None:
+        migration.cancel()
+        with suppress(asyncio.CancelledError):
+            await migration
+    if tiers is not None:
+        await tiers.close()
+
+
+async def migrate_tiers(app: Application, tiers: StorageTiers) -> None:
+    """
+    Demotes the files not read recently periodically.
+    """
+    while True:
+        await asyncio.sleep(app['tier_interval'])
+        try:
+            await tiers.demote()
+        except Exception:
+            logger.exception('Migration of the tiers has failed')
+
+
+async def setup_pack_store(app: Application) -> AsyncIterator[None]:
+    """
+    Opens the store of small files packed into pack files, the sparse
+    packs are compacted in the background by the process compacting them.
+    """
+    packs = None
+    compactor = None
+    if app['pack_max_file_size']:
+        packs = PackStore(app['storage_path'], app['pack_max_file_size'],
+                          app['pack_size'],
+                          # Files packed by other workers are not indexed
+                          authoritative=app['workers'] == 1)
+        await packs.open()
+        if app['compact_packs']:
+            compactor = asyncio.ensure_future(compact_packs(app, packs))
+
+    app['pack_store'] = packs
+    yield
+
+    if compactor is not None:
+        compactor.cancel()
+        with suppress(asyncio.CancelledError):
+            await compactor
+    if packs is not None:
+        await packs.close()
+
+
+async def compact_packs(app: Application, packs: PackStore) -> None:
+    """
+    Compacts the sparse packs periodically.
+    """
+    while True:
+        await asyncio.sleep(app['compact_interval'])
+        try:
+            await packs.compact(app['compact_ratio'])
+        except Exception:
+            logger.exception('Compaction of the packs has failed')
+
+
+async def setup_upload_sessions(app: Application) -> AsyncIterator[None]:
+    """
+    Opens the sessions uploading large files by several requests,
+    the abandoned ones are expired in the background by the process
+    expiring them.
+    """
+    sessions = UploadSessions(app['storage_path'], app['upload_ttl'],
+                              io_engine=app['io_engine'])
+    await sessions.open()
+
+    expiration = None
+    if app['expire_uploads']:
+        expiration = asyncio.ensure_future(expire_uploads(app, sessions))
+
+    app['upload_sessions'] = sessions
+    yield
+
+    if expiration is not None:
+        expiration.cancel()
+        with suppress(asyncio.CancelledError):
+            await expiration
+
+
+async def expire_uploads(app: Application, sessions: UploadSessions) \
+        -> None:
+    """
+    Removes the expired upload sessions periodically.
+    """
+    while True:
+        await asyncio.sleep(min(EXPIRE_INTERVAL, app['upload_ttl']))
+        try:
+            await sessions.expire()
+        except Exception:
+            logger.exception('Expiration of the upload sessions has failed')
+
+
+async def setup_scrubber(app: Application) -> AsyncIterator[None]:
+    """
+    Loads the log of the verified files, the store is scrubbed in
+    the background by the process scrubbing it. The verifications are
+    synced with other processes periodically.
+    """
+    log = VerificationLog(app['storage_path'], app['cold_storage_paths'])
+    await log.open()
+    app['verification_log'] = log
+
+    tasks = [asyncio.ensure_future(sync_verification_log(log))]
+    if app['scrub']:
+        scrubber = Scrubber(app['storage_path'], log, app['scrub_interval'],
+                            app['scrub_processes'], app['scrub_rate'],
+                            index=app['storage_index'],
+                            cache=app['file_cache'],
+                            packs=app['pack_store'],
+                            group_commit=app['group_commit'],
+                            cold_paths=app['cold_storage_paths'])
+        tasks.append(asyncio.ensure_future(scrub_store(app, scrubber)))
+    yield
+
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await log.close()
+
+
+async def sync_verification_log(log: VerificationLog) -> None:
+    """
+    Saves the verifications and loads the ones of other processes
+    periodically.
+    """
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        try:
+            await log.sync()
+        except Exception:
+            logger.exception('Sync of the verification log has failed')
+
+
+async def scrub_store(app: Application, scrubber: Scrubber) -> None:
+    """
+    Verifies the files of the store, the next pass starts the scrub
+    interval after the previous one.
+    """
+    while True:
+        try:
+            await scrubber.run()
+        except Exception:
+            logger.exception('Scrubbing of the store has failed')
+        await asyncio.sleep(app['scrub_interval'])
+
+
+async def setup_replication(app: Application) -> AsyncIterator[None]:
+    """
+    Opens the journal of the changes replicated to the peers, they are
+    sent in the background by the process replicating them. Nothing is
+    replicated without peers.
+    """
+    if not app['replication_peers']:
+        app['replication_journal'] = None
+        app['replicator'] = None
+        yield
+        return
+
+    journal = ReplicationJournal(app['storage_path'],
+                                 app['replication_peers'])
+    await journal.open()
+    # The changes made by the replicator are not replicated
+    replicator = Replicator(journal, app['file_manager_factory'],
+                            app['replication_concurrency'])
+    await replicator.open(send=app['replicate'])
+    app['replication_journal'] = journal
+    app['replicator'] = replicator
+    if app['replicate']:
+        app['metrics'].add_gauge(
+            'file_loader_replication_pending',
+            'Changes waiting to be replicated to the peer', ('peer',),
+            lambda: {(peer,): pending for peer, pending
+                     in replicator.pending.items()})
+    yield
+
+    await replicator.close()
+    await journal.close()
+    logger.info('Replication: %r', replicator.stats)
+
+
+def create_file_manager(app: Application, hash_algorithm: str,
+                        replication: Optional[ReplicationJournal] = None) \
+        -> FileManager:
+    """
+    Creates the file manager of the hash algorithm working with the store
+    components of the app, it's called by app['file_manager_factory'].
+    The changes are replicated by the journal, without it they are not
+    replicated.
+    """
+    compression = app['compression']
+    return FileManager(app['storage_path'],
+                       hash_algorithm=hash_algorithm,
+                       index=app['storage_index'],
+                       cache=app['file_cache'],
+                       compression=compression
+                       if compression != COMPRESSION_OFF else None,
+                       compression_level=app['compression_level'],
+                       layout=app['layout'],
+                       fallback_layouts=app['fallback_layouts'],
+                       group_commit=app['group_commit'],
+                       packs=app['pack_store'],
+                       io_engine=app['io_engine'],
+                       metrics=app['metrics'],
+                       verification_log=app['verification_log'],
+                       verify_max_age=app['scrub_interval']
+                       if app['verify_reads'] else None,
+                       tiers=app['storage_tiers'],
+                       replication=replication)
+
+
 def create_app() -> Application:
     """
     Creates an instance of the application. This one is ready to run.
     """
     app = Application(
-        middlewares=[error_middleware, ]
+        middlewares=[metrics_middleware, error_middleware,
+                     admission_middleware]
     )
 
     for handler in HANDLERS:
         logger.debug('Registering handler %r as %r', handler, handler.URL_PATH)
-        app.router.add_route('*', handler.URL_PATH, handler)
+        app.router.add_route(
+            '*', handler.URL_PATH, handler,
+            expect_handler=getattr(handler, 'expect_handler', None))
+
+    # Creates the file managers of the handlers and the replicator
+    app['file_manager_factory'] = partial(create_file_manager, app)
+    # Amount of requests of each operation served at once and waiting
+    # for their turn, the rest are shed. The operation is not limited when
+    # its concurrency is 0
+    app['upload_concurrency'] = 16
+    app['upload_queue_size'] = 256
+    app['download_concurrency'] = 256
+    app['download_queue_size'] = 1024
+    app['metadata_concurrency'] = 256
+    app['metadata_queue_size'] = 1024
+    app['admission_timeout'] = 10.0
+    app.cleanup_ctx.append(setup_admission)
+    # Downloads are passed to the kernel by sendfile unless disabled
+    app['sendfile'] = True
+    # Uploads without the algorithm in the URL are hashed by it
+    app['hash_algorithm'] = DEFAULT_ALGORITHM
+    # Threads reading and writing the files, the default executor does
+    # the I/O when it's 0. Files are read by buffers between the min and
+    # the max size chosen by the file size
+    app['read_threads'] = 32
+    app['write_threads'] = 8
+    app['min_buffer_size'] = MIN_BUFFER_SIZE
+    app['max_buffer_size'] = MAX_BUFFER_SIZE
+    app.cleanup_ctx.append(setup_io_engine)
+    # Metrics of the process are served by /metrics
+    app.cleanup_ctx.append(setup_metrics)
+    # Amount of processes serving the same store
+    app['workers'] = 1
+    app['index_mode'] = INDEX_MEMORY
+    app.cleanup_ctx.append(setup_storage_index)
+    # Memory cache of small files, disabled when the size is 0
+    app['cache_size'] = 0
+    app['cache_max_file_size'] = 64 * 1024
+    app.cleanup_ctx.append(setup_file_cache)
+    # Files are stored in nested shard directories named by the hash,
+    # the files of the store with another layout are migrated by
+    # the process migrating the layout
+    app['shard_depth'] = DEFAULT_LAYOUT.depth
+    app['shard_width'] = DEFAULT_LAYOUT.width
+    app['migrate_layout'] = True
+    app.cleanup_ctx.append(setup_store_layout)
+    # Saved files are synced to the disk before they are acknowledged,
+    # the syncs of the files saved at the same time are batched
+    app['durability'] = DURABILITY_GROUP
+    app['commit_delay'] = 0.0
+    app.cleanup_ctx.append(setup_group_commit)
+    # Directories of the colder tiers of the store, from the fastest to
+    # the slowest one. Files not read for the idle time, then the least
+    # recently read ones while the tier uses more than the part of its
+    # disk, are demoted to the next tier by the process migrating
+    # the tiers. The cold file read this many times within the idle time
+    # is promoted into the store
+    app['cold_storage_paths'] = ()
+    app['tier_idle_time'] = 7 * 24 * 3600.0
+    app['tier_promote_reads'] = 2
+    app['tier_max_usage'] = 0.9
+    app['tier_interval'] = 3600.0
+    app['migrate_tiers'] = True
+    app.cleanup_ctx.append(setup_storage_tiers)
+    # Files not larger than this are appended into pack files, disabled
+    # when it's 0. Packs with the larger part of deleted files are
+    # compacted by the process compacting them
+    app['pack_max_file_size'] = 0
+    app['pack_size'] = MAX_PACK_SIZE
+    app['compact_packs'] = True
+    app['compact_interval'] = 300.0
+    app['compact_ratio'] = 0.5
+    app.cleanup_ctx.append(setup_pack_store)
+    # Sessions of resumable uploads expire after this many seconds
+    # without uploads, they are removed by the process expiring them
+    app['upload_ttl'] = 24 * 3600.0
+    app['expire_uploads'] = True
+    app.cleanup_ctx.append(setup_upload_sessions)
+    # Files are verified to hash to their names once in the interval by
+    # the process scrubbing the store, the corrupt ones are quarantined.
+    # Scrubbing is enabled explicitly, each pass reads the whole store.
+    # The processes hash the files reading no more than the rate of bytes
+    # per second, not limited when it's 0. When the reads are verified,
+    # the file not verified within the interval is verified when it's
+    # sent whole
+    app['scrub'] = False
+    app['scrub_interval'] = 7 * 24 * 3600.0
+    app['scrub_processes'] = 1
+    app['scrub_rate'] = 32 * 1024 * 1024
+    app['verify_reads'] = False
+    app.cleanup_ctx.append(setup_scrubber)
+    # Compressible files are stored compressed unless it's off
+    app['compression'] = COMPRESSION_OFF
+    app['compression_level'] = 6
+    # URLs of the peers the saved and deleted files are replicated to by
+    # the process replicating them, this many files at once to each peer.
+    # The file missing in the store is fetched from the peers when it's
+    # read unless the read repair is disabled
+    app['replication_peers'] = ()
+    app['replication_concurrency'] = 4
+    app['replicate'] = True
+    app['read_repair'] = True
+    app.cleanup_ctx.append(setup_replication)
 
     PAYLOAD_REGISTRY.register(JsonPayload, (Mapping, MappingProxyType))
     return app
@@ -0,0 +1,156 @@
+import tarfile
+import time
+import zipfile
+from typing import List, NamedTuple, Optional, Sequence
+
+ARCHIVE_TAR = 'tar'
+ARCHIVE_ZIP = 'zip'
+ARCHIVE_FORMATS = (ARCHIVE_TAR, ARCHIVE_ZIP)
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# The archive ends with two empty blocks
+TAR_END = bytes(2 * TAR_BLOCK_SIZE)
+# Timestamps of zip entries can't be earlier
+ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+class ArchiveEntry(NamedTuple):
+    """The file of the archive
+    :param name: the name of the file in the archive
+    :param size: size of the file in bytes, None when it's unknown
+    :param mtime: timestamp of the last modification of the file
+    """
+    name: str
+    size: Optional[int]
+    mtime: float
+
+
+class TarWriter:
+    """Formats the files as the tar archive on the fly, the size of each
+    file has to be known before its content
+    """
+    content_type = 'application/x-tar'
+    needs_sizes = True
+
+    def __init__(self):
+        self._size = 0
+        self._written = 0
+
+    @staticmethod
+    def get_length(entries: Sequence[ArchiveEntry]) -> Optional[int]:
+        """Returns the size of the archive of the files, the headers of
+        the names longer than 100 bytes take extra blocks"""
+        return sum(len(_get_tar_header(entry)) + entry.size
+                   + _get_tar_padding(entry.size)
+                   for entry in entries) + len(TAR_END)
+
+    def begin(self, entry: ArchiveEntry) -> bytes:
+        """Returns the data preceding the content of the file"""
+        self._size = entry.size
+        self._written = 0
+        return _get_tar_header(entry)
+
+    def write(self, data: bytes) -> bytes:
+        """Returns the data of the archive holding the chunk of the file"""
+        self._written += len(data)
+        return data
+
+    def end(self) -> bytes:
+        """Returns the data following the content of the file
+        :raise ValueError: the file differs from its declared size
+        """
+        if self._written != self._size:
+            raise ValueError(f'{self._written} bytes were written instead '
+                             f'of {self._size}')
+        return bytes(_get_tar_padding(self._size))
+
+    def close(self) -> bytes:
+        """Returns the end of the archive"""
+        return TAR_END
+
+
+class ZipWriter:
+    """Formats the files as the zip archive on the fly. The files are
+    stored without compression, their sizes and checksums follow their
+    content, so the sizes are not needed in advance
+    """
+    content_type = 'application/zip'
+    needs_sizes = False
+
+    def __init__(self):
+        self._buffer = _ZipBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_STORED,
+                                    allowZip64=True)
+        self._file = None
+
+    @staticmethod
+    def get_length(entries: Sequence[ArchiveEntry]) -> Optional[int]:
+        """The size of the archive is known when it's written"""
+        return None
+
+    def begin(self, entry: ArchiveEntry) -> bytes:
+        """Returns the data preceding the content of the file"""
+        info = zipfile.ZipInfo(
+            entry.name,
+            max(time.gmtime(entry.mtime)[:6], ZIP_MIN_DATE))
+        info.external_attr = 0o644 << 16
+        if entry.size is not None:
+            info.file_size = entry.size
+        self._file = self._zip.open(info, 'w',
+                                    force_zip64=entry.size is None)
+        return self._buffer.take()
+
+    def write(self, data: bytes) -> bytes:
+        """Returns the data of the archive holding the chunk of the file"""
+        self._file.write(data)
+        return self._buffer.take()
+
+    def end(self) -> bytes:
+        """Returns the data following the content of the file"""
+        self._file.close()
+        self._file = None
+        return self._buffer.take()
+
+    def close(self) -> bytes:
+        """Returns the end of the archive, the central directory"""
+        self._zip.close()
+        return self._buffer.take()
+
+
+class _ZipBuffer:
+    """Not seekable output of the zip file, the written data is taken
+    away to be sent"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _get_tar_header(entry: ArchiveEntry) -> bytes:
+    info = tarfile.TarInfo(entry.name)
+    info.size = entry.size
+    info.mtime = int(entry.mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def _get_tar_padding(size: int) -> int:
+    return -size % TAR_BLOCK_SIZE
+
+
+def create_writer(archive_format: str):
+    """Returns the writer of the archive of the format"""
+    if archive_format == ARCHIVE_ZIP:
+        return ZipWriter()
+    return TarWriter()
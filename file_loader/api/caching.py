@@ -0,0 +1,56 @@
+from typing import List, Optional
+
+from aiohttp import hdrs
+from aiohttp.web_request import BaseRequest
+
+# The name of the file is the hash of its content, so the content stored
+# by a name never changes and can be cached forever
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+ETAG_ANY = '*'
+WEAK_PREFIX = 'W/'
+
+
+def make_etag(file_hash: str, encoding: Optional[str] = None) -> str:
+    """Returns the strong entity tag of the file, the file sent with
+    the content encoding is another representation and has its own tag
+    """
+    if encoding is not None:
+        return f'"{file_hash}-{encoding}"'
+    return f'"{file_hash}"'
+
+
+def parse_etags(header: str) -> List[str]:
+    """Parses the list of entity tags from If-Match/If-None-Match header,
+    weak tags are returned without the weakness indicator
+    """
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith(WEAK_PREFIX):
+            etag = etag[len(WEAK_PREFIX):]
+        if etag:
+            etags.append(etag)
+
+    return etags
+
+
+def is_not_modified(request: BaseRequest, etag: str,
+                    last_modified: float) -> bool:
+    """Checks the conditional headers (RFC 7232) of the request,
+    If-None-Match takes precedence over If-Modified-Since
+    :param request: the request for the file
+    :param etag: the entity tag of the file
+    :param last_modified: timestamp of the last modification of the file
+    :return: true then the client already has the file
+    """
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        return ETAG_ANY in etags or etag in etags
+
+    if_modified_since = request.if_modified_since
+    if if_modified_since is not None:
+        return int(last_modified) <= if_modified_since.timestamp()
+
+    return False
@@ -1,15 +1,36 @@
+import asyncio
 import logging
 import os
-from typing import Union
+from typing import Iterator, List, NamedTuple, Optional, Sequence, \
+    Tuple, Union
 from pathlib import Path
-from hashlib import md5
-from uuid import uuid4
 
-import aiofiles
-from aiohttp import BodyPartReader, MultipartReader
+from aiohttp import BodyPartReader, MultipartReader, StreamReader
+
+from file_loader.api.metrics import Metrics
+from file_loader.replication.journal import OP_DELETE, OP_SAVE, \
+    ReplicationJournal
+from file_loader.storage.cache import FileCache
+from file_loader.storage.commit import GroupCommit, StagedFile, \
+    link_file
+from file_loader.storage.compression import ENCODINGS, Encoding, \
+    StreamCoder, get_encoding, is_compressible
+from file_loader.storage.hashing import DEFAULT_ALGORITHM, Hasher, \
+    get_algorithm
+from file_loader.storage.index import FileRecord, StorageIndex
+from file_loader.storage.io_engine import IOEngine
+from file_loader.storage.layout import DEFAULT_LAYOUT, StoreLayout
+from file_loader.storage.packs import PackStore
+from file_loader.storage.scrubber import CorruptFileError, \
+    VerificationLog, quarantine_content, quarantine_file
+from file_loader.storage.tiers import StorageTiers, get_tier_path
 
 logger = logging.getLogger(__name__)
 
+# The amount of files looked for or removed by one executor call of
+# the batch operations
+LOOKUP_BATCH_SIZE = 256
+
 
 class EmptyFileError(Exception):
     """
@@ -18,79 +39,435 @@ class EmptyFileError(Exception):
     pass
 
 
+class HashMismatchError(Exception):
+    """
+    Exception raised when the hash of the received file differs from
+    the hash declared by the client.
+    """
+    pass
+
+
+class RawBodyReader:
+    """Reader of the raw request body with the interface of BodyPartReader
+    :param stream: the request stream
+    :param block_size: the minimum size of the chunk returned by the
+    reader, small pieces received from the socket are joined
+    """
+
+    def __init__(self, stream: StreamReader, block_size: int = 1024 * 1024):
+        self.stream = stream
+        self.block_size = block_size
+
+    async def read_chunk(self, size: int = 1024 * 1024) -> bytes:
+        """Reads the chunk of the body
+           :param size: the maximum size of the chunk, the block size is
+           used when it's greater
+           :return: bytes: the chunk, empty at the end of the body
+           """
+        size = max(size, self.block_size)
+        chunks = []
+        received = 0
+        while received < size:
+            data = await self.stream.read(size - received)
+            if not data:
+                break
+            chunks.append(data)
+            received += len(data)
+
+        return b''.join(chunks)
+
+
+class BufferedPartReader:
+    """Buffer of the part of multipart data with the interface of
+    BodyPartReader. The file is saved from the buffer while the next part
+    of the request is being read
+    :param max_chunks: the maximum amount of chunks in the buffer
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self.chunks = asyncio.Queue(maxsize=max_chunks)
+        self.aborted = False
+
+    async def feed(self, part: BodyPartReader, chunk_size: int) -> None:
+        """Reads the part into the buffer, waits while the buffer is full
+           :param part: the part of multipart data
+           :param chunk_size: the size of chunks read from the part
+           """
+        while not self.aborted:
+            chunk = await part.read_chunk(size=chunk_size)
+            await self.chunks.put(chunk)
+            if not chunk:
+                return
+
+        await part.release()
+
+    async def read_chunk(self, size: int = 64 * 1024) -> bytes:
+        """Returns the next chunk of the part, empty at the end of the part
+           :param size: not used, the chunks are read by feed()
+           """
+        return await self.chunks.get()
+
+    def abort(self) -> None:
+        """Stops buffering, the rest of the part is dropped"""
+        self.aborted = True
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
+
+
+class FileInfo(NamedTuple):
+    """Metadata of the stored file
+    :param size: size of the stored file in bytes
+    :param mtime: timestamp of the last modification of the file
+    :param encoding: the encoding of the file stored compressed
+    """
+    size: int
+    mtime: float
+    encoding: Optional[Encoding] = None
+
+
+class StoredFile(NamedTuple):
+    path: Path
+    record: FileRecord
+    encoding: Optional[Encoding]
+    # The key of the packed file
+    key: Optional[str] = None
+
+
 class FileManager:
     """Class for managing file handling
     :param path_store: directory for saving incoming files
     :param chunk_size: the size of slice of file for reading-writing by part
+    :param hash_algorithm: the name of the algorithm hashing the files.
+    md5 files are stored in the root of the store, files of other
+    algorithms in the subdirectory named as the algorithm
+    :param index: the index of the store serving existence checks and
+    metadata, the disk is checked if None
+    :param cache: the memory cache of small files, files are always read
+    from the disk if None
+    :param compression: the name of the encoding compressible files are
+    stored with, files are stored as is if None. The compressed file is
+    named by the hash of the original content with the encoding suffix
+    :param compression_level: the level of compression
+    :param layout: the layout of the shard directories new files are
+    saved in
+    :param fallback_layouts: the layouts the store is being migrated
+    from, files not found in the layout are looked for in them
+    :param group_commit: syncs the saved files to the disk, files are
+    not synced if None
+    :param packs: the store of small files appended into pack files,
+    files not larger than its max file size are packed. Every file is
+    stored in its own file if None
+    :param io_engine: does the disk I/O of the files, the default executor
+    of the loop if None
+    :param metrics: records the hashing and the dedup hits of the saved
+    files, nothing is recorded if None
+    :param verification_log: records when the stored files were last
+    verified to hash to their names
+    :param verify_max_age: the file not verified within this many seconds
+    is verified when it's read whole, files are never verified on read
+    if None
+    :param tiers: the tiers of the store, files are looked for in
+    the colder tiers after the store and their reads are counted to
+    promote them. Only the store is used if None
+    :param replication: the journal the saved and deleted files are
+    queued in to be replicated to the peers, nothing is replicated if None
     """
 
-    def __init__(self, path_store: Path, chunk_size: int = 64 * 1024):
+    def __init__(self, path_store: Path, chunk_size: int = 64 * 1024,
+                 hash_algorithm: str = DEFAULT_ALGORITHM,
+                 index: Optional[StorageIndex] = None,
+                 cache: Optional[FileCache] = None,
+                 compression: Optional[str] = None,
+                 compression_level: int = 6,
+                 layout: StoreLayout = DEFAULT_LAYOUT,
+                 fallback_layouts: Sequence[StoreLayout] = (),
+                 group_commit: Optional[GroupCommit] = None,
+                 packs: Optional[PackStore] = None,
+                 io_engine: Optional[IOEngine] = None,
+                 metrics: Optional[Metrics] = None,
+                 verification_log: Optional[VerificationLog] = None,
+                 verify_max_age: Optional[float] = None,
+                 tiers: Optional[StorageTiers] = None,
+                 replication: Optional[ReplicationJournal] = None):
         self.path_store = path_store
         self.chunk_size = chunk_size
+        self.hash_algorithm = get_algorithm(hash_algorithm)
+        self.index = index
+        self.cache = cache
+        self.compression = get_encoding(compression) \
+            if compression else None
+        self.compression_level = compression_level
+        self.layout = layout
+        self.fallback_layouts = fallback_layouts
+        self.group_commit = group_commit
+        self.packs = packs
+        self.io_engine = io_engine or IOEngine()
+        self.metrics = metrics
+        self.verification_log = verification_log
+        self.verify_max_age = verify_max_age
+        self.tiers = tiers
+        self.tier_paths = tiers.paths if tiers is not None \
+            else (path_store,)
+        self.replication = replication
 
     async def save_file(self,
-                        file_stream: Union[BodyPartReader, MultipartReader]) \
-            -> str:
+                        file_stream: Union[BodyPartReader, MultipartReader,
+                                           RawBodyReader, BufferedPartReader],
+                        expected_hash: Optional[str] = None,
+                        size: Optional[int] = None) -> str:
         """Saves the file coming in reader
            :param file_stream: the request stream
-           :return: str: md5 hash of the received file
+           :param expected_hash: hash the received file should have
+           :param size: the size of the file if it's known, the space for
+           the file is preallocated
+           :return: str: hash of the received file
            :raise EmptyFileError: the stream contained an empty (0 byte) file
+           :raise HashMismatchError: the hash of the received file differs
+           from the expected one
            """
-        file_tmp_name = f'id{uuid4()}'
+        if self.compression is not None:
+            # The size of the stored file is unknown
+            size = None
+
+        # The small file is held in memory until it's known to be packed.
+        # The file aborted before the commit leaves nothing in the store
+        spool_size = self.packs.max_file_size \
+            if self.packs is not None else 0
+        async with StagedFile(self.path_store, size, spool_size,
+                              self.io_engine.write_executor) as file_tmp:
+            file_hash, encoding = await self._receive_file(file_stream,
+                                                           file_tmp)
+            if expected_hash is not None and expected_hash != file_hash:
+                raise HashMismatchError(
+                    f'Expected hash {expected_hash}, received {file_hash}')
 
-        async with aiofiles.open(self.path_store / file_tmp_name,
-                                 'wb') as file_tmp:
-            file_hash = md5()
-            file_size = 0
+            # The file may be stored with another encoding
+            if await self._lookup(file_hash) is not None:
+                logger.info("File with hash %s has already existed",
+                            file_hash)
+                self._record_dedup()
+                return file_hash
 
-            while True:
-                chunk = await file_stream.read_chunk(size=self.chunk_size)
-                if not chunk:
-                    break
+            if file_tmp.spooled and self.packs is not None:
+                await self.packs.put(
+                    self._get_pack_key(file_hash, encoding),
+                    file_tmp.getvalue(), self.group_commit)
+                logger.info('File with hash %s was packed', file_hash)
+            elif not await self._commit_file(
+                    file_tmp, self._get_file_path(file_hash, encoding)):
+                return file_hash
+
+        await self._replicate(OP_SAVE, [file_hash])
+        return file_hash
+
+    async def _receive_file(self,
+                            file_stream: Union[BodyPartReader,
+                                               MultipartReader,
+                                               RawBodyReader,
+                                               BufferedPartReader],
+                            file_tmp: StagedFile) \
+            -> Tuple[str, Optional[Encoding]]:
+        """Writes the file coming in reader into the staged file, hashes
+        it at the same time. The file is compressed when its beginning is
+        compressible
+           :return: tuple: hash of the received file and the encoding it's
+           written with
+           :raise EmptyFileError: the stream contained an empty (0 byte) file
+           """
+        hasher = Hasher(self.hash_algorithm)
+        compressor = None
+        file_size = 0
 
-                file_size += await file_tmp.write(chunk)
-                file_hash.update(chunk)
+        while True:
+            chunk = await file_stream.read_chunk(size=self.chunk_size)
+            if not chunk:
+                break
+
+            data = chunk
+            if file_size == 0 and self.compression is not None \
+                    and is_compressible(self.compression,
+                                        self.compression_level, chunk):
+                compressor = StreamCoder.compressor(
+                    self.compression, self.compression_level)
+            if compressor is not None:
+                data = await compressor.process(chunk)
+
+            # The chunk is written and hashed at the same time
+            await asyncio.gather(file_tmp.write(data),
+                                 hasher.update(chunk))
+            file_size += len(chunk)
+
+        if compressor is not None:
+            await file_tmp.write(compressor.flush())
+
+        file_hash = await hasher.hexdigest()
+        if self.metrics is not None:
+            self.metrics.record_hashing(hasher.hashed, hasher.hash_time)
 
         if file_size == 0:
-            os.remove(self.path_store / file_tmp_name)
             raise EmptyFileError
 
-        new_dir_path = self.path_store / file_hash.hexdigest()[:2]
-        if not os.path.isdir(new_dir_path):
-            os.mkdir(new_dir_path)
+        encoding = self.compression if compressor is not None else None
+        return file_hash, encoding
 
-        # on Unix system silently replace existing file
+    async def _commit_file(self, file_tmp: StagedFile,
+                           file_path: Path) -> bool:
+        """Links the staged file into the store by the path
+           :return: bool: false when the file has been saved by another
+           process meanwhile
+           """
+        if not await file_tmp.commit(file_path, self.group_commit):
+            logger.info("File %s has already existed", file_path)
+            # The file saved by another process
+            await self._lookup_path(file_path, check_disk=True)
+            self._record_dedup()
+            return False
+
+        if self.index is not None:
+            self.index.add(file_path, file_tmp.written)
+
+        logger.info('File was save by path %s', file_path)
+        return True
+
+    async def store_file(self, source_path: Path, file_hash: str) -> bool:
+        """Links the complete file received by several requests into
+        the store as is, the file is not read again
+           :param source_path: path of the received file, it's in the same
+           file system as the store
+           :param file_hash: hash of the received file
+           :return: bool: false when the file has already been stored
+           """
+        if await self._lookup(file_hash) is not None:
+            logger.info("File with hash %s has already existed", file_hash)
+            self._record_dedup()
+            return False
+
+        file_path = self._get_file_path(file_hash)
         try:
-            os.rename(self.path_store / file_tmp_name,
-                      new_dir_path / file_hash.hexdigest())
+            created = await self.io_engine.run_write(link_file, source_path,
+                                                     file_path)
         except FileExistsError:
-            logger.info("File with hash %s has already existed",
-                        file_hash.hexdigest())
-            return file_hash.hexdigest()
+            logger.info("File with hash %s has already existed", file_hash)
+            # The file saved by another process
+            await self._lookup_path(file_path, check_disk=True)
+            self._record_dedup()
+            return False
 
-        logger.info('File was save by path %s',
-                    new_dir_path / file_hash.hexdigest())
-        return file_hash.hexdigest()
+        if self.group_commit is not None:
+            await self.group_commit.sync_dirs({
+                file_path.parent, *(path.parent for path in created)})
+        if self.index is not None:
+            stat = await self.io_engine.run_read(file_path.stat)
+            self.index.add(file_path, stat.st_size, stat.st_mtime)
 
-    async def get_file_reader(self, file_hash: str) -> ():
-        """Saves the file coming in reader
+        logger.info('File was save by path %s', file_path)
+        await self._replicate(OP_SAVE, [file_hash])
+        return True
+
+    async def get_file_path(self, file_hash: str) -> Path:
+        """Finds the stored file by hash of file
+            :param file_hash: hash of the file to find
+            :return: Path: path of the stored file, the file is compressed
+            when its info has the encoding
+            :raise FileNotFoundError: file not found by file hash
+            """
+        stored = await self._lookup(file_hash)
+        if stored is None:
+            raise FileNotFoundError
+
+        self._record_read(stored)
+        return stored.path
+
+    async def is_file_exist(self, file_hash: str) -> bool:
+        """Checks that the file is stored
+            :param file_hash: hash of the file
+            :return: bool: true then the file is stored
+            """
+        return await self._lookup(file_hash) is not None
+
+    async def get_file_info(self, file_hash: str) -> FileInfo:
+        """Returns the metadata of the stored file (size, modification time,
+        encoding)
+            :param file_hash: hash of the file
+            :return: FileInfo: metadata of the file
+            :raise FileNotFoundError: file not found by file hash
+            """
+        stored = await self._lookup(file_hash)
+        if stored is None:
+            raise FileNotFoundError
+
+        return FileInfo(stored.record.size, stored.record.mtime,
+                        stored.encoding)
+
+    async def get_decoded_size(self, file_hash: str) -> int:
+        """Returns the size of the file stored compressed after it's
+        decompressed, the file is decompressed to count it
+            :param file_hash: hash of the file
+            :raise FileNotFoundError: file not found by file hash
+            """
+        read_file = await self.get_file_reader(file_hash, decode=True)
+        size = 0
+        async for chunk in read_file():
+            size += len(chunk)
+        return size
+
+    async def get_cached_content(self, file_hash: str) -> Optional[bytes]:
+        """Returns the content of the small file from the memory cache,
+        the file is read into the cache on a miss. The packed file is
+        read from its pack.
+            :param file_hash: hash of the file to read
+            :return: bytes: content of the stored file, None when the file
+            is too large for the cache or the cache is disabled
+            :raise FileNotFoundError: file not found by file hash
+            """
+        if self.cache is None and self.packs is None:
+            return None
+
+        stored = await self._lookup(file_hash)
+        if stored is None:
+            raise FileNotFoundError
+        return await self._get_cached_content(file_hash, stored)
+
+    async def get_file_reader(self, file_hash: str,
+                              decode: bool = False,
+                              verify: bool = False) -> ():
+        """Returns the reader of the stored file
             :param file_hash: hash of the file to read
+            :param decode: the file stored compressed is decompressed,
+            the offset and the length are not supported then
+            :param verify: the content of the file read whole is hashed
+            while it's read, the reader raises CorruptFileError after
+            the last chunk when it differs. The file stored compressed is
+            verified only when it's decompressed
             :return: AsyncGenerator: reads the file hash of the file,
-            chunk by chunk
+            chunk by chunk, starting from the offset and no more than
+            length bytes if they are passed. The chunks are not reused,
+            they may be kept while the next ones are read
             :raise FileNotFoundError: file not found by file hash
             """
-        file_path = self.path_store / file_hash[:2] / file_hash
-        if not file_path.exists():
+        stored = await self._lookup(file_hash)
+        if stored is None:
             raise FileNotFoundError
 
-        async def read_file():
-            async with aiofiles.open(file_path, 'rb') as file:
-                while True:
-                    data = await file.read(self.chunk_size)
-                    if not data:
-                        break
+        read_stored = await self._get_stored_reader(file_hash, stored)
+        read_file = read_stored
+        if decode and stored.encoding is not None:
+            async def read_decoded():
+                decompressor = StreamCoder.decompressor(stored.encoding)
+                async for chunk in read_stored():
+                    data = await decompressor.process(chunk)
+                    if data:
+                        yield data
+
+                data = decompressor.flush()
+                if data:
                     yield data
 
+            read_file = read_decoded
+
+        if verify and (decode or stored.encoding is None):
+            # The hash is of the decoded content
+            return self._verify_reader(file_hash, stored, read_file)
         return read_file
 
     async def delete_file(self, file_hash: str) -> None:
@@ -100,10 +477,459 @@ class FileManager:
             :raise FileNotFoundError: file not found by file hash
             """
 
-        file_path = self.path_store / file_hash[:2] / file_hash
-        if not file_path.exists():
+        stored = await self._lookup(file_hash)
+        if stored is None:
             logger.warning('File with hash %s not found', file_hash)
             raise FileNotFoundError
 
-        os.remove(file_path)
+        if stored.key is not None:
+            await self.packs.delete(stored.key, self.group_commit)
+            self._forget_verification(stored)
+            logger.info('Delete packed file %s', stored.key)
+            await self._replicate(OP_DELETE, [file_hash])
+            return
+
+        file_path = stored.path
+        try:
+            os.remove(file_path)
+        finally:
+            for path in (file_path, *self._get_copies(file_path)):
+                if self.index is not None:
+                    self.index.remove(path)
+                if self.cache is not None:
+                    self.cache.invalidate(path)
+            self._forget_verification(stored)
+        if self.tiers is not None:
+            # The file being moved between the tiers is in both of them
+            await self.io_engine.run_write(self._remove_files,
+                                           self._get_copies(file_path))
         logger.info('Delete file with path %s', file_path)
+        await self._replicate(OP_DELETE, [file_hash])
+
+    async def get_files_info(self, file_hashes: Sequence[str]) \
+            -> List[Optional[FileInfo]]:
+        """Returns the metadata of many stored files, the files missing
+        in the index are looked for on the disk by batches in the executor
+            :param file_hashes: hashes of the files
+            :return: list: metadata of each file, None when the file is
+            not stored
+            """
+        return [
+            None if stored is None else FileInfo(
+                stored.record.size, stored.record.mtime, stored.encoding)
+            for stored in await self._lookup_many(file_hashes)
+        ]
+
+    async def delete_files(self, file_hashes: Sequence[str]) -> List[bool]:
+        """Deletes many files, the files are removed by batches in
+        the executor
+            :param file_hashes: hashes of the files
+            :return: list: false for each file which is not stored
+            """
+        found = await self._lookup_many(file_hashes)
+
+        # Tombstones of the packed files are synced by group commits
+        await asyncio.gather(*(
+            self.packs.delete(key, self.group_commit)
+            for key in {stored.key for stored in found
+                        if stored is not None and stored.key is not None}
+        ))
+
+        paths = list({stored.path for stored in found
+                      if stored is not None and stored.key is None})
+        # The files being moved between the tiers are in both of them
+        paths.extend(copy for file_path in paths
+                     for copy in self._get_copies(file_path))
+        removed = set()
+        for batch in await asyncio.gather(*(
+                self.io_engine.run_write(
+                    self._remove_files,
+                    paths[start:start + LOOKUP_BATCH_SIZE])
+                for start in range(0, len(paths), LOOKUP_BATCH_SIZE))):
+            removed.update(batch)
+
+        for file_path in paths:
+            if self.index is not None:
+                self.index.remove(file_path)
+            if self.cache is not None:
+                self.cache.invalidate(file_path)
+
+        deleted = [
+            stored is not None and (stored.key is not None
+                                    or stored.path in removed)
+            for stored in found
+        ]
+        for stored, is_deleted in zip(found, deleted):
+            if is_deleted:
+                self._forget_verification(stored)
+        logger.info('Delete %d of %d files', sum(deleted), len(file_hashes))
+        await self._replicate(OP_DELETE, [
+            file_hash for file_hash, is_deleted in zip(file_hashes, deleted)
+            if is_deleted])
+        return deleted
+
+    async def needs_verification(self, file_hash: str) -> bool:
+        """Checks that the file should be verified when it's read whole,
+        it has not been verified recently
+            :param file_hash: hash of the file
+            :return: bool: true when the reader should verify the file
+            """
+        stored = await self._lookup(file_hash)
+        return stored is not None and self._needs_verification(stored)
+
+    def _needs_verification(self, stored: StoredFile) -> bool:
+        if self.verification_log is None or self.verify_max_age is None:
+            return False
+        return not self.verification_log.is_verified(
+            self.verification_log.get_key(stored.path, stored.key),
+            self.verify_max_age)
+
+    def _verify_reader(self, file_hash: str, stored: StoredFile, read):
+        """Wraps the reader of the file to hash the file read whole"""
+        async def read_verified(offset: int = 0,
+                                length: Optional[int] = None):
+            if offset or length is not None:
+                async for chunk in read(offset, length):
+                    yield chunk
+                return
+
+            hasher = Hasher(self.hash_algorithm, batch_size=0)
+            async for chunk in read():
+                await hasher.update(chunk)
+                yield chunk
+            await self._check_hash(file_hash, stored,
+                                   await hasher.hexdigest())
+
+        return read_verified
+
+    async def _verify_content(self, file_hash: str, stored: StoredFile,
+                              content: bytes) -> None:
+        """Verifies the content of the file read into memory when it
+        has not been verified recently"""
+        if not self._needs_verification(stored):
+            return
+
+        hasher = Hasher(self.hash_algorithm)
+        if stored.encoding is not None:
+            decompressor = StreamCoder.decompressor(stored.encoding)
+            await hasher.update(await decompressor.process(content))
+            await hasher.update(decompressor.flush())
+        else:
+            await hasher.update(content)
+        await self._check_hash(file_hash, stored, await hasher.hexdigest())
+
+    async def _check_hash(self, file_hash: str, stored: StoredFile,
+                          content_hash: str) -> None:
+        """Records the verification of the file, the corrupt file is
+        quarantined
+        :raise CorruptFileError: the content differs from the hash
+        """
+        key = self.verification_log.get_key(stored.path, stored.key)
+        if content_hash == file_hash:
+            self.verification_log.record(key)
+            return
+
+        if stored.key is not None:
+            content = await self.packs.read(stored.key)
+            target = await self.io_engine.run_write(
+                quarantine_content, self.path_store, stored.key, content)
+            await self.packs.delete(stored.key, self.group_commit)
+        else:
+            target = await self.io_engine.run_write(
+                quarantine_file, get_tier_path(self.tier_paths, stored.path),
+                stored.path)
+            if self.index is not None:
+                self.index.remove(stored.path)
+            if self.cache is not None:
+                self.cache.invalidate(stored.path)
+        self.verification_log.forget(key)
+        logger.error('File with hash %s hashes to %s, it was quarantined '
+                     'to %s', file_hash, content_hash, target)
+        raise CorruptFileError(f'File with hash {file_hash} is corrupt')
+
+    def _forget_verification(self, stored: StoredFile) -> None:
+        """Forgets the verification of the deleted file"""
+        if self.verification_log is not None:
+            self.verification_log.forget(
+                self.verification_log.get_key(stored.path, stored.key))
+
+    def _record_read(self, stored: StoredFile) -> None:
+        """Marks the file as read now, the cold file read often enough
+        is promoted"""
+        if self.index is not None:
+            self.index.touch(stored.path)
+        if self.tiers is not None:
+            self.tiers.record_read(stored.path)
+
+    def _get_copies(self, file_path: Path) -> List[Path]:
+        """Returns the paths of the file in the other tiers"""
+        if self.tiers is None:
+            return []
+        return self.tiers.get_copies(file_path)
+
+    async def _replicate(self, op: str, file_hashes: List[str]) -> None:
+        """Queues the operation on the files to be replicated. The files
+        stay saved if it fails, the peers repair them when they are read"""
+        if self.replication is None or not file_hashes:
+            return
+        try:
+            await self.replication.add(op, self.hash_algorithm.name,
+                                       file_hashes)
+        except Exception:
+            logger.exception('Replication of %d files is not queued',
+                             len(file_hashes))
+
+    def _record_dedup(self) -> None:
+        """Counts the received file which had already been stored"""
+        if self.metrics is not None:
+            self.metrics.dedup_hits.inc(labels=('content',))
+
+    async def _get_cached_content(self, file_hash: str,
+                                  stored: StoredFile) -> Optional[bytes]:
+        """Returns the content of the file found the way
+        get_cached_content() does"""
+        if stored.key is not None:
+            content = await self.packs.read(stored.key)
+            await self._verify_content(file_hash, stored, content)
+            return content
+        if self.cache is None \
+                or stored.record.size > self.cache.max_file_size:
+            return None
+
+        self._record_read(stored)
+
+        content = self.cache.get(stored.path)
+        if content is None:
+            content = await self.io_engine.read_bytes(stored.path)
+            await self._verify_content(file_hash, stored, content)
+            self.cache.put(stored.path, content)
+
+        return content
+
+    async def _get_stored_reader(self, file_hash: str, stored: StoredFile):
+        """Returns the reader of the stored file, from the memory cache if
+        the file is cached"""
+        content = await self._get_cached_content(file_hash, stored)
+        if content is not None:
+            async def read_content(offset: int = 0,
+                                   length: Optional[int] = None):
+                view = memoryview(content)
+                end = len(view) if length is None else offset + length
+                for start in range(offset, end, self.chunk_size):
+                    yield view[start:min(start + self.chunk_size, end)]
+
+            return read_content
+
+        self._record_read(stored)
+        file_path = stored.path
+
+        def read_file(offset: int = 0, length: Optional[int] = None):
+            return self.io_engine.read_file(file_path, offset, length)
+
+        return read_file
+
+    async def _lookup(self, file_hash: str) -> Optional[StoredFile]:
+        """Finds the stored file as is or compressed with any encoding,
+        in the packs, in the layout of the store or in the layouts it's
+        migrated from
+        """
+        stored = self._lookup_packed(file_hash) \
+            or self._lookup_indexed(file_hash)
+        if stored is not None:
+            return stored
+
+        if self.index is None or not self.index.authoritative:
+            # All the paths are checked by one call in the executor
+            found = await self.io_engine.run_read(self._stat_files,
+                                                  [file_hash])
+            if found:
+                (_, stored), = found
+                return self._index_found(file_hash, stored)
+
+        if self.packs is not None and not self.packs.authoritative:
+            # The file may be packed by another process
+            await self.packs.refresh()
+            return self._lookup_packed(file_hash)
+        return None
+
+    async def _lookup_many(self, file_hashes: Sequence[str]) \
+            -> List[Optional[StoredFile]]:
+        """Finds many stored files the way _lookup() does, the files which
+        are not indexed are looked for on the disk by batches in
+        the executor at the same time
+        """
+        if self.packs is not None and not self.packs.authoritative:
+            # The files may be packed by other processes
+            await self.packs.refresh()
+
+        found = {}
+        unindexed = []
+        for file_hash in file_hashes:
+            stored = self._lookup_packed(file_hash) \
+                or self._lookup_indexed(file_hash)
+            if stored is not None:
+                found[file_hash] = stored
+            elif self.index is None or not self.index.authoritative:
+                unindexed.append(file_hash)
+
+        batches = [unindexed[start:start + LOOKUP_BATCH_SIZE]
+                   for start in range(0, len(unindexed), LOOKUP_BATCH_SIZE)]
+        for batch in await asyncio.gather(*(
+                self.io_engine.run_read(self._stat_files, batch)
+                for batch in batches)):
+            for file_hash, stored in batch:
+                if self.index is not None:
+                    self.index.add(stored.path, stored.record.size,
+                                   stored.record.mtime)
+                found[file_hash] = stored
+
+        return [found.get(file_hash) for file_hash in file_hashes]
+
+    def _index_found(self, file_hash: str,
+                     stored: StoredFile) -> StoredFile:
+        """Indexes the file found on the disk, the paths checked before
+        it are dropped from the index as the file has been moved from
+        them to another tier"""
+        if self.index is None:
+            return stored
+
+        for file_path, _ in self._iter_paths(file_hash):
+            if file_path == stored.path:
+                break
+            self.index.remove(file_path)
+
+        record = self.index.get(stored.path)
+        if record is None:
+            record = self.index.add(stored.path, stored.record.size,
+                                    stored.record.mtime)
+        return StoredFile(stored.path, record, stored.encoding)
+
+    def _lookup_indexed(self, file_hash: str) -> Optional[StoredFile]:
+        """Finds the file in the index"""
+        if self.index is None or self._may_be_moved():
+            return None
+
+        for file_path, encoding in self._iter_paths(file_hash):
+            record = self.index.get(file_path)
+            if record is not None:
+                return StoredFile(file_path, record, encoding)
+
+        return None
+
+    def _stat_files(self, file_hashes: Sequence[str]) \
+            -> List[Tuple[str, StoredFile]]:
+        """Finds the files on the disk. Runs in the executor.
+        :return: list: hashes and the stored files which are found
+        """
+        found = []
+        for file_hash in file_hashes:
+            for file_path, encoding in self._iter_paths(file_hash):
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((file_hash, StoredFile(
+                    file_path, FileRecord(stat.st_size, stat.st_mtime),
+                    encoding)))
+                break
+
+        return found
+
+    @staticmethod
+    def _remove_files(paths: Sequence[Path]) -> List[Path]:
+        """Removes the files. Runs in the executor.
+        :return: list: the removed files
+        """
+        removed = []
+        for file_path in paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                continue
+            removed.append(file_path)
+
+        return removed
+
+    def _iter_paths(self, file_hash: str) \
+            -> Iterator[Tuple[Path, Optional[Encoding]]]:
+        """Iterates over the paths the file may be stored by, as is or
+        compressed, in the layout of the store and the layouts it's
+        migrated from, in the tiers from the fastest one
+        """
+        for tier_path in self.tier_paths:
+            for layout in (self.layout, *self.fallback_layouts):
+                for encoding in (None, *ENCODINGS.values()):
+                    yield self._get_file_path(file_hash, encoding, layout,
+                                              tier_path), encoding
+
+    def _lookup_packed(self, file_hash: str) -> Optional[StoredFile]:
+        """Finds the file in the packs"""
+        if self.packs is None:
+            return None
+
+        for encoding in (None, *ENCODINGS.values()):
+            key = self._get_pack_key(file_hash, encoding)
+            entry = self.packs.get(key)
+            if entry is not None:
+                return StoredFile(self.packs.get_pack_path(entry.pack),
+                                  FileRecord(entry.length, entry.mtime),
+                                  encoding, key)
+
+        return None
+
+    async def _lookup_path(self, file_path: Path,
+                           check_disk: bool = False) -> Optional[FileRecord]:
+        """Returns the metadata of the file from the index, the disk is
+        checked when the file is not indexed and the index may be stale
+        or the check is forced. The indexed file is checked as well when
+        other processes move the files between the tiers
+        """
+        record = None
+        if self.index is not None:
+            record = self.index.get(file_path)
+            if record is not None and not self._may_be_moved():
+                return record
+            if record is None and self.index.authoritative \
+                    and not check_disk:
+                return None
+
+        try:
+            stat = await self.io_engine.run_read(file_path.stat)
+        except FileNotFoundError:
+            if record is not None:
+                # The file has been moved to another tier
+                self.index.remove(file_path)
+            return None
+
+        if record is not None:
+            return record
+        if self.index is not None:
+            return self.index.add(file_path, stat.st_size, stat.st_mtime)
+        return FileRecord(stat.st_size, stat.st_mtime)
+
+    def _get_pack_key(self, file_hash: str,
+                      encoding: Optional[Encoding] = None) -> str:
+        """Returns the key of the file in the packs"""
+        suffix = '' if encoding is None else encoding.suffix
+        return self.packs.make_key(self.hash_algorithm.name,
+                                   file_hash + suffix)
+
+    def _may_be_moved(self) -> bool:
+        """The files are moved between the tiers by other processes, so
+        the index may have the file in the tier it has left"""
+        return self.tiers is not None and not self.index.authoritative
+
+    def _get_file_path(self, file_hash: str,
+                       encoding: Optional[Encoding] = None,
+                       layout: Optional[StoreLayout] = None,
+                       tier_path: Optional[Path] = None) -> Path:
+        """Returns the path of the file in the store layout, in the store
+        unless the tier is passed. md5 files are stored in the root of
+        the tier, files of other algorithms in the subdirectory named as
+        the algorithm"""
+        layout = layout or self.layout
+        path_files = tier_path or self.path_store
+        if self.hash_algorithm.name != DEFAULT_ALGORITHM:
+            path_files = path_files / self.hash_algorithm.name
+        suffix = '' if encoding is None else encoding.suffix
+        return layout.get_path(path_files, file_hash, suffix)
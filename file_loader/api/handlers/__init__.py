@@ -1,5 +1,15 @@
+from .archive import ArchiveView
+from .batch import BatchView
 from .files import FilesView
+from .metrics import MetricsView
+from .status import StatusView
+from .uploads import UploadsView
 
 HANDLERS = (
     FilesView,
+    BatchView,
+    ArchiveView,
+    StatusView,
+    MetricsView,
+    UploadsView,
 )
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from contextlib import suppress
+from typing import List, Tuple
+
+from aiohttp import hdrs
+from aiohttp.web_exceptions import HTTPNotFound
+from aiohttp.web_response import StreamResponse
+
+from file_loader.api.admission import OPERATION_DOWNLOAD
+from file_loader.api.archive import ARCHIVE_FORMATS, ArchiveEntry, \
+    create_writer
+from file_loader.api.file_manager import FileManager
+from file_loader.api.handlers.batch import BatchView
+from file_loader.storage.hashing import HashAlgorithm
+from file_loader.storage.scrubber import CorruptFileError
+from file_loader.utils.exception import ValidationError
+
+logger = logging.getLogger(__name__)
+
+# The amount of chunks read ahead while the archive is sent, the next
+# file is read while the current one is being sent
+READ_AHEAD_CHUNKS = 16
+
+
+class ArchiveView(BatchView):
+    """Handler for downloading many files as one archive
+
+    :attribute URL_PATH: handler URL, the format of the archive
+    """
+    URL_PATH = r'/files/archive.{format:%s}' % '|'.join(ARCHIVE_FORMATS)
+    OPERATIONS = {hdrs.METH_POST: OPERATION_DOWNLOAD}
+
+    async def post(self) -> StreamResponse:
+        """Streams the files as the tar or zip archive, the archive is
+        made on the fly
+
+        Request
+        ------
+        <format> str: tar or zip
+        JSON body:
+        <hashes> list: hashes of the files, no more than 10000
+        <hash_algorithm> str: optional, the name of the hash function,
+        md5 by default
+        ------
+        Response
+        ------
+        the archive of the files named by their hashes, the files stored
+        compressed are decompressed. 404 status when any file is not stored
+        """
+        algorithm, file_hashes = await self._get_file_hashes()
+        file_manager = self._create_file_manager(algorithm)
+        writer = create_writer(self.request.match_info['format'])
+        entries = await self._get_entries(file_manager, file_hashes,
+                                          writer.needs_sizes)
+
+        response = StreamResponse()
+        response.content_type = writer.content_type
+        response.headers['Content-disposition'] = \
+            f'attachment; filename=files.{self.request.match_info["format"]}'
+        length = writer.get_length(entries)
+        if length is not None:
+            response.content_length = length
+        else:
+            response.enable_chunked_encoding()
+        await response.prepare(self.request)
+
+        await self._write_archive(response, writer, file_manager, entries)
+        await response.write_eof()
+        logger.info('Archive of %d files was sent', len(entries))
+        return response
+
+    async def _get_file_hashes(self) -> Tuple[HashAlgorithm, List[str]]:
+        """Returns the hashes of the files of the archive, the duplicates
+        are sent once
+        :raise ValidationError: the body is malformed
+        """
+        algorithm, file_hashes = await self._get_batch()
+        file_hashes = list(dict.fromkeys(file_hashes))
+        if not file_hashes:
+            raise ValidationError(message='hashes are empty')
+        for file_hash in file_hashes:
+            if not self._is_hash_valid(algorithm, file_hash):
+                raise ValidationError(
+                    message=f'Hash should be {algorithm.name} hex digest')
+
+        return algorithm, file_hashes
+
+    async def _get_entries(self, file_manager: FileManager,
+                           file_hashes: List[str],
+                           needs_sizes: bool) -> List[ArchiveEntry]:
+        """Returns the entries of the files, the sizes of the files stored
+        compressed are unknown unless the format needs them
+        :raise HTTPNotFound: any file is not stored
+        """
+        infos = await file_manager.get_files_info(file_hashes)
+        missing = [file_hash for file_hash, info in zip(file_hashes, infos)
+                   if info is None]
+        if missing:
+            raise HTTPNotFound(
+                text=f'Files are not found: {", ".join(missing[:10])}')
+
+        entries = [
+            ArchiveEntry(file_hash,
+                         None if info.encoding is not None else info.size,
+                         info.mtime)
+            for file_hash, info in zip(file_hashes, infos)
+        ]
+        if needs_sizes and any(entry.size is None for entry in entries):
+            entries = await self._get_decoded_sizes(file_manager, entries)
+        return entries
+
+    async def _write_archive(self, response: StreamResponse, writer,
+                             file_manager: FileManager,
+                             entries: List[ArchiveEntry]) -> None:
+        """Writes the archive of the files, the next chunks are read while
+        the current one is sent"""
+        chunks = asyncio.Queue(maxsize=READ_AHEAD_CHUNKS)
+        reading = asyncio.ensure_future(
+            self._read_files(file_manager, entries, chunks))
+        try:
+            for entry in entries:
+                await response.write(writer.begin(entry))
+                while True:
+                    chunk = await chunks.get()
+                    if isinstance(chunk, CorruptFileError):
+                        # The archive is cut by the connection closed
+                        self.request.transport.close()
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+                    if not chunk:
+                        break
+                    data = writer.write(chunk)
+                    if data:
+                        await response.write(data)
+                await response.write(writer.end())
+            await response.write(writer.close())
+        finally:
+            reading.cancel()
+            with suppress(asyncio.CancelledError):
+                await reading
+
+    @staticmethod
+    async def _read_files(file_manager: FileManager,
+                          entries: List[ArchiveEntry],
+                          chunks: asyncio.Queue) -> None:
+        """Reads the files one by one into the queue, each file ends with
+        the empty chunk. The error of reading is passed to the queue
+        """
+        try:
+            for entry in entries:
+                read_file = await file_manager.get_file_reader(
+                    entry.name, decode=True,
+                    verify=await file_manager.needs_verification(entry.name))
+                async for chunk in read_file():
+                    await chunks.put(chunk)
+                await chunks.put(b'')
+        except Exception as e:
+            await chunks.put(e)
+
+    @staticmethod
+    async def _get_decoded_sizes(file_manager: FileManager,
+                                 entries: List[ArchiveEntry]) \
+            -> List[ArchiveEntry]:
+        """Finds the sizes of the files stored compressed by decoding
+        them, the archive needs the sizes before the content
+        """
+        sized = []
+        for entry in entries:
+            if entry.size is None:
+                entry = entry._replace(
+                    size=await file_manager.get_decoded_size(entry.name))
+            sized.append(entry)
+
+        return sized
@@ -0,0 +1,122 @@
+import json
+import logging
+from http import HTTPStatus
+from typing import List, Tuple
+
+from aiohttp import hdrs
+from aiohttp.web_response import Response
+from aiohttp.web_urldispatcher import View
+
+from file_loader.api.admission import OPERATION_METADATA
+from file_loader.api.file_manager import FileManager
+from file_loader.api.handlers.files import FILE_HASH_PATTERN
+from file_loader.replication.replicator import get_replication
+from file_loader.storage.hashing import DEFAULT_ALGORITHM, HashAlgorithm, \
+    get_algorithm
+from file_loader.utils.exception import ValidationError
+
+logger = logging.getLogger(__name__)
+
+# The amount of hashes one request may pass
+MAX_BATCH_SIZE = 10000
+
+
+class BatchView(View):
+    """Handler for working with many files by one request
+
+    :attribute URL_PATH: handler URL, the operation applied to each file
+    """
+    URL_PATH = r'/files/batch/{operation:stat|delete}'
+    OPERATIONS = {hdrs.METH_POST: OPERATION_METADATA}
+
+    async def post(self) -> Response:
+        """Checks or deletes the files by their hashes
+
+        Request
+        ------
+        <operation> str: stat to return the metadata of the files, delete
+        to delete them
+        JSON body:
+        <hashes> list: hashes of the files, no more than 10000
+        <hash_algorithm> str: optional, the name of the hash function,
+        md5 by default
+        ------
+        Response
+        ------
+        207 status with <files> list: file_hash and code of each file.
+        stat: exists, size and mtime of the file
+        delete: 204 code when the file was deleted, 404 when it's not
+        stored. Malformed hashes have 400 code and the message
+        """
+        algorithm, file_hashes = await self._get_batch()
+        valid = [file_hash for file_hash in file_hashes
+                 if self._is_hash_valid(algorithm, file_hash)]
+
+        file_manager = self._create_file_manager(algorithm)
+        if self.request.match_info['operation'] == 'stat':
+            results = dict(zip(valid,
+                               await file_manager.get_files_info(valid)))
+        else:
+            results = dict(zip(valid,
+                               await file_manager.delete_files(valid)))
+
+        files = []
+        for file_hash in file_hashes:
+            if file_hash not in results:
+                files.append({'file_hash': file_hash,
+                              'code': HTTPStatus.BAD_REQUEST,
+                              'message': f'Hash should be {algorithm.name} '
+                                         f'hex digest'})
+            elif self.request.match_info['operation'] == 'stat':
+                info = results[file_hash]
+                files.append({
+                    'file_hash': file_hash,
+                    'code': HTTPStatus.OK if info else HTTPStatus.NOT_FOUND,
+                    'exists': info is not None,
+                    'size': info.size if info else None,
+                    'mtime': info.mtime if info else None})
+            else:
+                files.append({
+                    'file_hash': file_hash,
+                    'code': HTTPStatus.NO_CONTENT if results[file_hash]
+                    else HTTPStatus.NOT_FOUND})
+
+        return Response(body={'files': files},
+                        status=HTTPStatus.MULTI_STATUS)
+
+    async def _get_batch(self) -> Tuple[HashAlgorithm, List[str]]:
+        """Returns the hash algorithm and the hashes of the files
+        :raise ValidationError: the body is malformed
+        """
+        try:
+            data = await self.request.json()
+        except json.JSONDecodeError:
+            raise ValidationError(message='Body should be JSON')
+
+        if not isinstance(data, dict) \
+                or not isinstance(data.get('hashes'), list) \
+                or not all(isinstance(file_hash, str)
+                           for file_hash in data['hashes']):
+            raise ValidationError(message='hashes should be a list of '
+                                          'strings')
+        if len(data['hashes']) > MAX_BATCH_SIZE:
+            raise ValidationError(message=f'No more than {MAX_BATCH_SIZE} '
+                                          f'hashes are allowed')
+
+        name = data.get('hash_algorithm') or DEFAULT_ALGORITHM
+        try:
+            algorithm = get_algorithm(str(name))
+        except KeyError:
+            raise ValidationError(message=f'Unknown hash algorithm {name}')
+
+        return algorithm, [file_hash.strip().lower()
+                           for file_hash in data['hashes']]
+
+    @staticmethod
+    def _is_hash_valid(algorithm: HashAlgorithm, file_hash: str) -> bool:
+        return len(file_hash) == algorithm.hex_length \
+            and FILE_HASH_PATTERN.fullmatch(file_hash) is not None
+
+    def _create_file_manager(self, algorithm: HashAlgorithm) -> FileManager:
+        return self.request.app['file_manager_factory'](
+            algorithm.name, replication=get_replication(self.request))
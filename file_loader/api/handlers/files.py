@@ -1,23 +1,67 @@
+import asyncio
 import logging
+import re
+from email.utils import formatdate
 from http import HTTPStatus
+from typing import AsyncIterator, Dict, List, Mapping, Optional, Tuple, \
+    Union
+from uuid import uuid4
 
-from aiohttp.web_exceptions import HTTPNotFound
+from aiohttp import BodyPartReader, HttpVersion11, hdrs
+from aiohttp.web_exceptions import HTTPExpectationFailed, \
+    HTTPInternalServerError, HTTPNotFound, HTTPRequestRangeNotSatisfiable
+from aiohttp.web_request import Request
 from aiohttp.web_response import Response, StreamResponse
 from aiohttp.web_urldispatcher import View
 
-from file_loader.api.file_manager import FileManager, EmptyFileError
+from file_loader.api.admission import OPERATION_DOWNLOAD, \
+    OPERATION_METADATA, OPERATION_UPLOAD, OverloadedError
+from file_loader.api.caching import CACHE_CONTROL, is_not_modified, \
+    make_etag
+from file_loader.api.file_manager import BufferedPartReader, \
+    EmptyFileError, FileInfo, FileManager, HashMismatchError, RawBodyReader
+from file_loader.api.middleware import get_admission_pool, \
+    handle_overloaded_error
+from file_loader.api.ranges import ByteRange, RANGE_UNIT, \
+    RangeNotSatisfiableError, parse_range
+from file_loader.api.responses import SendfileResponse
+from file_loader.replication.replicator import REPLICA_HEADER, \
+    get_replication
+from file_loader.storage.hashing import DEFAULT_ALGORITHM, HashAlgorithm, \
+    get_algorithm
+from file_loader.storage.compression import accepts_encoding
+from file_loader.storage.scrubber import CorruptFileError
 from file_loader.utils.exception import ValidationError
 
 logger = logging.getLogger(__name__)
 
+FILE_HASH_HEADER = 'X-File-Hash'
+FILE_HASH_PATTERN = re.compile(r'[a-f0-9]+')
+
+RAW_CONTENT_TYPE = 'application/octet-stream'
+# The raw body is read by large blocks, there are no boundaries to search
+RAW_CHUNK_SIZE = 1024 * 1024
+# The amount of files of one multipart request saved at the same time
+MAX_SAVE_PIPELINES = 4
+
 
 class FilesView(View):
     """Handler for working with files
 
     :attribute URL_PATH: handler URL, verifies that the argument is
-    a hexadecimal hash code or empty
+    a hexadecimal hash code or empty, the hash may be prefixed with the name
+    of its algorithm (/files/sha256/<file_hash>). Hashes without the prefix
+    are md5 hashes, uploads without it use the algorithm of the deployment
     """
-    URL_PATH = r'/files/{file_hash:[A-Fa-f0-9]*}'
+    URL_PATH = (r'/files/{algorithm:(?:[A-Za-z0-9_]+/)?}'
+                r'{file_hash:[A-Fa-f0-9]*}')
+    OPERATIONS = {
+        hdrs.METH_GET: OPERATION_DOWNLOAD,
+        hdrs.METH_HEAD: OPERATION_METADATA,
+        hdrs.METH_POST: OPERATION_UPLOAD,
+        hdrs.METH_PUT: OPERATION_UPLOAD,
+        hdrs.METH_DELETE: OPERATION_METADATA,
+    }
 
     async def get(self) -> StreamResponse:
         """Get file by hash of file from storage
@@ -25,10 +69,22 @@ class FilesView(View):
         Request
         ------
         <file_hash> str: should be contain only numbers and letters
+        Range: optional, bytes ranges of the file to be sent
+        If-Range: optional, ETag or date the ranges depend on
+        If-None-Match, If-Modified-Since: optional, validators of the
+        cached copy of the file
+        Accept-Encoding: optional, the file stored compressed is sent as
+        is when the client accepts its encoding, otherwise decompressed
         ------
         Response
         ------
-        streaming bytes data
+        streaming bytes data, a part of file or multipart/byteranges
+        with 206 status when Range is passed, 304 status without body
+        when the cached copy is still valid. The file not verified
+        recently is verified while it's sent whole when the verification
+        on read is enabled, the response is aborted when the file is
+        corrupt and the file is quarantined. The missing file is fetched
+        from the peers when the read repair is enabled
         """
         file_hash = self.request.match_info['file_hash'].lower()
         if not file_hash:
@@ -36,59 +92,188 @@ class FilesView(View):
 
         file_manager = self._create_file_manager()
         try:
-            file_reader = await file_manager.get_file_reader(file_hash)
-
-            response = StreamResponse(
-                status=HTTPStatus.OK,
-                headers={
-                    'Content-disposition': f'attachment; filename={file_hash}'
-                })
-            response.enable_chunked_encoding()
-            await response.prepare(self.request)
-            async for chunk in file_reader():
-                await response.write(chunk)
-            await response.write_eof()
+            file_info = await self._get_repaired_file_info(file_manager,
+                                                           file_hash)
+            content_encoding = self._get_content_encoding(file_info)
+            etag = make_etag(file_hash, content_encoding)
+            headers = self._get_file_headers(file_hash, file_info, etag,
+                                             content_encoding)
 
-            return response
+            # The file is not opened when the client already has it
+            if is_not_modified(self.request, etag, file_info.mtime):
+                return Response(status=HTTPStatus.NOT_MODIFIED,
+                                headers=headers)
+
+            if file_info.encoding is not None and content_encoding is None:
+                # The size of the decompressed file is unknown
+                headers[hdrs.ACCEPT_RANGES] = 'none'
+                return await self._send_decoded_file(file_manager, file_hash,
+                                                     headers=headers)
+
+            ranges = self._get_ranges(etag, file_info)
+            if ranges is None:
+                # The file sent compressed can't be verified
+                verify = file_info.encoding is None \
+                    and await file_manager.needs_verification(file_hash)
+                return await self._send_file(file_manager, file_hash,
+                                             status=HTTPStatus.OK,
+                                             headers=headers, verify=verify)
+
+            if len(ranges) > 1:
+                return await self._send_byteranges(
+                    file_manager, file_hash, ranges, file_info.size,
+                    headers=headers)
+
+            byte_range, = ranges
+            headers[hdrs.CONTENT_RANGE] = byte_range.content_range(
+                file_info.size)
+            return await self._send_file(file_manager, file_hash,
+                                         offset=byte_range.start,
+                                         length=byte_range.length,
+                                         status=HTTPStatus.PARTIAL_CONTENT,
+                                         headers=headers)
+        except FileNotFoundError:
+            raise HTTPNotFound
+        except CorruptFileError:
+            raise HTTPInternalServerError(text='File is corrupt')
+
+    async def head(self) -> Response:
+        """Get the metadata of the file by hash of file, the file is not
+        opened
+
+        Request
+        ------
+        <file_hash> str: should be contain only numbers and letters
+        If-None-Match, If-Modified-Since: optional, validators of the
+        cached copy of the file
+        Accept-Encoding: optional, the same as for GET
+        ------
+        Response
+        ------
+        the headers GET would send: Content-Length, ETag, Last-Modified
+        """
+        file_hash = self.request.match_info['file_hash'].lower()
+        if not file_hash:
+            raise ValidationError(message='file_hash is empty')
+
+        file_manager = self._create_file_manager()
+        try:
+            file_info = await file_manager.get_file_info(file_hash)
         except FileNotFoundError:
             raise HTTPNotFound
 
+        content_encoding = self._get_content_encoding(file_info)
+        etag = make_etag(file_hash, content_encoding)
+        headers = self._get_file_headers(file_hash, file_info, etag,
+                                         content_encoding)
+        if is_not_modified(self.request, etag, file_info.mtime):
+            return Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+        size = file_info.size
+        if file_info.encoding is not None and content_encoding is None:
+            # GET decompresses the file on the fly, the size it would send
+            # is found by decompressing the file
+            headers[hdrs.ACCEPT_RANGES] = 'none'
+            try:
+                size = await file_manager.get_decoded_size(file_hash)
+            except FileNotFoundError:
+                raise HTTPNotFound
+        headers[hdrs.CONTENT_LENGTH] = str(size)
+        return Response(status=HTTPStatus.OK, headers=headers)
+
     async def post(self) -> Response:
         """Uploads a file to storage
 
         Request
         ------
-        should be contain multipart data
+        should be contain multipart data or the raw file with
+        application/octet-stream content type
+        X-File-Hash: optional, hash of the file declared by the client.
+        The body is not read when the file has already been stored,
+        otherwise the hash of the received file is verified. Multipart
+        data declared by it should contain one file, each part of multipart
+        data may declare the hash of its own file the same way
         ------
         Response
         ------
-        <file_hash> str: new file name generated by hash function
+        <file_hash> str: new file name generated by hash function,
+        <hash_algorithm> str: the name of the hash function,
+        201 status when the file was received, 200 when it had already
+        been stored.
+        When multipart data contains several files, 207 status with
+        <files> list: filename, file_hash and code of each file, message
+        instead of file_hash when the file was rejected
         """
+        # The body is not read when the file has already been stored
+        response = await self._get_stored_response()
+        if response is not None:
+            return response
+
         if not self.request.can_read_body:
             raise ValidationError
+        if self.request.content_type == RAW_CONTENT_TYPE:
+            return await self._save_raw_body()
         if 'multipart' not in self.request.content_type:
             raise ValidationError(
-                message='Only multipart content is supported')
+                message=f'Only multipart and {RAW_CONTENT_TYPE} content '
+                        f'is supported')
+        return await self._save_multipart()
 
-        reader = await self.request.multipart()
+    async def put(self) -> Response:
+        """Uploads a file to storage, the body is the raw file
 
-        file_manager = self._create_file_manager()
-        try:
-            async for file_stream in reader:
-                if file_stream.filename:
-                    file_hash = await file_manager.save_file(file_stream)
-                break
+        Request
+        ------
+        <file_hash> str: optional, hash of the file declared by
+        the client, the same as X-File-Hash
+        X-File-Hash: optional, hash of the file declared by the client.
+        The body is not read when the file has already been stored,
+        otherwise the hash of the received file is verified
+        ------
+        Response
+        ------
+        <file_hash> str: new file name generated by hash function,
+        <hash_algorithm> str: the name of the hash function,
+        201 status when the file was received, 200 when it had already
+        been stored
+        """
+        response = await self._get_stored_response()
+        if response is not None:
+            return response
 
-            response = Response(
-                body={'file_hash': file_hash},
-                headers={
-                    'Location': f'/files/{file_hash}'},
-                status=HTTPStatus.CREATED)
+        if not self.request.can_read_body:
+            raise ValidationError
+        return await self._save_raw_body()
 
-            return response
-        except EmptyFileError as e:
-            logger.exception(e)
-            raise ValidationError(message='File is empty') from e
+    @staticmethod
+    async def expect_handler(request: Request) -> Optional[Response]:
+        """Handles Expect: 100-continue. When the file declared by
+        the client has already been stored, the client gets the final
+        response instead of 100 Continue and doesn't send the body
+        """
+        if request.method in (hdrs.METH_POST, hdrs.METH_PUT):
+            try:
+                response = await FilesView(request)._get_stored_response()
+                if response is not None:
+                    return response
+            except ValidationError:
+                # The error is reported by the handler
+                pass
+
+            # The body is not sent when the upload would be shed
+            pool = get_admission_pool(request)
+            if pool is not None:
+                try:
+                    pool.check()
+                except OverloadedError as e:
+                    raise handle_overloaded_error(e)
+
+        expect = request.headers.get(hdrs.EXPECT, '')
+        if request.version == HttpVersion11 \
+                and expect.lower() == '100-continue':
+            await request.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        else:
+            raise HTTPExpectationFailed(text=f'Unknown Expect: {expect}')
 
     async def delete(self) -> Response:
         """Delete file by hash of file from storage
@@ -112,6 +297,430 @@ class FilesView(View):
         except FileNotFoundError:
             raise HTTPNotFound
 
-    def _create_file_manager(self):
-        storage_path = self.request.app['storage_path']
-        return FileManager(storage_path)
+    async def _send_file(self, file_manager: FileManager, file_hash: str,
+                         offset: int = 0, length: Optional[int] = None,
+                         status: int = HTTPStatus.OK,
+                         headers: Optional[Mapping] = None,
+                         verify: bool = False) -> StreamResponse:
+        """Sends the file or its part from the memory cache or by sendfile
+        when it's possible, otherwise streams it chunk by chunk. The file
+        verified while it's sent is streamed
+        """
+        content = await file_manager.get_cached_content(file_hash)
+        if content is not None:
+            end = len(content) if length is None else offset + length
+            return Response(body=memoryview(content)[offset:end],
+                            status=status, headers=headers)
+
+        if self._can_sendfile() and not verify:
+            file_path = await file_manager.get_file_path(file_hash)
+            io_engine = file_manager.io_engine
+            return SendfileResponse(file_path, offset=offset, count=length,
+                                    chunk_size=io_engine.get_buffer_size(
+                                        length),
+                                    status=status, headers=headers,
+                                    executor=io_engine.read_executor)
+
+        file_reader = await file_manager.get_file_reader(file_hash,
+                                                         verify=verify)
+
+        response = StreamResponse(status=status, headers=headers)
+        response.enable_chunked_encoding()
+        await response.prepare(self.request)
+        await self._write_verified(response, file_reader(offset, length))
+        await response.write_eof()
+
+        return response
+
+    async def _send_decoded_file(self, file_manager: FileManager,
+                                 file_hash: str,
+                                 headers: Optional[Mapping] = None) \
+            -> StreamResponse:
+        """Streams the file stored compressed decompressing it chunk by
+        chunk, for clients which don't accept its encoding
+        """
+        file_reader = await file_manager.get_file_reader(
+            file_hash, decode=True,
+            verify=await file_manager.needs_verification(file_hash))
+
+        response = StreamResponse(status=HTTPStatus.OK, headers=headers)
+        response.enable_chunked_encoding()
+        await response.prepare(self.request)
+        await self._write_verified(response, file_reader())
+        await response.write_eof()
+
+        return response
+
+    async def _write_verified(self, response: StreamResponse,
+                              chunks: AsyncIterator[bytes]) -> None:
+        """Writes the chunks of the body. The connection is closed when
+        the file turns out corrupt, so the client sees the body cut
+        :raise CorruptFileError: the file is corrupt
+        """
+        try:
+            async for chunk in chunks:
+                await response.write(chunk)
+        except CorruptFileError:
+            self.request.transport.close()
+            raise
+
+    async def _send_byteranges(self, file_manager: FileManager,
+                               file_hash: str, ranges: List[ByteRange],
+                               file_size: int,
+                               headers: Optional[Mapping] = None) \
+            -> StreamResponse:
+        """Sends several parts of the file as multipart/byteranges"""
+        file_reader = await file_manager.get_file_reader(file_hash)
+
+        boundary = uuid4().hex
+        part_headers = [
+            (f'--{boundary}\r\n'
+             f'{hdrs.CONTENT_TYPE}: application/octet-stream\r\n'
+             f'{hdrs.CONTENT_RANGE}: {byte_range.content_range(file_size)}'
+             f'\r\n\r\n').encode()
+            for byte_range in ranges
+        ]
+        closing = f'--{boundary}--\r\n'.encode()
+
+        response = StreamResponse(status=HTTPStatus.PARTIAL_CONTENT,
+                                  headers=headers)
+        response.content_type = 'multipart/byteranges'
+        response.headers[hdrs.CONTENT_TYPE] += f'; boundary={boundary}'
+        response.content_length = len(closing) + sum(
+            len(part_header) + byte_range.length + 2
+            for part_header, byte_range in zip(part_headers, ranges)
+        )
+        await response.prepare(self.request)
+
+        for part_header, byte_range in zip(part_headers, ranges):
+            await response.write(part_header)
+            async for chunk in file_reader(byte_range.start,
+                                           byte_range.length):
+                await response.write(chunk)
+            await response.write(b'\r\n')
+        await response.write(closing)
+        await response.write_eof()
+
+        return response
+
+    async def _save_raw_body(self) -> Response:
+        """Saves the body of the request as is, without multipart parsing
+        """
+        file_manager = self._create_file_manager()
+        file_stream = RawBodyReader(self.request.content, RAW_CHUNK_SIZE)
+        file_hash = await self._save_file(file_manager, file_stream,
+                                          self._get_expected_hash(),
+                                          self.request.content_length)
+
+        return self._make_saved_response(file_hash, HTTPStatus.CREATED)
+
+    async def _save_multipart(self) -> Response:
+        """Saves every file part of multipart data, the response of
+        several files has the status of each one"""
+        parts = await self._start_saving_parts()
+        results = await asyncio.gather(*(saving for _, saving in parts),
+                                       return_exceptions=True)
+        if len(results) == 1:
+            result, = results
+            if isinstance(result, BaseException):
+                raise result
+            return self._make_saved_response(*result)
+
+        files = []
+        for (filename, _), result in zip(parts, results):
+            if isinstance(result, ValidationError):
+                files.append({'filename': filename,
+                              'code': HTTPStatus.BAD_REQUEST,
+                              'message': result.message})
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                file_hash, status = result
+                files.append({'filename': filename,
+                              'file_hash': file_hash,
+                              'code': status})
+
+        return Response(body={'files': files},
+                        status=HTTPStatus.MULTI_STATUS)
+
+    async def _start_saving_parts(self) \
+            -> List[Tuple[str, asyncio.Future]]:
+        """Reads the file parts of multipart data one by one, the files
+        are saved from the buffers while the next parts are read. Saving
+        of every part is cancelled when the reading fails
+        :return: list: the filename and the future of saving of each part
+        :raise ValidationError: there are no files, or the hash declared
+        by the request isn't the hash of the only file
+        """
+        reader = await self.request.multipart()
+
+        # The hash declared by the request is the hash of its only file
+        declared_hash = self._get_expected_hash()
+        file_manager = self._create_file_manager()
+        pipelines = asyncio.Semaphore(MAX_SAVE_PIPELINES)
+        parts = []
+        try:
+            async for file_stream in reader:
+                if not file_stream.filename:
+                    continue
+                if parts and declared_hash is not None:
+                    raise ValidationError(
+                        message=f'{FILE_HASH_HEADER} of the request '
+                                f'declares one file, the parts should '
+                                f'declare the hashes of several files')
+
+                parts.append((
+                    file_stream.filename,
+                    await self._start_saving_part(file_manager, file_stream,
+                                                  pipelines, declared_hash)
+                ))
+        except BaseException:
+            for _, saving in parts:
+                saving.cancel()
+            await asyncio.gather(*(saving for _, saving in parts),
+                                 return_exceptions=True)
+            raise
+
+        if not parts:
+            raise ValidationError(message='Multipart data contains no files')
+        return parts
+
+    async def _start_saving_part(self, file_manager: FileManager,
+                                 file_stream: BodyPartReader,
+                                 pipelines: asyncio.Semaphore,
+                                 declared_hash: Optional[str] = None) \
+            -> asyncio.Future:
+        """Reads the part of multipart data into the buffer, the file is
+        saved from the buffer in the background
+        :param declared_hash: the hash declared by the request, used when
+        the part doesn't declare its own one
+        :return: Future: hash of the file and the status of saving
+        :raise ValidationError: the declared hash is malformed
+        """
+        loop = asyncio.get_event_loop()
+
+        expected_hash = self._get_expected_hash(file_stream) or declared_hash
+        if expected_hash is not None \
+                and await file_manager.is_file_exist(expected_hash):
+            # The part is skipped, the file has already been stored
+            await file_stream.release()
+            stored = loop.create_future()
+            stored.set_result((expected_hash, HTTPStatus.OK))
+            return stored
+
+        await pipelines.acquire()
+        file_buffer = BufferedPartReader()
+
+        async def save():
+            try:
+                file_hash = await self._save_file(file_manager, file_buffer,
+                                                  expected_hash)
+                return file_hash, HTTPStatus.CREATED
+            finally:
+                # The rest of the part is dropped if saving has failed
+                file_buffer.abort()
+                pipelines.release()
+
+        saving = loop.create_task(save())
+        try:
+            await file_buffer.feed(file_stream, file_manager.chunk_size)
+        except BaseException:
+            # Saving waits for the chunks which won't be fed
+            saving.cancel()
+            await asyncio.gather(saving, return_exceptions=True)
+            raise
+        return saving
+
+    async def _save_file(self, file_manager: FileManager,
+                         file_stream: Union[BodyPartReader, RawBodyReader,
+                                            BufferedPartReader],
+                         expected_hash: Optional[str] = None,
+                         size: Optional[int] = None) -> str:
+        """Saves the uploaded file, verifies its hash if it was declared
+        :raise ValidationError: the file is empty or its hash differs from
+        the declared one
+        """
+        try:
+            return await file_manager.save_file(
+                file_stream, expected_hash=expected_hash, size=size)
+        except EmptyFileError as e:
+            logger.exception(e)
+            raise ValidationError(message='File is empty') from e
+        except HashMismatchError as e:
+            logger.warning(e)
+            raise ValidationError(
+                message=f'File hash does not match {FILE_HASH_HEADER}') from e
+
+    def _get_expected_hash(self, part: Optional[BodyPartReader] = None) \
+            -> Optional[str]:
+        """Returns the hash of the uploaded file declared by the client,
+        the part of multipart data may declare the hash of its own file
+        :param part: the part of multipart data, the hash declared by
+        the request is returned when it's None
+        :raise ValidationError: the declared hash is malformed
+        """
+        if part is not None:
+            expected_hash = part.headers.get(FILE_HASH_HEADER)
+        else:
+            expected_hash = self.request.headers.get(FILE_HASH_HEADER)
+            if expected_hash is None and self.request.method == hdrs.METH_PUT:
+                expected_hash = self.request.match_info['file_hash'] or None
+        if expected_hash is None:
+            return None
+
+        algorithm = self._get_algorithm()
+        expected_hash = expected_hash.strip().lower()
+        if len(expected_hash) != algorithm.hex_length \
+                or not FILE_HASH_PATTERN.fullmatch(expected_hash):
+            raise ValidationError(
+                message=f'{FILE_HASH_HEADER} should be {algorithm.name} '
+                        f'hex digest')
+
+        return expected_hash
+
+    async def _get_stored_response(self) -> Optional[Response]:
+        """Returns the response to the upload when the file declared by
+        the client has already been stored
+        :raise ValidationError: the declared hash is malformed
+        """
+        expected_hash = self._get_expected_hash()
+        if expected_hash is None:
+            return None
+
+        file_manager = self._create_file_manager()
+        if not await file_manager.is_file_exist(expected_hash):
+            return None
+
+        logger.info('File with hash %s has already been stored, '
+                    'the body is skipped', expected_hash)
+        self.request.app['metrics'].dedup_hits.inc(labels=('declared',))
+        return self._make_saved_response(expected_hash, HTTPStatus.OK)
+
+    def _make_saved_response(self, file_hash: str, status: int) -> Response:
+        algorithm = self._get_algorithm()
+        location = f'/files/{file_hash}'
+        if algorithm.name != DEFAULT_ALGORITHM:
+            location = f'/files/{algorithm.name}/{file_hash}'
+
+        return Response(
+            body={'file_hash': file_hash,
+                  'hash_algorithm': algorithm.name},
+            headers={
+                'Location': location},
+            status=status)
+
+    def _get_content_encoding(self, file_info: FileInfo) -> Optional[str]:
+        """Returns the encoding the file is sent with, the file stored
+        compressed is sent as is when the client accepts its encoding
+        """
+        encoding = file_info.encoding
+        if encoding is None or not accepts_encoding(
+                self.request.headers.get(hdrs.ACCEPT_ENCODING),
+                encoding.name):
+            return None
+
+        return encoding.name
+
+    def _get_file_headers(self, file_hash: str, file_info: FileInfo,
+                          etag: str, content_encoding: Optional[str]) \
+            -> Dict[str, str]:
+        """Returns the headers describing the sent file"""
+        headers = {
+            'Content-disposition': f'attachment; filename={file_hash}',
+            hdrs.ACCEPT_RANGES: RANGE_UNIT,
+            **self._get_cache_headers(etag, file_info),
+        }
+        if file_info.encoding is not None:
+            headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+        if content_encoding is not None:
+            headers[hdrs.CONTENT_ENCODING] = content_encoding
+        return headers
+
+    @staticmethod
+    def _get_cache_headers(etag: str,
+                           file_info: FileInfo) -> Mapping[str, str]:
+        """Returns the validators and caching policy of the file"""
+        return {
+            hdrs.ETAG: etag,
+            hdrs.LAST_MODIFIED: formatdate(file_info.mtime, usegmt=True),
+            hdrs.CACHE_CONTROL: CACHE_CONTROL,
+        }
+
+    def _get_ranges(self, etag: str, file_info: FileInfo) \
+            -> Optional[List[ByteRange]]:
+        """Returns the requested ranges of the file, None means
+        the whole file should be sent
+        :raise HTTPRequestRangeNotSatisfiable: the ranges are out of file
+        """
+        header = self.request.headers.get(hdrs.RANGE)
+        if header is None or not self._is_range_valid(etag, file_info):
+            return None
+
+        try:
+            return parse_range(header, file_info.size)
+        except RangeNotSatisfiableError:
+            raise HTTPRequestRangeNotSatisfiable(headers={
+                hdrs.CONTENT_RANGE: f'{RANGE_UNIT} */{file_info.size}'
+            })
+
+    def _is_range_valid(self, etag: str, file_info: FileInfo) -> bool:
+        """Checks the If-Range condition. The content of the file never
+        changes, so the validator matches while the file is stored
+        """
+        if_range = self.request.headers.get(hdrs.IF_RANGE)
+        if if_range is None:
+            return True
+
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == etag
+
+        date = self.request.if_range
+        return date is not None and date.timestamp() >= int(
+            file_info.mtime)
+
+    def _can_sendfile(self) -> bool:
+        """Checks that the file can be passed to the kernel as is,
+        otherwise it is streamed chunk by chunk through the event loop
+        """
+        return self.request.app['sendfile'] and not self.request.secure
+
+    def _get_algorithm(self) -> HashAlgorithm:
+        """Returns the hash algorithm of the requested file
+        :raise ValidationError: the algorithm is unknown
+        """
+        name = self.request.match_info['algorithm'].rstrip('/')
+        if not name:
+            name = DEFAULT_ALGORITHM
+            if self.request.method in (hdrs.METH_POST, hdrs.METH_PUT) \
+                    and not self.request.match_info['file_hash']:
+                name = self.request.app['hash_algorithm']
+
+        try:
+            return get_algorithm(name)
+        except KeyError:
+            raise ValidationError(message=f'Unknown hash algorithm {name}')
+
+    async def _get_repaired_file_info(self, file_manager: FileManager,
+                                      file_hash: str) -> FileInfo:
+        """Returns the metadata of the file, the file missing in the store
+        is fetched from the peers first. The reads of the peers are not
+        repaired, so the peers don't ask each other for the missing file
+            :raise FileNotFoundError: file not found here and on the peers
+            """
+        try:
+            return await file_manager.get_file_info(file_hash)
+        except FileNotFoundError:
+            replicator = self.request.app['replicator']
+            if replicator is None or not self.request.app['read_repair'] \
+                    or REPLICA_HEADER in self.request.headers:
+                raise
+            if not await replicator.repair(file_manager.hash_algorithm.name,
+                                           file_hash):
+                raise
+        return await file_manager.get_file_info(file_hash)
+
+    def _create_file_manager(self) -> FileManager:
+        return self.request.app['file_manager_factory'](
+            self._get_algorithm().name,
+            replication=get_replication(self.request))
@@ -0,0 +1,26 @@
+from aiohttp.web_response import Response
+from aiohttp.web_urldispatcher import View
+
+from file_loader.api.metrics import CONTENT_TYPE
+
+
+class MetricsView(View):
+    """Handler for the metrics of the server process
+
+    :attribute URL_PATH: handler URL
+    """
+    URL_PATH = r'/metrics'
+
+    async def get(self) -> Response:
+        """Returns the metrics of the process serving the request
+
+        Response
+        ------
+        the metrics in the Prometheus text format: latency of the requests
+        by method and handler, bytes uploaded and downloaded, requests in
+        flight, dedup hits, hashing, the executor queues, the admission
+        pools and the event loop lag
+        """
+        response = Response(text=self.request.app['metrics'].render())
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return response
@@ -0,0 +1,25 @@
+from aiohttp.web_response import Response
+from aiohttp.web_urldispatcher import View
+
+
+class StatusView(View):
+    """Handler for the state of the server process
+
+    :attribute URL_PATH: handler URL
+    """
+    URL_PATH = r'/status'
+
+    async def get(self) -> Response:
+        """Returns the load of the process serving the request
+
+        Response
+        ------
+        <admission> dict: for each operation the amount of active and
+        queued requests, the amount of admitted and shed ones, the mean
+        and max seconds the requests waited for their turn
+        """
+        pools = self.request.app['admission_pools']
+        return Response(body={
+            'admission': {operation: pool.stats
+                          for operation, pool in pools.items()},
+        })
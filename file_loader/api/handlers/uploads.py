@@ -0,0 +1,299 @@
+import logging
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import AsyncIterator, Mapping, Optional
+
+from aiohttp import hdrs
+from aiohttp.web_exceptions import HTTPConflict, HTTPNotFound
+from aiohttp.web_response import Response
+from aiohttp.web_urldispatcher import View
+
+from file_loader.api.admission import OPERATION_METADATA, \
+    OPERATION_UPLOAD
+from file_loader.api.file_manager import FileManager, RawBodyReader
+from file_loader.api.handlers.files import FILE_HASH_HEADER, \
+    FILE_HASH_PATTERN, RAW_CHUNK_SIZE
+from file_loader.replication.replicator import get_replication
+from file_loader.storage.hashing import DEFAULT_ALGORITHM, HashAlgorithm, \
+    get_algorithm
+from file_loader.storage.uploads import OffsetMismatchError, OpenUpload, \
+    UploadLengthError, UploadLockedError, UploadNotFoundError, UploadSession
+from file_loader.utils.exception import ValidationError
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_OFFSET_HEADER = 'Upload-Offset'
+UPLOAD_LENGTH_HEADER = 'Upload-Length'
+HASH_ALGORITHM_HEADER = 'X-Hash-Algorithm'
+
+
+class UploadsView(View):
+    """Handler for uploading large files by several requests. The session
+    is created, the file is appended to it by parts from the offset
+    received so far, the interrupted upload is resumed from the offset
+    the server reports. The complete file is stored on finalization.
+
+    :attribute URL_PATH: handler URL, verifies that the argument is
+    a hexadecimal identifier of the session or empty
+    """
+    URL_PATH = r'/uploads/{upload_id:[a-f0-9]*}'
+    OPERATIONS = {
+        hdrs.METH_POST: OPERATION_UPLOAD,
+        hdrs.METH_PATCH: OPERATION_UPLOAD,
+        hdrs.METH_HEAD: OPERATION_METADATA,
+        hdrs.METH_GET: OPERATION_METADATA,
+        hdrs.METH_DELETE: OPERATION_METADATA,
+    }
+
+    async def post(self) -> Response:
+        """Creates the upload session or finalizes it
+
+        Request
+        ------
+        <upload_id> str: empty to create the session, the identifier of
+        the session to finalize it
+        Upload-Length: optional, the size of the uploaded file
+        X-File-Hash: optional, hash the uploaded file should have
+        X-Hash-Algorithm: optional, the name of the algorithm hashing
+        the file, the algorithm of the deployment by default
+        ------
+        Response
+        ------
+        The created session: <upload_id> str, <offset> int, <length> int,
+        <hash_algorithm> str, 201 status.
+        The finalized session: <file_hash> str, <hash_algorithm> str,
+        201 status when the file was stored, 200 when it had already
+        been stored
+        """
+        if self.request.match_info['upload_id']:
+            return await self._finalize()
+
+        algorithm = self._get_algorithm()
+        session = await self.request.app['upload_sessions'].create(
+            algorithm.name,
+            expected_hash=self._get_expected_hash(algorithm),
+            length=self._get_length())
+
+        return Response(
+            body=self._make_session_body(session, 0),
+            headers={
+                'Location': f'/uploads/{session.upload_id}',
+                UPLOAD_OFFSET_HEADER: '0'},
+            status=HTTPStatus.CREATED)
+
+    async def patch(self) -> Response:
+        """Appends the part of the file to the upload session
+
+        Request
+        ------
+        <upload_id> str: the identifier of the session
+        Upload-Offset: the offset of the part in the file, it should be
+        the amount of bytes received so far
+        ------
+        Response
+        ------
+        204 status, Upload-Offset is the amount of bytes received so far,
+        409 status with the actual Upload-Offset when it differs from
+        the passed one or the session is used by another request
+        """
+        offset = self._get_offset()
+        if not self.request.can_read_body:
+            raise ValidationError
+
+        async with self._use_session() as upload:
+            file_stream = RawBodyReader(self.request.content, RAW_CHUNK_SIZE)
+            try:
+                offset = await upload.append(
+                    file_stream, offset, RAW_CHUNK_SIZE,
+                    self.request.app['group_commit'])
+            except OffsetMismatchError as e:
+                raise HTTPConflict(text=str(e), headers={
+                    UPLOAD_OFFSET_HEADER: str(e.offset)})
+            except UploadLengthError as e:
+                raise ValidationError(message=str(e)) from e
+
+        return Response(status=HTTPStatus.NO_CONTENT,
+                        headers={UPLOAD_OFFSET_HEADER: str(offset)})
+
+    async def head(self) -> Response:
+        """Returns the amount of bytes received by the upload session
+
+        Request
+        ------
+        <upload_id> str: the identifier of the session
+        ------
+        Response
+        ------
+        Upload-Offset, Upload-Length when it was declared
+        """
+        async with self._use_session() as upload:
+            return Response(headers=self._make_offset_headers(upload))
+
+    async def get(self) -> Response:
+        """Returns the state of the upload session
+
+        Request
+        ------
+        <upload_id> str: the identifier of the session
+        ------
+        Response
+        ------
+        <upload_id> str, <offset> int: the amount of bytes received so far,
+        <length> int, <hash_algorithm> str
+        """
+        async with self._use_session() as upload:
+            return Response(
+                body=self._make_session_body(upload.session, upload.offset),
+                headers=self._make_offset_headers(upload))
+
+    async def delete(self) -> Response:
+        """Aborts the upload session, the received data is dropped
+
+        Request
+        ------
+        <upload_id> str: the identifier of the session
+        ------
+        Response
+        ------
+        None
+        """
+        async with self._use_session() as upload:
+            await self.request.app['upload_sessions'].remove(
+                upload.upload_id)
+        return Response(status=HTTPStatus.NO_CONTENT)
+
+    async def _finalize(self) -> Response:
+        """Verifies the received file and stores it, the session is
+        removed
+        :raise ValidationError: the file is incomplete, empty or its hash
+        differs from the declared one
+        """
+        async with self._use_session() as upload:
+            session = upload.session
+            if session.length is not None and upload.offset != session.length:
+                raise ValidationError(
+                    message=f'{upload.offset} of {session.length} bytes '
+                            f'have been received')
+            if upload.offset == 0:
+                raise ValidationError(message='File is empty')
+
+            # The hash has been calculated while the parts were received
+            file_hash = await upload.hexdigest()
+            if session.expected_hash is not None \
+                    and session.expected_hash != file_hash:
+                logger.warning('Upload %s expected hash %s, received %s',
+                               upload.upload_id, session.expected_hash,
+                               file_hash)
+                raise ValidationError(
+                    message=f'File hash does not match {FILE_HASH_HEADER}')
+
+            file_manager = self._create_file_manager(session.algorithm)
+            stored = await file_manager.store_file(upload.path, file_hash)
+            await self.request.app['upload_sessions'].remove(
+                upload.upload_id)
+
+        algorithm = file_manager.hash_algorithm
+        location = f'/files/{file_hash}'
+        if algorithm.name != DEFAULT_ALGORITHM:
+            location = f'/files/{algorithm.name}/{file_hash}'
+
+        return Response(
+            body={'file_hash': file_hash,
+                  'hash_algorithm': algorithm.name},
+            headers={
+                'Location': location},
+            status=HTTPStatus.CREATED if stored else HTTPStatus.OK)
+
+    @asynccontextmanager
+    async def _use_session(self) -> AsyncIterator[OpenUpload]:
+        """Opens the upload session for the request
+        :raise HTTPNotFound: the session doesn't exist or has expired
+        :raise HTTPConflict: the session is used by another request
+        """
+        upload = self.request.app['upload_sessions'].use(
+            self.request.match_info['upload_id'])
+        try:
+            await upload.__aenter__()
+        except UploadNotFoundError:
+            raise HTTPNotFound(text='Upload session is not found')
+        except UploadLockedError:
+            raise HTTPConflict(
+                text='Upload session is used by another request')
+
+        try:
+            yield upload
+        finally:
+            await upload.__aexit__(None, None, None)
+
+    @staticmethod
+    def _make_session_body(session: UploadSession,
+                           offset: int) -> Mapping:
+        return {'upload_id': session.upload_id,
+                'offset': offset,
+                'length': session.length,
+                'hash_algorithm': session.algorithm}
+
+    @staticmethod
+    def _make_offset_headers(upload: OpenUpload) -> Mapping[str, str]:
+        headers = {UPLOAD_OFFSET_HEADER: str(upload.offset),
+                   hdrs.CACHE_CONTROL: 'no-store'}
+        if upload.session.length is not None:
+            headers[UPLOAD_LENGTH_HEADER] = str(upload.session.length)
+        return headers
+
+    def _get_offset(self) -> int:
+        """Returns the offset of the appended part
+        :raise ValidationError: the offset is missing or malformed
+        """
+        offset = self.request.headers.get(UPLOAD_OFFSET_HEADER, '')
+        if not offset.isdigit():
+            raise ValidationError(
+                message=f'{UPLOAD_OFFSET_HEADER} should be a non-negative '
+                        f'integer')
+        return int(offset)
+
+    def _get_length(self) -> Optional[int]:
+        """Returns the declared length of the uploaded file
+        :raise ValidationError: the length is malformed
+        """
+        length = self.request.headers.get(UPLOAD_LENGTH_HEADER)
+        if length is None:
+            return None
+
+        if not length.isdigit() or int(length) == 0:
+            raise ValidationError(
+                message=f'{UPLOAD_LENGTH_HEADER} should be a positive '
+                        f'integer')
+        return int(length)
+
+    def _get_expected_hash(self, algorithm: HashAlgorithm) -> Optional[str]:
+        """Returns the hash of the uploaded file declared by the client
+        :raise ValidationError: the declared hash is malformed
+        """
+        expected_hash = self.request.headers.get(FILE_HASH_HEADER)
+        if expected_hash is None:
+            return None
+
+        expected_hash = expected_hash.strip().lower()
+        if len(expected_hash) != algorithm.hex_length \
+                or not FILE_HASH_PATTERN.fullmatch(expected_hash):
+            raise ValidationError(
+                message=f'{FILE_HASH_HEADER} should be {algorithm.name} '
+                        f'hex digest')
+
+        return expected_hash
+
+    def _get_algorithm(self) -> HashAlgorithm:
+        """Returns the hash algorithm of the uploaded file
+        :raise ValidationError: the algorithm is unknown
+        """
+        name = self.request.headers.get(HASH_ALGORITHM_HEADER,
+                                        self.request.app['hash_algorithm'])
+        try:
+            return get_algorithm(name.strip())
+        except KeyError:
+            raise ValidationError(message=f'Unknown hash algorithm {name}')
+
+    def _create_file_manager(self, algorithm: str) -> FileManager:
+        return self.request.app['file_manager_factory'](
+            algorithm, replication=get_replication(self.request))
@@ -0,0 +1,234 @@
+import bisect
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, \
+    Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds of serving the requests, uploads and downloads of large files
+# take longer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Seconds the event loop is late to wake up the monitor
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0)
+# The event loop is checked this often
+LOOP_LAG_INTERVAL = 0.5
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    """The named family of values in the Prometheus text format, each
+    value is identified by the values of the labels
+
+    :param name: the name of the metric
+    :param documentation: the help line of the metric
+    :param labels: the names of the labels
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def render(self) -> List[str]:
+        """Returns the lines of the metric in the text format"""
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_format_labels(labels, values)} '
+                         f'{_format_value(value)}')
+        return lines
+
+    @abstractmethod
+    def samples(self) \
+            -> Iterable[Tuple[str, Sequence[str], LabelValues, float]]:
+        """Yields the suffix of the name, the label names, the label
+        values and the value of each sample"""
+        ...
+
+
+class Counter(Metric):
+    """The value which only grows. The counter with the collect function
+    reads the values counted elsewhere when the metrics are rendered
+
+    :param collect: returns the values by the label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]]
+                 = None):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def inc(self, amount: float = 1.0, labels: LabelValues = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        for values, value in self.values.items():
+            yield '', self.labels, values, value
+
+
+class Gauge(Metric):
+    """The value which goes up and down. The gauge with the collect
+    function is set by it when the metrics are rendered
+
+    :param collect: returns the values by the label values
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]]
+                 = None):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, labels: LabelValues = ()) -> None:
+        self.values[labels] = value
+
+    def inc(self, amount: float = 1.0, labels: LabelValues = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, labels: LabelValues = ()) -> None:
+        self.inc(-amount, labels)
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        for values, value in self.values.items():
+            yield '', self.labels, values, value
+
+
+class Histogram(Metric):
+    """The distribution of the observed values by the buckets of their
+    upper bounds
+
+    :param buckets: the sorted upper bounds of the buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # The counts of the buckets, the sum and the count of the values
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: LabelValues = ()) -> None:
+        counts, total = self.values.setdefault(
+            labels, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self):
+        bucket_labels = (*self.labels, 'le')
+        for values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield '_bucket', bucket_labels, \
+                    (*values, _format_value(bound)), cumulative
+            yield '_sum', self.labels, values, total[0]
+            yield '_count', self.labels, values, cumulative
+
+
+class Metrics:
+    """The metrics of the server process, rendered in the Prometheus text
+    format. Each worker has its own metrics"""
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            'file_loader_request_duration_seconds',
+            'Seconds of serving the requests, sending the response included',
+            ('method', 'handler'))
+        self.requests = Counter(
+            'file_loader_requests_total', 'Served requests',
+            ('method', 'handler', 'status'))
+        self.in_flight = Gauge(
+            'file_loader_requests_in_flight', 'Requests being served',
+            ('method',))
+        self.uploaded_bytes = Counter(
+            'file_loader_uploaded_bytes_total',
+            'Bytes of the request bodies received')
+        self.downloaded_bytes = Counter(
+            'file_loader_downloaded_bytes_total',
+            'Bytes of the responses sent')
+        self.dedup_hits = Counter(
+            'file_loader_dedup_hits_total',
+            'Uploads of the files which had already been stored, by '
+            'the declared hash or by the received content',
+            ('check',))
+        self.hashed_bytes = Counter(
+            'file_loader_hashed_bytes_total', 'Bytes of the uploads hashed')
+        self.hash_seconds = Counter(
+            'file_loader_hash_seconds_total', 'Seconds spent hashing')
+        self.loop_lag = Histogram(
+            'file_loader_event_loop_lag_seconds',
+            'Seconds the event loop is late to run the scheduled callback',
+            buckets=LAG_BUCKETS)
+        self.collected: List[Metric] = []
+
+    @property
+    def metrics(self) -> List[Metric]:
+        return [self.request_duration, self.requests, self.in_flight,
+                self.uploaded_bytes, self.downloaded_bytes, self.dedup_hits,
+                self.hashed_bytes, self.hash_seconds, self.loop_lag,
+                *self.collected]
+
+    def add_gauge(self, name: str, documentation: str,
+                  labels: Sequence[str],
+                  collect: Callable[[], Dict[LabelValues, float]]) -> None:
+        """Adds the gauge set by the collect function when the metrics
+        are rendered"""
+        self.collected.append(Gauge(name, documentation, labels, collect))
+
+    def add_counter(self, name: str, documentation: str,
+                    labels: Sequence[str],
+                    collect: Callable[[], Dict[LabelValues, float]]) \
+            -> None:
+        """Adds the counter read by the collect function when the metrics
+        are rendered"""
+        self.collected.append(Counter(name, documentation, labels, collect))
+
+    def record_hashing(self, size: int, seconds: float) -> None:
+        self.hashed_bytes.inc(size)
+        self.hash_seconds.inc(seconds)
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names: Sequence[str], values: LabelValues) -> str:
+    if not names:
+        return ''
+    return '{%s}' % ','.join(f'{name}="{_escape(str(value))}"'
+                             for name, value in zip(names, values))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -1,22 +1,32 @@
 import logging
+import time
 from http import HTTPStatus
 from typing import Mapping, Optional
 
+from aiohttp import hdrs
 from aiohttp.web_exceptions import (
-    HTTPBadRequest, HTTPException, HTTPInternalServerError,
+    HTTPBadRequest, HTTPException, HTTPInternalServerError, HTTPNotFound,
+    HTTPServiceUnavailable,
 )
 from aiohttp.web_middlewares import middleware
 from aiohttp.web_request import Request
+from multidict import CIMultiDict
 
+from file_loader.api.admission import AdmissionPool, OverloadedError
 from file_loader.utils.exception import ValidationError
 
 log = logging.getLogger(__name__)
 
+BODY_HEADERS = (hdrs.CONTENT_TYPE, hdrs.CONTENT_LENGTH,
+                hdrs.CONTENT_ENCODING, hdrs.TRANSFER_ENCODING)
+
 
 def format_http_error(http_error_cls, message: Optional[str] = None,
-                      fields: Optional[Mapping] = None) -> HTTPException:
+                      fields: Optional[Mapping] = None,
+                      headers: Optional[Mapping] = None) -> HTTPException:
     """
-    Formats the error as an HTTP exception
+    Formats the error as an HTTP exception, keeps passed headers except
+    the ones describing the original body
     """
     status = HTTPStatus(http_error_cls.status_code)
     error = {
@@ -27,7 +37,36 @@ def format_http_error(http_error_cls, message: Optional[str] = None,
     if fields:
         error['additional_info'] = fields
 
-    return http_error_cls(body={'error': error})
+    if headers:
+        headers = CIMultiDict(headers)
+        for name in BODY_HEADERS:
+            headers.popall(name, None)
+
+    return http_error_cls(body={'error': error}, headers=headers)
+
+
+def handle_overloaded_error(error: OverloadedError) -> HTTPException:
+    """
+    A shed request as an HTTP error, the client is asked to retry later.
+    The body of the request is left unread, so the connection is closed
+    """
+    return HTTPServiceUnavailable(
+        text=str(error),
+        headers={hdrs.RETRY_AFTER: str(error.retry_after),
+                 hdrs.CONNECTION: 'close'})
+
+
+def get_admission_pool(request: Request) -> Optional[AdmissionPool]:
+    """
+    Returns the admission pool of the operation of the request, the view
+    maps the methods it serves to their operations
+    """
+    operations = getattr(request.match_info.handler, 'OPERATIONS', None)
+    if not operations:
+        return None
+
+    return request.app['admission_pools'].get(
+        operations.get(request.method))
 
 
 def handle_validation_error(error: ValidationError, *_):
@@ -38,12 +77,73 @@ def handle_validation_error(error: ValidationError, *_):
                             error.message)
 
 
+def get_handler_name(request: Request) -> str:
+    """
+    Returns the name of the view serving the request, 'none' when no
+    route matches the request
+    """
+    if request.match_info.http_exception is not None:
+        return 'none'
+    return getattr(request.match_info.handler, '__name__', 'none')
+
+
+def get_method_label(request: Request) -> str:
+    """
+    Returns the method of the request as the label of the metrics,
+    the methods out of the HTTP standard are 'other', so any method
+    the client sends doesn't add new series
+    """
+    if request.method in hdrs.METH_ALL:
+        return request.method
+    return 'other'
+
+
+@middleware
+async def metrics_middleware(request: Request, handler):
+    """
+    Records the latency, the status and the transferred bytes of
+    the request. The response is sent inside, so the latency includes
+    sending it.
+    """
+    metrics = request.app['metrics']
+    labels = (get_method_label(request), get_handler_name(request))
+    status = HTTPStatus.INTERNAL_SERVER_ERROR
+    started = time.monotonic()
+    metrics.in_flight.inc(labels=labels[:1])
+    try:
+        response = await handler(request)
+        status = response.status
+        try:
+            await response.prepare(request)
+            await response.write_eof()
+        except ConnectionError:
+            # The client has gone, it's handled by the server
+            pass
+        if request.method != hdrs.METH_HEAD:
+            # The file passed to sendfile bypasses the writer counting
+            # the body, the chunked body is counted by the writer
+            metrics.downloaded_bytes.inc(
+                response.content_length
+                if response.content_length is not None
+                else response.body_length)
+        return response
+    except HTTPException as err:
+        status = err.status
+        raise
+    finally:
+        metrics.in_flight.dec(labels=labels[:1])
+        metrics.request_duration.observe(time.monotonic() - started, labels)
+        metrics.requests.inc(labels=(*labels, str(int(status))))
+        metrics.uploaded_bytes.inc(request.content.total_bytes)
+
+
 @middleware
 async def error_middleware(request: Request, handler):
     try:
         return await handler(request)
     except HTTPException as err:
-        raise format_http_error(err.__class__, err.text)
+        raise format_http_error(err.__class__, err.text,
+                                headers=err.headers)
 
     except ValidationError as err:
         # Validation errors thrown in handlers
@@ -54,3 +154,32 @@ async def error_middleware(request: Request, handler):
         # as an HTTP response and can reveal internal information.
         log.exception('Unhandled exception')
         raise format_http_error(HTTPInternalServerError)
+
+
+@middleware
+async def admission_middleware(request: Request, handler):
+    """
+    Serves the request in the admission pool of its operation. The turn
+    is held until the response is sent, the file of the response is read
+    while it's being sent. The file deleted after the handler has found it
+    is not found as well.
+    """
+    pool = get_admission_pool(request)
+    if pool is None:
+        return await handler(request)
+
+    try:
+        async with pool.admit():
+            response = await handler(request)
+            try:
+                await response.prepare(request)
+                await response.write_eof()
+            except ConnectionError:
+                # The client has gone, it's handled by the server
+                pass
+            except FileNotFoundError:
+                # The file is opened when the response is prepared
+                raise HTTPNotFound
+            return response
+    except OverloadedError as err:
+        raise handle_overloaded_error(err)
@@ -0,0 +1,104 @@
+import re
+from typing import List, NamedTuple, Optional
+
+RANGE_UNIT = 'bytes'
+# Limits the amount of parts in the multipart/byteranges response,
+# lots of small ranges are more expensive than the whole file
+MAX_RANGES = 64
+
+RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiableError(Exception):
+    """
+    Exception raised when none of the requested ranges overlap the file.
+    """
+    pass
+
+
+class ByteRange(NamedTuple):
+    """Range of bytes of the file, both positions are inclusive"""
+    start: int
+    end: int
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start + 1
+
+    def content_range(self, size: int) -> str:
+        return f'{RANGE_UNIT} {self.start}-{self.end}/{size}'
+
+
+def parse_range(header: str, size: int) -> Optional[List[ByteRange]]:
+    """Parses the value of the Range header (RFC 7233)
+    :param header: value of the Range header
+    :param size: size of the requested file
+    :return: sorted ranges with merged overlaps or None when the header is
+    malformed and should be ignored
+    :raise RangeNotSatisfiableError: none of the ranges overlap the file
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != RANGE_UNIT or not specs:
+        return None
+
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        try:
+            byte_range = _parse_spec(spec, size)
+        except ValueError:
+            return None
+        if byte_range is not None:
+            ranges.append(byte_range)
+
+    if not ranges:
+        raise RangeNotSatisfiableError
+    return _merge_ranges(ranges)
+
+
+def _parse_spec(spec: str, size: int) -> Optional[ByteRange]:
+    """Parses one range of the Range header: closed (0-99), open-ended
+    (100-) or suffix (-100)
+    :return: the range cut to the file, None when it doesn't overlap
+    the file
+    :raise ValueError: the range is malformed
+    """
+    match = RANGE_SPEC.match(spec)
+    if not match:
+        raise ValueError(f'Malformed range {spec!r}')
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            raise ValueError(f'Malformed range {spec!r}')
+    elif last:
+        # suffix range: the last N bytes of the file
+        if not int(last):
+            return None
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        raise ValueError(f'Malformed range {spec!r}')
+
+    if start >= size:
+        return None
+    return ByteRange(start, min(end, size - 1))
+
+
+def _merge_ranges(ranges: List[ByteRange]) -> List[ByteRange]:
+    """Sorts the ranges, merges the overlapping and adjacent ones"""
+    ranges.sort()
+    merged = [ranges[0]]
+    for byte_range in ranges[1:]:
+        last = merged[-1]
+        if byte_range.start <= last.end + 1:
+            merged[-1] = ByteRange(last.start, max(last.end, byte_range.end))
+        else:
+            merged.append(byte_range)
+
+    return merged
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Mapping, Optional
+
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.web_fileresponse import FileResponse
+from aiohttp.web_request import BaseRequest
+
+from file_loader.storage.io_engine import advise
+
+logger = logging.getLogger(__name__)
+
+
+class SendfileResponse(FileResponse):
+    """Response that hands a region of a stored file to the kernel.
+
+    Unlike the aiohttp FileResponse, it does not inspect the request
+    headers itself: all decisions (status, region, headers) are made by
+    the handler, the response only transfers the bytes. aiohttp falls
+    back to reading the file in chunks when sendfile can't be used
+    (TLS transport, compressed response).
+
+    :param path: path of the file to send
+    :param offset: position of the first byte to send
+    :param count: amount of bytes to send, till the end of file if None
+    :param chunk_size: the size of slice of file for the fallback path
+    :param executor: the executor opening the file, the default one if None
+    """
+
+    def __init__(self, path: Path, offset: int = 0,
+                 count: Optional[int] = None, chunk_size: int = 64 * 1024,
+                 status: int = 200,
+                 headers: Optional[Mapping[str, str]] = None,
+                 executor: Optional[Executor] = None):
+        super().__init__(path, chunk_size=chunk_size, status=status,
+                         headers=headers)
+        self._offset = offset
+        self._count = count
+        self._executor = executor
+
+    async def prepare(self, request: BaseRequest) \
+            -> Optional[AbstractStreamWriter]:
+        # The response sent whole is not prepared again by aiohttp
+        if self.prepared or self._eof_sent:
+            return await super(FileResponse, self).prepare(request)
+
+        loop = asyncio.get_event_loop()
+        file = await loop.run_in_executor(self._executor, open, self._path,
+                                          'rb')
+        try:
+            count = self._count
+            if count is None:
+                size = await loop.run_in_executor(
+                    self._executor, lambda: Path(self._path).stat().st_size)
+                count = size - self._offset
+
+            # The kernel reads the file ahead while it's sent
+            await loop.run_in_executor(self._executor, advise,
+                                       file.fileno(), self._offset, count,
+                                       min(count, self._chunk_size))
+            self.content_length = count
+            return await self._sendfile(request, file, self._offset, count)
+        finally:
+            await loop.run_in_executor(self._executor, file.close)
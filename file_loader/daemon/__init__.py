@@ -1 +1,7 @@
 from .daemon import AbstractDaemon
+from .workers import WorkerSupervisor
+
+__all__ = (
+    'AbstractDaemon',
+    'WorkerSupervisor',
+)
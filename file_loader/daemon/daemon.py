@@ -1,10 +1,15 @@
 import atexit
 import os
 import signal
+import socket
 import sys
 import errno
+import time
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Optional
+
+from .handoff import SocketHandoff
 
 
 class PidFile:
@@ -31,18 +36,30 @@ class PidFile:
             return pid
 
     def save(self, value: int) -> None:
-        """Save pid in file.
+        """Save pid in file. The file is replaced at once, so it's never
+        read half-written while the daemon is replaced.
         :param value: the pid that should be save in file
         :raise ValueError when pid has incorrect format
         """
         if not value > 0:
             raise ValueError('Cannot be negative')
 
-        with open(self.file_path, 'w') as f:
+        tmp_path = f'{self.file_path}.{value}.tmp'
+        with open(tmp_path, 'w') as f:
             f.write(str(value))
+        os.replace(tmp_path, self.file_path)
+
+    def remove(self, value: Optional[int] = None) -> None:
+        """Delete pid file.
+        :param value: the file is deleted only when it contains this pid
+        """
+        if value is not None:
+            try:
+                if self.load() != value:
+                    return
+            except (FileNotFoundError, ValueError):
+                return
 
-    def remove(self) -> None:
-        """Delete pid file."""
         if self.is_file_exist():
             os.remove(self.file_path)
 
@@ -87,8 +104,9 @@ class Process:
         self.pid_file.save(pid)
 
     def remove_pid(self):
-        """Remove file with pid."""
-        self.pid_file.remove()
+        """Remove file with pid if it's the pid of the current process,
+        the daemon which has replaced this one saved its own pid."""
+        self.pid_file.remove(os.getpid())
 
     def get_pid(self):
         """Load pid from file.
@@ -118,6 +136,8 @@ class AbstractDaemon(ABC):
     :param stdin: new place for stdin
     :param stdout: new place for stdout
     :param stderr: new place for stderr
+    :param handoff_file_name: the name of the Unix socket the listening
+        socket is passed to the daemon replacing this one by
     :param kwargs: parameters to be used in the run() method
     """
     def __init__(self,
@@ -126,6 +146,7 @@ class AbstractDaemon(ABC):
                  stdin: str = '/dev/null',
                  stdout: str = '/dev/null',
                  stderr: str = '/dev/null',
+                 handoff_file_name: str = 'daemon.sock',
                  kwargs=None):
         if not kwargs:
             kwargs = {}
@@ -135,12 +156,15 @@ class AbstractDaemon(ABC):
         self.stderr = stderr
         self.storage = storage
         self.process = Process(self.storage / pid_file_name)
+        self.handoff = SocketHandoff(self.storage / handoff_file_name)
 
         for k in kwargs.keys():
             setattr(self, k, kwargs[k])
 
-    def daemonize(self) -> None:
-        """Daemonize class. UNIX double fork mechanism."""
+    def daemonize(self, save_pid: bool = True) -> None:
+        """Daemonize class. UNIX double fork mechanism.
+        :param save_pid: the pid is saved, otherwise it's saved by ready()
+        """
         try:
             Process.fork()
         except OSError as err:
@@ -171,7 +195,8 @@ class AbstractDaemon(ABC):
 
         atexit.register(self.process.remove_pid)
 
-        self.process.save_pid()
+        if save_pid:
+            self.process.save_pid()
 
     def start(self) -> None:
         """Start the daemon."""
@@ -207,14 +232,42 @@ class AbstractDaemon(ABC):
                 raise
 
     def restart(self):
-        """Restart the daemon."""
+        """Restart the daemon. The new daemon is started when the running
+        one has finished its requests and exited."""
         self.stop()
+        while self.process.is_running():
+            time.sleep(0.1)
         self.start()
 
+    def reload(self) -> None:
+        """Replace the running daemon by a new one without refusing
+        connections. The new daemon takes over the listening socket by
+        handoff.take_over() in run(), the running one drains its requests
+        and exits when the new one calls ready(). The pid file keeps
+        the pid of the running daemon until then, it keeps running if
+        the new one fails. Starts the daemon when it's not running."""
+        if not self.process.is_running():
+            self.start()
+        else:
+            self.daemonize(save_pid=False)
+            self.run()
+
+    def ready(self, sock: socket.socket) -> None:
+        """Starts passing the listening socket to the daemon replacing
+        this one, which stops this one by SIGTERM. Saves the pid of
+        the daemon and stops the daemon it has replaced. Should be called
+        by run() when the daemon accepts connections.
+        :param sock: the listening socket
+        """
+        self.handoff.serve(
+            sock, on_handoff=lambda: os.kill(os.getpid(), signal.SIGTERM))
+        self.process.save_pid()
+        self.handoff.ready()
+
     @abstractmethod
     def run(self) -> None:
         """You should override this method in your subclass Daemon.
         It will be called after the process has been daemonized by
-        start() or restart().
+        start(), restart() or reload().
         """
         ...
@@ -0,0 +1,134 @@
+import array
+import logging
+import socket
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# The daemon taking over the socket is ready to accept connections
+READY = b'R'
+
+
+class SocketHandoff:
+    """Passes the listening socket of the running daemon to the daemon
+    replacing it. The running daemon serves the Unix socket in its working
+    directory, the new one connects to it and receives the listening
+    socket by SCM_RIGHTS. Both share the socket, so connections are not
+    refused while one of them is starting or stopping. The running daemon
+    is stopped only when the new one is ready, it keeps serving if the new
+    one fails before that.
+    :param path: the path of the Unix socket, it's limited by 107 bytes
+    :param timeout: seconds to wait for the running daemon to pass
+        the socket
+    """
+    def __init__(self, path: Path, timeout: float = 10.0):
+        self.path = path
+        self.timeout = timeout
+        self._listener: Optional[socket.socket] = None
+        self._peer: Optional[socket.socket] = None
+
+    def take_over(self) -> Optional[socket.socket]:
+        """Receives the listening socket of the running daemon, it's
+        stopped by ready().
+        :return: the listening socket, None when no daemon passes it
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        fds = array.array('i')
+        try:
+            conn.connect(str(self.path))
+            _, ancdata, _, _ = conn.recvmsg(
+                1, socket.CMSG_SPACE(fds.itemsize))
+        except OSError:
+            # There is no running daemon or it has failed
+            conn.close()
+            return None
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        if not fds:
+            conn.close()
+            return None
+
+        self._peer = conn
+        logger.info('Listening socket is taken over from the running '
+                    'daemon')
+        return socket.socket(fileno=fds[0])
+
+    def ready(self) -> None:
+        """Stops the daemon the socket was taken over from, its requests
+        in progress are finished. Does nothing if the socket was not
+        taken over."""
+        if self._peer is None:
+            return
+        try:
+            self._peer.sendall(READY)
+        except OSError:
+            logger.exception('Running daemon has not been stopped')
+        finally:
+            self._peer.close()
+            self._peer = None
+
+    def serve(self, sock: socket.socket,
+              on_handoff: Callable[[], None]) -> None:
+        """Starts the thread passing the listening socket to the daemon
+        replacing this one.
+        :param sock: the listening socket
+        :param on_handoff: called when the new daemon is ready, it should
+            stop accepting connections and stop the daemon
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket of the stopped daemon is left behind
+        if self.path.is_socket():
+            self.path.unlink()
+        listener.bind(str(self.path))
+        listener.listen(1)
+        self._listener = listener
+        threading.Thread(target=self._serve, args=(listener, sock,
+                                                   on_handoff),
+                         name='socket-handoff', daemon=True).start()
+
+    def close(self) -> None:
+        """Stops passing the socket, the Unix socket file is left because
+        it may be bound by the new daemon already."""
+        if self._listener is not None:
+            # Wakes up the thread waiting in accept()
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._listener.close()
+            self._listener = None
+
+    def _serve(self, listener: socket.socket, sock: socket.socket,
+               on_handoff: Callable[[], None]) -> None:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                # The listener is closed
+                return
+
+            with conn:
+                try:
+                    conn.sendmsg([b'\0'], [(
+                        socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', [sock.fileno()]))])
+                    # The new daemon may load the store for a long time
+                    ready = conn.recv(1)
+                except OSError:
+                    logger.exception('Listening socket was not passed')
+                    continue
+
+            if ready == READY:
+                logger.info('Listening socket is taken over by the new '
+                            'daemon, stopping')
+                listener.close()
+                on_handoff()
+                return
+
+            logger.warning('New daemon has failed before it was ready, '
+                           'the listening socket is kept')
@@ -0,0 +1,171 @@
+import logging
+import os
+import select
+import signal
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Exited workers are checked for this often while the workers are starting
+STARTUP_POLL_INTERVAL = 0.1
+
+
+class WorkerSupervisor:
+    """Runs the target in several forked worker processes. Workers share
+    everything the parent prepared before the fork (e.g. the listening
+    socket). The supervisor restarts crashed workers and forwards the
+    termination signals to them.
+    :param workers: the amount of worker processes
+    :param target: the function run in each worker process, gets
+        the number of the worker
+    :param restart_delay: seconds to wait before restarting a crashed
+        worker, protects from the restart loop
+    :param on_started: called in the supervisor when all the workers
+        report they are started by notify_started()
+    """
+    def __init__(self, workers: int, target: Callable[[int], None],
+                 restart_delay: float = 1.0,
+                 on_started: Optional[Callable[[], None]] = None):
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.on_started = on_started
+        self.children: Dict[int, int] = {}
+        self.stopping = False
+        # The pipe the workers report they are started by
+        self._started_reader: Optional[int] = None
+        self._started_writer: Optional[int] = None
+
+    def run(self) -> None:
+        """Starts the workers and supervises them until they all exit
+        after the termination signal. When a worker exits before all of
+        them are started, the others are stopped and the supervisor exits
+        with code 1."""
+        self._handle_signals()
+        started = self._start()
+        self._supervise()
+
+        logger.info('All workers have stopped')
+        if not started:
+            raise SystemExit(1)
+
+    def notify_started(self) -> None:
+        """Reports to the supervisor that the worker is started, called
+        in the worker process."""
+        try:
+            os.write(self._started_writer, b'S')
+        except OSError:
+            # The restarted worker is not waited for
+            pass
+
+    def _handle_signals(self) -> None:
+        """Forwards the termination signals to the workers."""
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+
+    def _start(self) -> bool:
+        """Starts the workers and waits until they all are started.
+        :return: bool: false when a worker has exited before that, the
+            others are stopped then
+        """
+        self._started_reader, self._started_writer = os.pipe()
+        for number in range(self.workers):
+            self._spawn(number)
+        started = self._wait_started()
+        os.close(self._started_reader)
+        self._started_reader = None
+
+        if started:
+            if self.on_started is not None:
+                self.on_started()
+        elif not self.stopping:
+            logger.error('Workers have failed to start, stopping')
+            self._terminate(signal.SIGTERM, None)
+            return False
+        return True
+
+    def _supervise(self) -> None:
+        """Reaps the exited workers and restarts the crashed ones until
+        they all exit after the termination signal."""
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            number = self.children.pop(pid, None)
+            if number is None or self.stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = f'was killed by signal {os.WTERMSIG(status)}'
+            else:
+                reason = f'exited with code {os.WEXITSTATUS(status)}'
+            logger.error('Worker #%d (pid %d) %s, restarting',
+                         number, pid, reason)
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self._spawn(number)
+
+    def _wait_started(self) -> bool:
+        """Waits until every worker reports it's started.
+        :return: bool: false when a worker has exited or the supervisor
+            is stopped before that
+        """
+        started = 0
+        while started < self.workers and not self.stopping:
+            readable, _, _ = select.select([self._started_reader], [], [],
+                                           STARTUP_POLL_INTERVAL)
+            if readable:
+                started += len(os.read(self._started_reader, self.workers))
+
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                number = self.children.pop(pid, None)
+                logger.error('Worker #%s (pid %d) has exited before it was '
+                             'started', number, pid)
+                return False
+
+        return started >= self.workers
+
+    def _spawn(self, number: int) -> None:
+        """Forks a new worker process."""
+        # The buffered records must not be written by both processes
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
+        pid = os.fork()
+        if pid > 0:
+            logger.info('Worker #%d started with pid %d', number, pid)
+            self.children[pid] = number
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if self._started_reader is not None:
+            os.close(self._started_reader)
+
+        code = 0
+        try:
+            self.target(number)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception('Worker #%d has crashed', number)
+            code = 1
+        finally:
+            for handler in logging.getLogger().handlers:
+                handler.flush()
+            # The exit handlers of the parent (e.g. removing the pid file)
+            # must not be run by the worker
+            os._exit(code)
+
+    def _terminate(self, signum: int, _) -> None:
+        """Forwards the termination signal to the workers."""
+        self.stopping = True
+        for pid in tuple(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'replication.sqlite3'
+
+OP_SAVE = 'save'
+OP_DELETE = 'delete'
+OPS = (OP_SAVE, OP_DELETE)
+
+# The failed operation is retried after the delay doubled by each attempt
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 300.0
+
+
+class ReplicationOp(NamedTuple):
+    """The operation waiting to be replicated to the peer
+    :param id: the identifier of the operation in the journal, later
+    operations have larger ones
+    :param peer: the URL of the peer
+    :param op: save or delete
+    :param algorithm: the name of the hash algorithm of the file
+    :param file_hash: the hash of the file
+    :param attempts: the amount of the failed attempts
+    """
+    id: int
+    peer: str
+    op: str
+    algorithm: str
+    file_hash: str
+    attempts: int
+
+
+class ReplicationJournal:
+    """Persistent queue of the saved and deleted files to be replicated to
+    the peers, it's saved to the store, so the operations survive
+    restarts. Each operation is queued for every peer, the later operation
+    on the same file replaces the queued one. The operations added at
+    the same time are written by one transaction in the executor.
+    Several processes share the journal.
+
+    :param path_store: directory of the store
+    :param peers: the URLs of the peers
+    """
+
+    def __init__(self, path_store: Path, peers: Sequence[str]):
+        self.db_path = path_store / DB_NAME
+        self.peers = tuple(peers)
+        # Set when the operations of this process are written
+        self.added = asyncio.Event()
+        self._pending: List[Tuple[str, str, str]] = []
+        self._waiters: List[asyncio.Future] = []
+        self._flushing: Optional[asyncio.Future] = None
+
+    async def open(self) -> None:
+        """Creates the journal, drops the operations of the peers which
+        are not configured anymore"""
+        loop = asyncio.get_event_loop()
+        dropped = await loop.run_in_executor(None, self._open)
+        if dropped:
+            logger.warning('%d operations of the removed peers were '
+                           'dropped', dropped)
+
+    async def close(self) -> None:
+        """Waits for the operations being written"""
+        if self._flushing is not None:
+            await self._flushing
+
+    async def add(self, op: str, algorithm: str,
+                  file_hashes: Sequence[str]) -> None:
+        """Queues the operation on the files for every peer, waits until
+        it's written
+            :param op: save or delete
+            :param algorithm: the name of the hash algorithm of the files
+            :param file_hashes: the hashes of the files
+            """
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._pending.extend((op, algorithm, file_hash)
+                             for file_hash in file_hashes)
+        self._waiters.append(waiter)
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        # The operations are written even if the request is cancelled
+        await asyncio.shield(waiter)
+
+    async def take(self, peer: str, limit: int) -> List[ReplicationOp]:
+        """Returns the oldest operations of the peer which are due, they
+        stay in the journal until they are completed
+            :param peer: the URL of the peer
+            :param limit: the max amount of the operations
+            """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._take, peer, limit)
+
+    async def complete(self, ops: Sequence[ReplicationOp]) -> None:
+        """Removes the replicated operations"""
+        if not ops:
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._execute, 'DELETE FROM ops '
+                                   'WHERE id = ?', [(op.id,) for op in ops])
+
+    async def retry(self, ops: Sequence[ReplicationOp]) -> None:
+        """Postpones the failed operations by the delay growing with
+        the attempts"""
+        if not ops:
+            return
+        now = time.time()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._execute, (
+            'UPDATE ops SET attempts = attempts + 1, next_attempt = ? '
+            'WHERE id = ?'), [
+            (now + min(RETRY_DELAY * 2 ** op.attempts, MAX_RETRY_DELAY),
+             op.id) for op in ops])
+
+    async def count(self, peer: str) -> int:
+        """Returns the amount of the operations queued for the peer"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._count, peer)
+
+    async def is_deleted(self, algorithm: str, file_hash: str) -> bool:
+        """Checks that the deletion of the file is being replicated, so
+        the peers may still have the deleted file"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._is_deleted,
+                                          algorithm, file_hash)
+
+    async def _flush(self) -> None:
+        """Writes the added operations while there are ones to write"""
+        loop = asyncio.get_event_loop()
+        while self._waiters:
+            pending, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            try:
+                await loop.run_in_executor(None, self._write, pending)
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.added.set()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(str(self.db_path), timeout=30.0)
+        db.execute('CREATE TABLE IF NOT EXISTS ops ('
+                   'id INTEGER PRIMARY KEY AUTOINCREMENT, peer TEXT, '
+                   'op TEXT, algorithm TEXT, file_hash TEXT, '
+                   'attempts INTEGER, next_attempt REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS ops_file '
+                   'ON ops (peer, algorithm, file_hash)')
+        return db
+
+    def _open(self) -> int:
+        """Creates the tables, removes the operations of unknown peers.
+        Runs in the executor.
+        :return: int: the amount of the removed operations
+        """
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode = WAL')
+            cursor = db.execute(
+                f'DELETE FROM ops WHERE peer NOT IN '
+                f'({", ".join("?" * len(self.peers))})', self.peers)
+            return cursor.rowcount
+
+    def _write(self, pending: List[Tuple[str, str, str]]) -> None:
+        """Queues the operations for every peer, replacing the queued ones
+        on the same files. Runs in the executor."""
+        with self._connect() as db:
+            for op, algorithm, file_hash in pending:
+                for peer in self.peers:
+                    db.execute('DELETE FROM ops WHERE peer = ? '
+                               'AND algorithm = ? AND file_hash = ?',
+                               (peer, algorithm, file_hash))
+                    db.execute('INSERT INTO ops (peer, op, algorithm, '
+                               'file_hash, attempts, next_attempt) '
+                               'VALUES (?, ?, ?, ?, 0, 0)',
+                               (peer, op, algorithm, file_hash))
+
+    def _take(self, peer: str, limit: int) -> List[ReplicationOp]:
+        """Reads the due operations. Runs in the executor."""
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT id, peer, op, algorithm, file_hash, attempts '
+                'FROM ops WHERE peer = ? AND next_attempt <= ? '
+                'ORDER BY id LIMIT ?', (peer, time.time(), limit))
+            return [ReplicationOp(*row) for row in rows]
+
+    def _execute(self, query: str, params: List[Tuple]) -> None:
+        """Runs the query for each parameters. Runs in the executor."""
+        with self._connect() as db:
+            db.executemany(query, params)
+
+    def _count(self, peer: str) -> int:
+        """Counts the operations of the peer. Runs in the executor."""
+        with self._connect() as db:
+            count, = db.execute('SELECT COUNT(*) FROM ops WHERE peer = ?',
+                                (peer,)).fetchone()
+            return count
+
+    def _is_deleted(self, algorithm: str, file_hash: str) -> bool:
+        """Looks for the deletion of the file. Runs in the executor."""
+        with self._connect() as db:
+            row = db.execute('SELECT 1 FROM ops WHERE op = ? '
+                             'AND algorithm = ? AND file_hash = ? LIMIT 1',
+                             (OP_DELETE, algorithm, file_hash)).fetchone()
+            return row is not None
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+from http import HTTPStatus
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, hdrs
+from aiohttp.web_request import Request
+
+from file_loader.api.file_manager import EmptyFileError, FileManager, \
+    HashMismatchError, RawBodyReader
+from file_loader.replication.journal import OP_SAVE, ReplicationJournal, \
+    ReplicationOp
+from file_loader.storage.hashing import DEFAULT_ALGORITHM
+
+logger = logging.getLogger(__name__)
+
+# Marks the requests of the replicator, the peer doesn't replicate
+# the changes they make and doesn't repair the files they miss
+REPLICA_HEADER = 'X-File-Loader-Replica'
+
+# The journal is checked this often for the operations added by other
+# processes and for the retried ones
+POLL_INTERVAL = 1.0
+# The max amount of the operations sent to the peer at once, the deletes
+# of them are sent by one batch request
+BATCH_SIZE = 64
+PEER_TIMEOUT = ClientTimeout(total=None, sock_connect=5.0, sock_read=60.0)
+
+
+def get_replication(request: Request) -> Optional[ReplicationJournal]:
+    """
+    Returns the journal the changes of the request are replicated by,
+    the changes received from the peers are not replicated again
+    """
+    if REPLICA_HEADER in request.headers:
+        return None
+    return request.app['replication_journal']
+
+
+class Replicator:
+    """Sends the operations of the journal to the peers in the background,
+    each peer by its own loop. Saved files are sent by PUT requests up to
+    the concurrency at once, deleted ones by batch requests. The failed
+    operations are retried with backoff until the peer accepts them.
+    The files missing in the store are repaired from the peers when they
+    are read.
+
+    :param journal: the journal of the operations
+    :param create_file_manager: creates the file manager of the hash
+    algorithm, the changes it makes are not replicated
+    :param concurrency: the amount of files sent to each peer at once
+    """
+
+    def __init__(self, journal: ReplicationJournal,
+                 create_file_manager: Callable[[str], FileManager],
+                 concurrency: int = 4):
+        self.journal = journal
+        self.create_file_manager = create_file_manager
+        self.concurrency = concurrency
+        self.session: Optional[ClientSession] = None
+        # The amount of the operations queued for each peer
+        self.pending: Dict[str, int] = {peer: 0 for peer in journal.peers}
+        self.stats = {'sent': 0, 'failed': 0, 'repaired': 0}
+        self._tasks: List[asyncio.Task] = []
+        self._repairs: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def open(self, send: bool = True) -> None:
+        """Opens the connections to the peers
+            :param send: the operations of the journal are sent, only one
+            process of the deployment should send them
+            """
+        self.session = ClientSession(timeout=PEER_TIMEOUT)
+        if send:
+            self._tasks = [asyncio.ensure_future(self._replicate_to(peer))
+                           for peer in self.journal.peers]
+
+    async def close(self) -> None:
+        """Stops sending, the operations being sent stay in the journal"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._repairs.values(),
+                             return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    async def repair(self, algorithm: str, file_hash: str) -> bool:
+        """Fetches the file missing in the store from the peers and saves
+        it, the file read by many requests at once is fetched once
+            :param algorithm: the name of the hash algorithm of the file
+            :param file_hash: hash of the file
+            :return: bool: true when the file is saved
+            """
+        key = (algorithm, file_hash)
+        repair = self._repairs.get(key)
+        if repair is None:
+            repair = self._repairs[key] = asyncio.ensure_future(
+                self._repair(algorithm, file_hash))
+            repair.add_done_callback(lambda _: self._repairs.pop(key, None))
+        return await asyncio.shield(repair)
+
+    async def _repair(self, algorithm: str, file_hash: str) -> bool:
+        # The file deleted here may not be deleted on the peers yet
+        if await self.journal.is_deleted(algorithm, file_hash):
+            return False
+
+        file_manager = self.create_file_manager(algorithm)
+        for peer in self.journal.peers:
+            try:
+                async with self.session.get(
+                        self._get_file_url(peer, algorithm, file_hash),
+                        headers={REPLICA_HEADER: '1',
+                                 hdrs.ACCEPT_ENCODING: 'identity'}) \
+                        as response:
+                    if response.status != HTTPStatus.OK:
+                        continue
+                    await file_manager.save_file(
+                        RawBodyReader(response.content),
+                        expected_hash=file_hash,
+                        size=response.content_length)
+            except (ClientError, asyncio.TimeoutError, EmptyFileError,
+                    HashMismatchError) as e:
+                logger.warning('File with hash %s was not fetched from %s: '
+                               '%r', file_hash, peer, e)
+                continue
+
+            self.stats['repaired'] += 1
+            logger.info('File with hash %s was repaired from %s',
+                        file_hash, peer)
+            return True
+
+        return False
+
+    async def _replicate_to(self, peer: str) -> None:
+        """Sends the operations of the peer while the replicator is open"""
+        while True:
+            # The operations added while sending are not waited for
+            self.journal.added.clear()
+            try:
+                ops = await self.journal.take(peer, BATCH_SIZE)
+                if ops:
+                    await self._send(peer, ops)
+                self.pending[peer] = await self.journal.count(peer)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Replication to %s failed', peer)
+                ops = []
+
+            if len(ops) < BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self.journal.added.wait(),
+                                           POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send(self, peer: str, ops: List[ReplicationOp]) -> None:
+        """Sends the operations, completes the accepted ones and retries
+        the failed ones"""
+        slots = asyncio.Semaphore(self.concurrency)
+        deletes: Dict[str, List[ReplicationOp]] = {}
+        # The operations sent by each request
+        groups = []
+        sends = []
+        for op in ops:
+            if op.op == OP_SAVE:
+                groups.append([op])
+                sends.append(self._send_save(peer, op, slots))
+            else:
+                deletes.setdefault(op.algorithm, []).append(op)
+        for algorithm, algorithm_ops in deletes.items():
+            groups.append(algorithm_ops)
+            sends.append(self._send_deletes(peer, algorithm, algorithm_ops))
+
+        results = await asyncio.gather(*sends)
+        sent = [op for group, is_sent in zip(groups, results) if is_sent
+                for op in group]
+        failed = [op for group, is_sent in zip(groups, results)
+                  if not is_sent for op in group]
+        self.stats['sent'] += len(sent)
+        self.stats['failed'] += len(failed)
+        await self.journal.complete(sent)
+        await self.journal.retry(failed)
+
+    async def _send_save(self, peer: str, op: ReplicationOp,
+                         slots: asyncio.Semaphore) -> bool:
+        """Sends the saved file decompressed, the peer stores it with its
+        own compression and skips the body when it has the file
+            :return: bool: false when it should be retried
+            """
+        file_manager = self.create_file_manager(op.algorithm)
+        try:
+            info = await file_manager.get_file_info(op.file_hash)
+            read_file = await file_manager.get_file_reader(op.file_hash,
+                                                           decode=True)
+        except FileNotFoundError:
+            # The file is deleted, its deletion is queued after the save
+            return True
+
+        headers = {REPLICA_HEADER: '1',
+                   hdrs.CONTENT_TYPE: 'application/octet-stream'}
+        if info.encoding is None:
+            headers[hdrs.CONTENT_LENGTH] = str(info.size)
+
+        async with slots:
+            try:
+                async with self.session.put(
+                        self._get_file_url(peer, op.algorithm, op.file_hash),
+                        data=read_file(), headers=headers,
+                        expect100=True) as response:
+                    status = response.status
+                    text = await response.text()
+            except (ClientError, asyncio.TimeoutError, OSError) as e:
+                logger.warning('File with hash %s was not sent to %s: %r',
+                               op.file_hash, peer, e)
+                return False
+
+        if status in (HTTPStatus.OK, HTTPStatus.CREATED):
+            return True
+        if status == HTTPStatus.BAD_REQUEST:
+            # The stored file is corrupt or the peer can't store it,
+            # repeating won't help
+            logger.error('Peer %s rejected file with hash %s: %s', peer,
+                         op.file_hash, text)
+            return True
+        logger.warning('Peer %s failed to save file with hash %s: %d',
+                       peer, op.file_hash, status)
+        return False
+
+    async def _send_deletes(self, peer: str, algorithm: str,
+                            ops: List[ReplicationOp]) -> bool:
+        """Deletes the files of the algorithm on the peer by one batch
+        request, the files the peer doesn't have are skipped
+            :return: bool: false when it should be retried
+            """
+        try:
+            async with self.session.post(
+                    f'{peer}/files/batch/delete',
+                    json={'hashes': [op.file_hash for op in ops],
+                          'hash_algorithm': algorithm},
+                    headers={REPLICA_HEADER: '1'}) as response:
+                status = response.status
+                await response.read()
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning('Deletes of %d files were not sent to %s: %r',
+                           len(ops), peer, e)
+            return False
+
+        if status != HTTPStatus.MULTI_STATUS:
+            logger.warning('Peer %s failed to delete %d files: %d', peer,
+                           len(ops), status)
+            return False
+        return True
+
+    @staticmethod
+    def _get_file_url(peer: str, algorithm: str, file_hash: str) -> str:
+        if algorithm == DEFAULT_ALGORITHM:
+            return f'{peer}/files/{file_hash}'
+        return f'{peer}/files/{algorithm}/{file_hash}'
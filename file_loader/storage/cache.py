@@ -0,0 +1,79 @@
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """In-memory LRU cache of the content of small files. The total size of
+    cached files is limited, the least recently used ones are evicted.
+    The content of the stored file never changes, so the entries are only
+    invalidated when the file is deleted.
+    :param max_size: the maximum total size of cached files in bytes
+    :param max_file_size: files larger than this are never cached
+    """
+
+    def __init__(self, max_size: int, max_file_size: int = 64 * 1024):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files: 'OrderedDict[Path, bytes]' = OrderedDict()
+
+    def get(self, file_path: Path) -> Optional[bytes]:
+        """Returns the content of the cached file
+            :param file_path: path of the file in the store
+            :return: bytes: content of the file, None if it's not cached
+            """
+        content = self._files.get(file_path)
+        if content is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._files.move_to_end(file_path)
+        return content
+
+    def put(self, file_path: Path, content: bytes) -> None:
+        """Caches the content of the file, evicts the least recently used
+        files to fit in the size limit
+            :param file_path: path of the file in the store
+            :param content: content of the file
+            """
+        if len(content) > self.max_file_size or len(content) > self.max_size:
+            return
+
+        self.invalidate(file_path)
+        while self.size + len(content) > self.max_size:
+            _, evicted = self._files.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+        self._files[file_path] = content
+        self.size += len(content)
+
+    def invalidate(self, file_path: Path) -> None:
+        """Removes the file from the cache
+            :param file_path: path of the file in the store
+            """
+        content = self._files.pop(file_path, None)
+        if content is not None:
+            self.size -= len(content)
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    @property
+    def stats(self) -> Mapping[str, int]:
+        """Counters of the cache usage"""
+        return {
+            'files': len(self._files),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
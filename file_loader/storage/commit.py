@@ -0,0 +1,370 @@
+import asyncio
+import errno
+import logging
+import os
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Union
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# Files are linked into the store without waiting for the disk
+DURABILITY_NONE = 'none'
+# Files and directories are synced to the disk before the upload is
+# acknowledged, syncs of concurrent uploads are batched into group commits
+DURABILITY_GROUP = 'group'
+# Each file is synced to the disk on its own
+DURABILITY_SYNC = 'sync'
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_GROUP, DURABILITY_SYNC)
+
+TMP_PREFIX = 'id'
+# Errors of the file systems which can't create anonymous files
+TMPFILE_ERRORS = (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL)
+PROC_FDS = '/proc/self/fd'
+
+
+class GroupCommit:
+    """Syncs the committed files and their directories to the disk.
+    The syncs requested while the previous batch is being synced are
+    batched and done by one pass in the executor, so one disk flush
+    commits many concurrent uploads.
+
+    :param durability: the durability level, nothing is synced when it's
+    none, each file is synced on its own when it's sync
+    :param max_delay: seconds the batch waits for more files to commit
+    :param executor: the executor syncing files, the default one if None
+    """
+
+    def __init__(self, durability: str = DURABILITY_GROUP,
+                 max_delay: float = 0.0,
+                 executor: Optional[Executor] = None):
+        self.durability = durability
+        self.max_delay = max_delay
+        self.executor = executor
+        self.batches = 0
+        self.synced = 0
+        self._files: Dict[int, asyncio.Future] = {}
+        self._dirs: Dict[Path, asyncio.Future] = {}
+        self._flushing: Optional[asyncio.Task] = None
+
+    async def sync_file(self, fd: int) -> None:
+        """Waits until the data of the file is on the disk
+            :param fd: the descriptor of the file open for writing
+            """
+        if self.durability == DURABILITY_NONE:
+            return
+
+        if self.durability == DURABILITY_SYNC:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.executor, os.fsync, fd)
+            return
+
+        waiter = self._files.get(fd)
+        if waiter is None:
+            loop = asyncio.get_event_loop()
+            waiter = self._files[fd] = loop.create_future()
+        await self._wait(waiter)
+
+    async def sync_dirs(self, dir_paths: Set[Path]) -> None:
+        """Waits until the entries of the directories are on the disk
+            :param dir_paths: the directories the files were linked into
+            """
+        if self.durability == DURABILITY_NONE:
+            return
+
+        if self.durability == DURABILITY_SYNC:
+            loop = asyncio.get_event_loop()
+            errors = await loop.run_in_executor(
+                self.executor, self._sync_batch, [], list(dir_paths))
+            for error in errors.values():
+                raise error
+            return
+
+        loop = asyncio.get_event_loop()
+        waiters = []
+        for dir_path in dir_paths:
+            waiter = self._dirs.get(dir_path)
+            if waiter is None:
+                waiter = self._dirs[dir_path] = loop.create_future()
+            waiters.append(waiter)
+
+        for waiter in waiters:
+            await self._wait(waiter)
+
+    async def close(self) -> None:
+        """Waits for the batch being synced"""
+        if self._flushing is not None:
+            await self._flushing
+        logger.info('Group commit synced %d files and directories by %d '
+                    'batches', self.synced, self.batches)
+
+    async def _wait(self, waiter: asyncio.Future) -> None:
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        # The batch is synced even if the waiting upload is cancelled
+        await asyncio.shield(waiter)
+
+    async def _flush(self) -> None:
+        """Syncs the batches while there are files to sync"""
+        loop = asyncio.get_event_loop()
+        while self._files or self._dirs:
+            if self.max_delay:
+                await asyncio.sleep(self.max_delay)
+
+            files, self._files = self._files, {}
+            dirs, self._dirs = self._dirs, {}
+            errors = await loop.run_in_executor(
+                self.executor, self._sync_batch, list(files), list(dirs))
+
+            self.batches += 1
+            self.synced += len(files) + len(dirs)
+            for key, waiter in (*files.items(), *dirs.items()):
+                if waiter.done():
+                    continue
+                if key in errors:
+                    waiter.set_exception(errors[key])
+                else:
+                    waiter.set_result(None)
+
+    @staticmethod
+    def _sync_batch(fds: List[int], dir_paths: List[Path]) -> Dict:
+        """Syncs the files, then the directories. Runs in the executor.
+        :return: dict: the errors of the files and directories failed to
+        sync
+        """
+        errors = {}
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                errors[fd] = e
+
+        for dir_path in dir_paths:
+            try:
+                dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError as e:
+                errors[dir_path] = e
+
+        return errors
+
+
+class StagedFile:
+    """The file written before it's committed into the store. It's
+    an anonymous file (O_TMPFILE) linked into the store on commit, so
+    the aborted upload leaves nothing behind. Where anonymous files are
+    not supported, it's the temporary file in the directory of the store
+    removed when the upload is aborted. The small file is held in memory
+    until it exceeds the spool size, it may be stored without the file.
+
+    :param path_store: directory of the store
+    :param size: the expected size of the file, the space is preallocated
+    when it's known
+    :param spool_size: the file is created when the written data exceeds
+    this size
+    :param executor: the executor doing the file operations, the default
+    one if None
+    """
+
+    def __init__(self, path_store: Path, size: Optional[int] = None,
+                 spool_size: int = 0, executor: Optional[Executor] = None):
+        self.path_store = path_store
+        self.size = size
+        self.spool_size = spool_size
+        self.executor = executor
+        self.written = 0
+        self.fd: Optional[int] = None
+        self.path_tmp: Optional[Path] = None
+        self._spooled: List[bytes] = []
+        self._preallocated = False
+
+    @property
+    def spooled(self) -> bool:
+        """The data is held in memory, the file has not been created"""
+        return self.fd is None
+
+    def getvalue(self) -> bytes:
+        """Returns the data held in memory"""
+        return b''.join(self._spooled)
+
+    async def __aenter__(self) -> 'StagedFile':
+        if not self.spool_size or (self.size or 0) > self.spool_size:
+            await self._create()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._close)
+
+    async def write(self, data: bytes) -> int:
+        """Writes the data to the end of the file
+            :return: int: the amount of written bytes
+            """
+        if not data:
+            return 0
+
+        if self.fd is None:
+            if self.written + len(data) <= self.spool_size:
+                self._spooled.append(data)
+                self.written += len(data)
+                return len(data)
+            await self._create()
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._write, data)
+        self.written += len(data)
+        return len(data)
+
+    async def commit(self, file_path: Path,
+                     group_commit: Optional[GroupCommit] = None) -> bool:
+        """Links the file into the store, the missing directories are
+        created. The file and the directories are synced to the disk by
+        the group commit before the file is acknowledged.
+            :param file_path: path of the file in the store
+            :param group_commit: syncs the file to the disk
+            :return: bool: false when the file already exists
+            """
+        if self.fd is None:
+            await self._create()
+
+        loop = asyncio.get_event_loop()
+        if self._preallocated and self.written != self.size:
+            await loop.run_in_executor(self.executor, os.ftruncate,
+                                       self.fd, self.written)
+
+        if group_commit is not None:
+            # The data is on the disk before the file is visible
+            await group_commit.sync_file(self.fd)
+
+        try:
+            created = await loop.run_in_executor(self.executor, self._link,
+                                                 file_path)
+        except FileExistsError:
+            return False
+
+        if group_commit is not None:
+            await group_commit.sync_dirs({
+                file_path.parent, *(path.parent for path in created)})
+        return True
+
+    async def _create(self) -> None:
+        """Creates the file, the data held in memory is written to it"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._open)
+        if self._spooled:
+            await loop.run_in_executor(self.executor, self._write,
+                                       self.getvalue())
+            self._spooled.clear()
+
+    def _open(self) -> None:
+        """Creates the file. Runs in the executor."""
+        if hasattr(os, 'O_TMPFILE'):
+            try:
+                self.fd = os.open(self.path_store,
+                                  os.O_TMPFILE | os.O_WRONLY, 0o666)
+            except OSError as e:
+                if e.errno not in TMPFILE_ERRORS:
+                    raise
+
+        if self.fd is None:
+            self.path_tmp = self.path_store / f'{TMP_PREFIX}{uuid4()}'
+            self.fd = os.open(self.path_tmp,
+                              os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+
+        if self.size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+                self._preallocated = True
+            except OSError as e:
+                logger.debug('Space of %d bytes is not preallocated: %r',
+                             self.size, e)
+
+    def _write(self, data: bytes) -> None:
+        """Writes all the data. Runs in the executor."""
+        write_all(self.fd, data)
+
+    def _link(self, file_path: Path) -> List[Path]:
+        """Links the file into the store. Runs in the executor.
+        :return: list: the directories created for the file
+        :raise FileExistsError: the file already exists
+        """
+        if self.path_tmp is not None:
+            return link_file(self.path_tmp, file_path)
+
+        # The descriptor is linked by its /proc entry, linkat() with
+        # AT_EMPTY_PATH needs CAP_DAC_READ_SEARCH
+        proc_fds = os.open(PROC_FDS, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            return link_file(str(self.fd), file_path, src_dir_fd=proc_fds)
+        finally:
+            os.close(proc_fds)
+
+    def _close(self) -> None:
+        """Closes the file, the temporary file is removed. Runs in
+        the executor."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        if self.path_tmp is not None:
+            try:
+                os.remove(self.path_tmp)
+            except FileNotFoundError:
+                pass
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """Writes all the data to the descriptor, the write may be short
+    (e.g. interrupted by a signal or the disk is almost full)
+    :param fd: the descriptor of the file open for writing
+    :param data: the written data
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def link_file(source: Union[Path, str], file_path: Path,
+              src_dir_fd: Optional[int] = None) -> List[Path]:
+    """Links the file into the store, the missing directories are created
+    :param source: the path of the linked file
+    :param file_path: path of the file in the store
+    :param src_dir_fd: the directory the source path is relative to
+    :return: list: the directories created for the file
+    :raise FileExistsError: the file already exists
+    """
+    try:
+        os.link(source, file_path, src_dir_fd=src_dir_fd)
+        return []
+    except FileNotFoundError:
+        created = _make_dirs(file_path.parent)
+        if not created:
+            # The linked file is missing
+            raise
+
+    os.link(source, file_path, src_dir_fd=src_dir_fd)
+    return created
+
+
+def _make_dirs(dir_path: Path) -> List[Path]:
+    """Creates the directory and its missing parents
+    :return: list: the created directories
+    """
+    missing = []
+    while not dir_path.exists():
+        missing.append(dir_path)
+        dir_path = dir_path.parent
+
+    created = []
+    for dir_path in reversed(missing):
+        try:
+            dir_path.mkdir()
+        except FileExistsError:
+            continue
+        created.append(dir_path)
+
+    return created
@@ -0,0 +1,126 @@
+import asyncio
+import zlib
+from concurrent.futures import Executor
+from typing import Callable, Dict, NamedTuple, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_OFF = 'off'
+# The file is stored compressed only when the sample of its first chunk
+# shrinks at least by this ratio
+MIN_RATIO = 0.9
+SAMPLE_SIZE = 16 * 1024
+# Smaller chunks are (de)compressed on the event loop, the executor hop
+# costs more than processing them
+INLINE_SIZE = 16 * 1024
+
+
+class Encoding(NamedTuple):
+    """Encoding of the files stored compressed
+    :param name: the name of the encoding in Content-Encoding header
+    :param suffix: the suffix of the name of the stored file
+    :param compressor: creates the compressor by the compression level,
+    the compressor has compress() and flush() methods
+    :param decompressor: creates the decompressor which has decompress()
+    and flush() methods
+    """
+    name: str
+    suffix: str
+    compressor: Callable
+    decompressor: Callable
+
+
+ENCODINGS: Dict[str, Encoding] = {
+    'gzip': Encoding(
+        'gzip', '.gz',
+        lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+        lambda: zlib.decompressobj(31)),
+}
+
+if zstandard is not None:
+    ENCODINGS['zstd'] = Encoding(
+        'zstd', '.zst',
+        lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+        lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def get_encoding(name: str) -> Encoding:
+    """Returns the encoding by name
+    :raise KeyError: the encoding is unknown or its package is not
+    installed
+    """
+    return ENCODINGS[name.lower()]
+
+
+def accepts_encoding(accept_encoding: Optional[str], name: str) -> bool:
+    """Checks that the client accepts the encoding (RFC 7231)
+    :param accept_encoding: value of the Accept-Encoding header
+    :param name: the name of the encoding
+    """
+    if not accept_encoding:
+        return False
+
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        coding, *params = coding.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    quality = qualities.get(name, qualities.get('*', 0.0))
+    return quality > 0
+
+
+class StreamCoder:
+    """Compresses or decompresses the stream chunk by chunk, large chunks
+    are processed in the executor, zlib and zstd release the GIL
+    :param coder: the compressor or decompressor object
+    :param executor: the executor, the default one if None
+    """
+
+    def __init__(self, coder, executor: Optional[Executor] = None):
+        self.coder = coder
+        self.executor = executor
+        self._process = getattr(coder, 'compress', None) \
+            or getattr(coder, 'decompress')
+
+    @classmethod
+    def compressor(cls, encoding: Encoding, level: int,
+                   executor: Optional[Executor] = None) -> 'StreamCoder':
+        return cls(encoding.compressor(level), executor)
+
+    @classmethod
+    def decompressor(cls, encoding: Encoding,
+                     executor: Optional[Executor] = None) -> 'StreamCoder':
+        return cls(encoding.decompressor(), executor)
+
+    async def process(self, chunk: bytes) -> bytes:
+        """Passes the chunk through the coder"""
+        if len(chunk) <= INLINE_SIZE:
+            return self._process(chunk)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._process,
+                                          chunk)
+
+    def flush(self) -> bytes:
+        """Returns the rest of the output"""
+        return self.coder.flush()
+
+
+def is_compressible(encoding: Encoding, level: int, sample: bytes) -> bool:
+    """Checks by the sample of the file that it is worth storing it
+    compressed"""
+    sample = sample[:SAMPLE_SIZE]
+    compressor = encoding.compressor(level)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed <= len(sample) * MIN_RATIO
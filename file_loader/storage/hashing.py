@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import Executor
+from typing import Callable, Dict, NamedTuple, Optional
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_ALGORITHM = 'md5'
+# The data is passed to the executor by large buffers, hashlib releases
+# the GIL while it hashes them
+BATCH_SIZE = 1024 * 1024
+# Smaller buffers are hashed on the event loop, the executor hop costs
+# more than hashing them
+INLINE_SIZE = 16 * 1024
+
+
+class HashAlgorithm(NamedTuple):
+    """Algorithm of content hashing
+    :param name: the name used in the URL and the store layout
+    :param factory: creates a new hash object with update() and
+    hexdigest() methods
+    :param hex_length: the length of the hexadecimal digest
+    """
+    name: str
+    factory: Callable
+    hex_length: int
+
+
+ALGORITHMS: Dict[str, HashAlgorithm] = {
+    algorithm.name: algorithm for algorithm in (
+        HashAlgorithm('md5', hashlib.md5, 32),
+        HashAlgorithm('sha1', hashlib.sha1, 40),
+        HashAlgorithm('sha256', hashlib.sha256, 64),
+        HashAlgorithm('blake2b', hashlib.blake2b, 128),
+    )
+}
+
+if xxhash is not None:
+    ALGORITHMS.update({
+        'xxh64': HashAlgorithm('xxh64', xxhash.xxh64, 16),
+        'xxh3_128': HashAlgorithm('xxh3_128', xxhash.xxh3_128, 32),
+    })
+
+
+def get_algorithm(name: str) -> HashAlgorithm:
+    """Returns the hash algorithm by name
+    :raise KeyError: the algorithm is unknown or its package is not
+    installed
+    """
+    return ALGORITHMS[name.lower()]
+
+
+class Hasher:
+    """Calculates the digest of the stream off the event loop. Chunks are
+    joined into batches which are hashed in the executor
+    :param algorithm: the hash algorithm
+    :param executor: the executor for hashing, the default one if None
+    :param batch_size: the size of data passed to the executor at once
+
+    Attributes:
+        hashed -- the amount of hashed bytes
+        hash_time -- seconds spent hashing them
+    """
+
+    def __init__(self, algorithm: HashAlgorithm,
+                 executor: Optional[Executor] = None,
+                 batch_size: int = BATCH_SIZE):
+        self.algorithm = algorithm
+        self.executor = executor
+        self.batch_size = batch_size
+        self._hash = algorithm.factory()
+        self._buffer = []
+        self._buffered = 0
+        self.hashed = 0
+        self.hash_time = 0.0
+
+    async def update(self, chunk: bytes) -> None:
+        """Adds the chunk to the digest, hashes the batch when it's full"""
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Hashes the buffered chunks"""
+        if not self._buffered:
+            return
+
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+
+        if len(data) <= INLINE_SIZE:
+            self._update(data)
+            return
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._update, data)
+
+    async def hexdigest(self) -> str:
+        """Returns the digest of all passed chunks"""
+        await self.flush()
+        return self._hash.hexdigest()
+
+    def _update(self, data: bytes) -> None:
+        started = time.perf_counter()
+        self._hash.update(data)
+        self.hash_time += time.perf_counter() - started
+        self.hashed += len(data)
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROOT = '.'
+DB_NAME = 'index.sqlite3'
+
+INDEX_MEMORY = 'memory'
+INDEX_PERSISTENT = 'persistent'
+INDEX_OFF = 'off'
+INDEX_MODES = (INDEX_MEMORY, INDEX_PERSISTENT, INDEX_OFF)
+
+
+class FileRecord:
+    """Metadata of the stored file
+    :param size: size of the file in bytes
+    :param mtime: timestamp of the last modification of the file
+    :param last_access: timestamp of the last read of the file
+    """
+    __slots__ = ('size', 'mtime', 'last_access')
+
+    def __init__(self, size: int, mtime: float,
+                 last_access: Optional[float] = None):
+        self.size = size
+        self.mtime = mtime
+        self.last_access = mtime if last_access is None else last_access
+
+
+class DirRecord:
+    """Content of the directory of the store
+    :param mtime_ns: modification time of the directory when its content
+    was indexed, the directory is not listed again while it's the same
+    """
+    __slots__ = ('mtime_ns', 'files', 'subdirs')
+
+    def __init__(self, mtime_ns: int = 0):
+        self.mtime_ns = mtime_ns
+        self.files: Dict[str, FileRecord] = {}
+        self.subdirs: Set[str] = set()
+
+
+class StorageIndex:
+    """In-memory index of the files of the store, serves existence checks
+    and metadata without touching the disk. The index is built by
+    the parallel scan of the store, the directories are listed in
+    the executor at the same time.
+
+    :param path_store: directory of the store
+    :param authoritative: the index is changed by the only process,
+    files missing in the index are missing on the disk. When several
+    processes share the store, misses have to be checked on the disk
+    :param persistent: the index is saved to the store on close and
+    loaded on open, only changed directories are listed again
+    :param excluded: names of the entries in the root of the store which
+    are not part of the store layout
+    """
+
+    def __init__(self, path_store: Path, authoritative: bool = True,
+                 persistent: bool = False, excluded: Iterable[str] = ()):
+        self.path_store = path_store
+        self.authoritative = authoritative
+        self.persistent = persistent
+        self.excluded = set(excluded)
+        self.db_path = path_store / DB_NAME
+        self.dirs: Dict[str, DirRecord] = {}
+
+    def get(self, file_path: Path) -> Optional[FileRecord]:
+        """Returns the metadata of the file
+            :param file_path: path of the file in the store
+            :return: FileRecord: metadata of the file, None when the file
+            is not indexed
+            """
+        directory = self.dirs.get(self._get_dir_key(file_path.parent))
+        if directory is None:
+            return None
+
+        return directory.files.get(file_path.name)
+
+    def add(self, file_path: Path, size: int,
+            mtime: Optional[float] = None) -> FileRecord:
+        """Adds the file saved to the store
+            :param file_path: path of the file in the store
+            :param size: size of the file in bytes
+            :param mtime: modification time of the file, now if None
+            :return: FileRecord: metadata of the file
+            """
+        record = FileRecord(size, time.time() if mtime is None else mtime)
+        directory = self._add_dir(self._get_dir_key(file_path.parent))
+        directory.files[file_path.name] = record
+        return record
+
+    def remove(self, file_path: Path) -> None:
+        """Removes the file deleted from the store
+            :param file_path: path of the file in the store
+            """
+        directory = self.dirs.get(self._get_dir_key(file_path.parent))
+        if directory is not None:
+            directory.files.pop(file_path.name, None)
+
+    def remove_dir(self, dir_path: Path) -> None:
+        """Removes the directory deleted from the store
+            :param dir_path: path of the directory
+            """
+        key = self._get_dir_key(dir_path)
+        self._remove_dir(key)
+        parent, _, name = key.rpartition('/')
+        directory = self.dirs.get(parent or ROOT)
+        if directory is not None:
+            directory.subdirs.discard(name)
+
+    def touch(self, file_path: Path) -> None:
+        """Marks the file as read now
+            :param file_path: path of the file in the store
+            """
+        record = self.get(file_path)
+        if record is not None:
+            record.last_access = time.time()
+
+    def has_dir(self, dir_path: Path) -> bool:
+        """Checks that the directory of the store exists
+            :param dir_path: path of the directory
+            """
+        return self._get_dir_key(dir_path) in self.dirs
+
+    def __len__(self) -> int:
+        return sum(len(directory.files) for directory in self.dirs.values())
+
+    @property
+    def total_size(self) -> int:
+        """The size of all indexed files in bytes"""
+        return sum(record.size for _, record in self.iter_files())
+
+    def iter_files(self) -> Iterator[Tuple[Path, FileRecord]]:
+        """Iterates over the paths and metadata of all indexed files"""
+        for key, directory in self.dirs.items():
+            dir_path = self.path_store / key
+            for name, record in directory.files.items():
+                yield dir_path / name, record
+
+    async def open(self) -> None:
+        """Builds the index: loads the saved one and lists the changed
+        directories or scans the whole store"""
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        if self.persistent:
+            self.dirs = await loop.run_in_executor(None, self._load)
+
+        await self._refresh(ROOT)
+        logger.info('Storage index contains %d files, built in %.3f s',
+                    len(self), time.monotonic() - started)
+
+    async def close(self) -> None:
+        """Saves the index when it's persistent"""
+        if not self.persistent:
+            return
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._save)
+        logger.info('Storage index of %d files saved to %s',
+                    len(self), self.db_path)
+
+    async def _refresh(self, key: str) -> None:
+        """Lists the directory when it has changed since it was indexed,
+        then refreshes its subdirectories at the same time"""
+        loop = asyncio.get_event_loop()
+        indexed = self.dirs.get(key)
+        try:
+            directory = await loop.run_in_executor(
+                None, self._refresh_dir, key, indexed)
+        except FileNotFoundError:
+            self._remove_dir(key)
+            return
+
+        if indexed is not None:
+            for name in indexed.subdirs - directory.subdirs:
+                self._remove_dir(self._join_key(key, name))
+
+        self.dirs[key] = directory
+        await asyncio.gather(*(
+            self._refresh(self._join_key(key, name))
+            for name in directory.subdirs
+        ))
+
+    def _refresh_dir(self, key: str, directory: Optional[DirRecord]) \
+            -> DirRecord:
+        """Lists the directory if it has changed, stats only new files.
+        Runs in the executor.
+        """
+        dir_path = self.path_store / key
+        mtime_ns = dir_path.stat().st_mtime_ns
+        if directory is not None and directory.mtime_ns == mtime_ns:
+            return directory
+
+        old_files = directory.files if directory is not None else {}
+        directory = DirRecord(mtime_ns)
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if key == ROOT and entry.name in self.excluded:
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    directory.subdirs.add(entry.name)
+                elif key != ROOT and entry.is_file(follow_symlinks=False):
+                    # The content of the stored file never changes
+                    record = old_files.get(entry.name)
+                    if record is None:
+                        stat = entry.stat(follow_symlinks=False)
+                        record = FileRecord(stat.st_size, stat.st_mtime)
+                    directory.files[entry.name] = record
+
+        return directory
+
+    def _add_dir(self, key: str) -> DirRecord:
+        directory = self.dirs.get(key)
+        if directory is None:
+            directory = self.dirs[key] = DirRecord()
+            if key != ROOT:
+                parent, _, name = key.rpartition('/')
+                self._add_dir(parent or ROOT).subdirs.add(name)
+
+        return directory
+
+    def _remove_dir(self, key: str) -> None:
+        directory = self.dirs.pop(key, None)
+        if directory is None:
+            return
+
+        for name in directory.subdirs:
+            self._remove_dir(self._join_key(key, name))
+
+    def _get_dir_key(self, dir_path: Path) -> str:
+        return dir_path.relative_to(self.path_store).as_posix()
+
+    @staticmethod
+    def _join_key(key: str, name: str) -> str:
+        return name if key == ROOT else f'{key}/{name}'
+
+    def _load(self) -> Dict[str, DirRecord]:
+        """Loads the saved index. Runs in the executor."""
+        dirs = {}
+        if not self.db_path.exists():
+            return dirs
+
+        with sqlite3.connect(str(self.db_path)) as db:
+            self._create_tables(db)
+            for key, mtime_ns in db.execute('SELECT key, mtime_ns FROM dirs'):
+                dirs[key] = DirRecord(mtime_ns)
+
+            for key, name, size, mtime, last_access in db.execute(
+                    'SELECT dir, name, size, mtime, last_access FROM files'):
+                directory = dirs.get(key)
+                if directory is not None:
+                    directory.files[name] = FileRecord(size, mtime,
+                                                       last_access)
+
+        for key in dirs:
+            if key != ROOT:
+                parent, _, name = key.rpartition('/')
+                if (parent or ROOT) in dirs:
+                    dirs[parent or ROOT].subdirs.add(name)
+
+        return dirs
+
+    def _save(self) -> None:
+        """Saves the index. Runs in the executor."""
+        rows = []
+        for key, directory in self.dirs.items():
+            mtime_ns = directory.mtime_ns
+            if self.authoritative:
+                # All changes of the directory are known to the index
+                try:
+                    mtime_ns = (self.path_store / key).stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+            rows.append((key, mtime_ns))
+
+        with sqlite3.connect(str(self.db_path)) as db:
+            self._create_tables(db)
+            db.execute('DELETE FROM dirs')
+            db.execute('DELETE FROM files')
+            db.executemany('INSERT INTO dirs VALUES (?, ?)', rows)
+            db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', (
+                (key, name, record.size, record.mtime, record.last_access)
+                for key, directory in self.dirs.items()
+                for name, record in directory.files.items()
+            ))
+
+    @staticmethod
+    def _create_tables(db: sqlite3.Connection) -> None:
+        db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                   'key TEXT PRIMARY KEY, mtime_ns INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS files ('
+                   'dir TEXT, name TEXT, size INTEGER, mtime REAL, '
+                   'last_access REAL, PRIMARY KEY (dir, name))')
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+# The file is read by about this many buffers, larger files by the max
+# buffer size
+READS_PER_FILE = 16
+# The amount of free buffers of each size kept for reuse
+MAX_FREE_BUFFERS = 32
+
+
+class IOEngine:
+    """Does the disk I/O of the store in its own thread pools, reads and
+    writes have separate pools, so a burst of uploads can't stall
+    downloads. Files are read by buffers sized by the file size, the
+    buffers are reused between the reads. When a pool has no threads,
+    its work is done by the default executor of the loop.
+
+    :param read_threads: the amount of threads reading files
+    :param write_threads: the amount of threads writing and syncing files
+    :param min_buffer_size: the size of the buffers reading small files
+    :param max_buffer_size: the size of the buffers reading large files
+    """
+
+    def __init__(self, read_threads: int = 0, write_threads: int = 0,
+                 min_buffer_size: int = MIN_BUFFER_SIZE,
+                 max_buffer_size: int = MAX_BUFFER_SIZE):
+        self.read_threads = read_threads
+        self.write_threads = write_threads
+        self.min_buffer_size = min_buffer_size
+        self.max_buffer_size = max(max_buffer_size, min_buffer_size)
+        self.read_executor: Optional[Executor] = None
+        self.write_executor: Optional[Executor] = None
+        self._free_buffers: Dict[int, List[bytearray]] = {}
+
+    def open(self) -> None:
+        """Starts the thread pools"""
+        if self.read_threads:
+            self.read_executor = ThreadPoolExecutor(
+                self.read_threads, thread_name_prefix='file-loader-read')
+        if self.write_threads:
+            self.write_executor = ThreadPoolExecutor(
+                self.write_threads, thread_name_prefix='file-loader-write')
+
+    async def close(self) -> None:
+        """Waits for the I/O in progress, stops the thread pools"""
+        loop = asyncio.get_event_loop()
+        for executor in (self.read_executor, self.write_executor):
+            if executor is not None:
+                await loop.run_in_executor(None, executor.shutdown)
+        self.read_executor = self.write_executor = None
+        self._free_buffers.clear()
+
+    @property
+    def queue_depths(self) -> Dict[str, int]:
+        """The amount of calls waiting for a thread in each pool, the pool
+        without threads is served by the default executor"""
+        loop = asyncio.get_event_loop()
+        return {
+            'read': get_queue_depth(self.read_executor),
+            'write': get_queue_depth(self.write_executor),
+            # Hashing and the rest of the blocking calls
+            'default': get_queue_depth(
+                getattr(loop, '_default_executor', None)),
+        }
+
+    async def run_read(self, func, *args):
+        """Runs the reading function in the read pool"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.read_executor, func, *args)
+
+    async def run_write(self, func, *args):
+        """Runs the writing function in the write pool"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.write_executor, func, *args)
+
+    def get_buffer_size(self, file_size: Optional[int] = None) -> int:
+        """Returns the size of the buffers reading the file, the larger
+        the file is the less reads it takes
+            :param file_size: the amount of bytes to read, None when it's
+            unknown
+            """
+        size = self.min_buffer_size
+        if file_size is None:
+            return size
+
+        while size < self.max_buffer_size \
+                and size * READS_PER_FILE < file_size:
+            size *= 2
+        return min(size, self.max_buffer_size)
+
+    async def read_file(self, file_path: Path, offset: int = 0,
+                        length: Optional[int] = None) \
+            -> AsyncIterator[bytes]:
+        """Reads the file from the offset, no more than length bytes if
+        it's passed. The kernel is advised the file is read sequentially
+        and the next chunk is read in the pool while the current one is
+        processed. The chunks are copied out of the reused buffer, they
+        may be kept after the next one is requested, e.g. by a transport.
+            :param file_path: path of the file
+            :param offset: the position of the first byte to read
+            :param length: the amount of bytes to read, till the end of
+            the file if None
+            """
+        file, length = await self.run_read(self._open, file_path, offset,
+                                           length)
+        buffer = self._acquire_buffer(self.get_buffer_size(length))
+        view = memoryview(buffer)
+        reading = self._read_ahead(file, view, length)
+        try:
+            while reading is not None:
+                # The read goes on when the reader is cancelled, the buffer
+                # and the file are in use until it's done
+                chunk = await asyncio.shield(reading)
+                length -= len(chunk)
+                reading = self._read_ahead(file, view, length) \
+                    if chunk else None
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if reading is not None:
+                await asyncio.wait([reading])
+            self._release_buffer(buffer)
+            await self.run_read(file.close)
+
+    async def read_bytes(self, file_path: Path) -> bytes:
+        """Reads the whole small file"""
+        return await self.run_read(file_path.read_bytes)
+
+    def _acquire_buffer(self, size: int) -> bytearray:
+        free = self._free_buffers.get(size)
+        if free:
+            return free.pop()
+        return bytearray(size)
+
+    def _release_buffer(self, buffer: bytearray) -> None:
+        free = self._free_buffers.setdefault(len(buffer), [])
+        if len(free) < MAX_FREE_BUFFERS:
+            free.append(buffer)
+
+    def _read_ahead(self, file, view: memoryview, length: int) \
+            -> Optional[asyncio.Future]:
+        """Starts reading the next chunk in the read pool
+        :return: Future: the chunk, None when nothing is left to read
+        """
+        if length <= 0:
+            return None
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.read_executor, self._read_chunk,
+                                    file, view[:min(length, len(view))])
+
+    def _open(self, file_path: Path, offset: int, length: Optional[int]):
+        """Opens the file for sequential reading from the offset. Runs in
+        the executor.
+        :return: tuple: the file and the amount of bytes to read
+        """
+        file = open(file_path, 'rb', buffering=0)
+        try:
+            size = os.fstat(file.fileno()).st_size
+            length = size - offset if length is None \
+                else min(length, size - offset)
+            advise(file.fileno(), offset, length,
+                   self.get_buffer_size(length))
+            file.seek(offset)
+        except BaseException:
+            file.close()
+            raise
+
+        return file, length
+
+    @staticmethod
+    def _read_chunk(file, view: memoryview) -> bytes:
+        """Reads the file into the buffer and copies the chunk out of it,
+        the kernel is advised to read the next part ahead. Runs in the
+        executor."""
+        size = file.readinto(view)
+        if not size:
+            return b''
+        advise(file.fileno(), file.tell(), 0, len(view))
+        return bytes(view[:size])
+
+
+def get_queue_depth(executor: Optional[Executor]) -> int:
+    """Returns the amount of calls waiting for a thread of the executor,
+    0 when it's unknown"""
+    work_queue = getattr(executor, '_work_queue', None)
+    if work_queue is None:
+        return 0
+    return work_queue.qsize()
+
+
+def advise(fd: int, offset: int, length: int, read_ahead: int) -> None:
+    """Advises the kernel the region of the file is read sequentially and
+    its beginning is read soon, nothing is done where the hints are not
+    supported
+    :param fd: the descriptor of the file
+    :param offset: the position of the region
+    :param length: the length of the region, till the end of the file if 0
+    :param read_ahead: the amount of bytes read soon
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        if length:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, offset, read_ahead, os.POSIX_FADV_WILLNEED)
+    except OSError as e:
+        logger.debug('Reading of the file is not advised: %r', e)
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from file_loader.storage.cache import FileCache
+from file_loader.storage.hashing import ALGORITHMS
+from file_loader.storage.index import StorageIndex
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_FILE = 'layout.json'
+SHARD_PATTERN = re.compile(r'[a-f0-9]+')
+# The stored file is named by the hash of its content, the compressed one
+# has the suffix of its encoding
+FILE_NAME_PATTERN = re.compile(r'([a-f0-9]+)(\.[a-z]+)?')
+# The moved file is unlinked from the old layout after this delay,
+# requests which have found it there before it was moved can open it
+UNLINK_DELAY = 1.0
+
+# The old path, the new path and the stat of the linked file
+LinkedFile = Tuple[Path, Path, os.stat_result]
+
+
+class StoreLayout(NamedTuple):
+    """Layout of the directories of the store, the file is stored in
+    the nested shard directories named by the leading parts of its hash
+    (depth 2, width 2: ab/cd/abcd...)
+    :param depth: the amount of the nested shard directories
+    :param width: the amount of hash characters naming each directory
+    """
+    depth: int = 1
+    width: int = 2
+
+    @property
+    def prefix_length(self) -> int:
+        """The amount of hash characters used by the shard directories"""
+        return self.depth * self.width
+
+    def get_path(self, path_files: Path, file_hash: str,
+                 suffix: str = '') -> Path:
+        """Returns the path of the file in the layout
+            :param path_files: the root directory of the files of the hash
+            algorithm
+            :param file_hash: hash of the file
+            :param suffix: the suffix of the file name
+            """
+        shards = (file_hash[level * self.width:(level + 1) * self.width]
+                  for level in range(self.depth))
+        return path_files.joinpath(*shards, file_hash + suffix)
+
+    def is_shard(self, parts: Sequence[str]) -> bool:
+        """Checks that the directory is a shard directory of the layout
+            :param parts: the path of the directory relative to the root
+            directory of the files
+            """
+        return len(parts) <= self.depth \
+            and all(len(part) == self.width for part in parts)
+
+    def to_dict(self):
+        return {'depth': self.depth, 'width': self.width}
+
+
+# The original fixed layout of the store: ab/abcd...
+DEFAULT_LAYOUT = StoreLayout()
+
+
+def load_layouts(path_store: Path) -> List[StoreLayout]:
+    """Loads the layouts the files of the store may be stored in, the first
+    one is the layout of the new files. The store created before
+    the layout was configurable has the default one.
+    """
+    try:
+        with open(path_store / LAYOUT_FILE) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return [DEFAULT_LAYOUT]
+
+    return [StoreLayout(**layout) for layout in state['layouts']]
+
+
+def save_layouts(path_store: Path, layouts: Iterable[StoreLayout]) -> None:
+    """Saves the layouts the files of the store may be stored in"""
+    path_tmp = path_store / f'{LAYOUT_FILE}.tmp'
+    with open(path_tmp, 'w') as file:
+        json.dump({'layouts': [layout.to_dict() for layout in layouts]},
+                  file)
+    os.replace(path_tmp, path_store / LAYOUT_FILE)
+
+
+class LayoutMigration:
+    """Moves the files of the store into the new layout while the store is
+    served. The file is linked into the new layout before it's unlinked
+    from the old one, so it can always be found by the layouts of
+    the store. The directories are processed one by one in the executor.
+
+    :param path_store: directory of the store
+    :param layout: the layout the files are moved into
+    :param index: the index of the store updated with the moved files
+    :param cache: the memory cache of small files
+    """
+
+    def __init__(self, path_store: Path, layout: StoreLayout,
+                 index: Optional[StorageIndex] = None,
+                 cache: Optional[FileCache] = None):
+        self.path_store = path_store
+        self.layout = layout
+        self.index = index
+        self.cache = cache
+        self.moved = 0
+        self._unlinking: List[Tuple[float, List[LinkedFile]]] = []
+        self._old_dirs: List[Path] = []
+
+    async def run(self) -> int:
+        """Moves all files of the store into the new layout
+            :return: int: the amount of the moved files
+            """
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        roots = [self.path_store]
+        for name in ALGORITHMS:
+            if await loop.run_in_executor(
+                    None, (self.path_store / name).is_dir):
+                roots.append(self.path_store / name)
+
+        for path_files in roots:
+            await self._migrate_dir(path_files, ())
+
+        if self._unlinking:
+            deadline, _ = self._unlinking[-1]
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+            await self._unlink_moved()
+
+        # The subdirectories are removed before their parents
+        for dir_path in self._old_dirs:
+            try:
+                await loop.run_in_executor(None, dir_path.rmdir)
+            except OSError:
+                continue
+            if self.index is not None:
+                self.index.remove_dir(dir_path)
+
+        logger.info('Store was migrated to %r, %d files moved in %.3f s',
+                    self.layout, self.moved, time.monotonic() - started)
+        return self.moved
+
+    async def _migrate_dir(self, path_files: Path,
+                           parts: Tuple[str, ...]) -> None:
+        """Moves the files of the directory into the new layout, then
+        migrates its shard subdirectories"""
+        loop = asyncio.get_event_loop()
+        dir_path = path_files.joinpath(*parts)
+        try:
+            files, subdirs = await loop.run_in_executor(
+                None, self._list_dir, dir_path, not parts)
+        except FileNotFoundError:
+            return
+
+        moves = [
+            (dir_path / name, self.layout.get_path(path_files, file_hash,
+                                                   suffix))
+            for name, file_hash, suffix in files
+            if len(file_hash) > self.layout.prefix_length
+        ]
+        moves = [(source, target) for source, target in moves
+                 if source != target]
+        if moves:
+            await self._move_files(moves)
+        await self._unlink_moved()
+
+        for name in subdirs:
+            await self._migrate_dir(path_files, (*parts, name))
+
+        if parts and not self.layout.is_shard(parts):
+            # The shards of the old layout are removed when they're empty
+            self._old_dirs.append(dir_path)
+
+    async def _move_files(self, moves: List[Tuple[Path, Path]]) -> None:
+        """Links the files into the new layout and adds them to the index,
+        they are unlinked from the old one after the delay"""
+        loop = asyncio.get_event_loop()
+        linked = await loop.run_in_executor(None, self._link_files, moves)
+        if self.index is not None:
+            for _, target, stat in linked:
+                self.index.add(target, stat.st_size, stat.st_mtime)
+
+        self._unlinking.append((time.monotonic() + UNLINK_DELAY, linked))
+
+    async def _unlink_moved(self) -> None:
+        """Unlinks the files moved before the delay from the old layout"""
+        loop = asyncio.get_event_loop()
+        now = time.monotonic()
+        while self._unlinking and self._unlinking[0][0] <= now:
+            _, linked = self._unlinking.pop(0)
+            await loop.run_in_executor(None, self._unlink_files, linked)
+            for source, _, _ in linked:
+                if self.index is not None:
+                    self.index.remove(source)
+                if self.cache is not None:
+                    self.cache.invalidate(source)
+            self.moved += len(linked)
+
+    @staticmethod
+    def _list_dir(dir_path: Path, is_root: bool) \
+            -> Tuple[List[Tuple[str, str, str]], List[str]]:
+        """Lists the stored files and the shard subdirectories of
+        the directory. Runs in the executor."""
+        files, subdirs = [], []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # The directories of other hash algorithms are
+                    # migrated separately
+                    if SHARD_PATTERN.fullmatch(entry.name):
+                        subdirs.append(entry.name)
+                    continue
+
+                match = FILE_NAME_PATTERN.fullmatch(entry.name)
+                if not is_root and match is not None \
+                        and entry.is_file(follow_symlinks=False):
+                    files.append((entry.name, match.group(1),
+                                  match.group(2) or ''))
+
+        return files, subdirs
+
+    @staticmethod
+    def _link_files(moves: List[Tuple[Path, Path]]) \
+            -> List[LinkedFile]:
+        """Links the files into the new layout. Runs in the executor."""
+        linked = []
+        for source, target in moves:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                # The same file has been saved into the new layout
+                pass
+            except FileNotFoundError:
+                # The file has been deleted
+                continue
+            linked.append((source, target, target.stat()))
+
+        return linked
+
+    @staticmethod
+    def _unlink_files(linked: List[LinkedFile]) -> None:
+        """Unlinks the files from the old layout. Runs in the executor."""
+        for source, _, _ in linked:
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,565 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, \
+    Set, Tuple
+
+from file_loader.storage.commit import GroupCommit
+
+logger = logging.getLogger(__name__)
+
+PACKS_DIR = 'packs'
+PACK_SUFFIX = '.pack'
+MAX_PACK_SIZE = 256 * 1024 * 1024
+
+# The record of the pack: the header, the key of the file and its data.
+# The header is the magic, the flags, the length of the key, the length
+# of the data and the modification time of the file
+MAGIC = b'FLPK'
+HEADER = struct.Struct('<4sBHQd')
+# The data of the tombstone is the number of the pack of the deleted file,
+# the tombstone is dropped by the compactor when that pack is removed
+FLAG_DELETED = 1
+TOMBSTONE = struct.Struct('<Q')
+
+# The live files of the compacted pack are moved by batches of this size,
+# uploads are appended between them
+COMPACT_BATCH_SIZE = 4 * 1024 * 1024
+
+
+class PackEntry(NamedTuple):
+    """Location of the packed file
+    :param pack: the number of the pack
+    :param offset: the offset of the data of the file in the pack
+    :param length: the length of the data
+    :param mtime: timestamp of the file saving
+    """
+    pack: int
+    offset: int
+    length: int
+    mtime: float
+
+
+class PackRecord(NamedTuple):
+    flags: int
+    key: str
+    offset: int
+    length: int
+    mtime: float
+    # The pack of the file deleted by the tombstone
+    ref: int = 0
+
+
+class PackStore:
+    """Storage of small files appended into large append-only pack files
+    (Haystack), saves an inode and the open of each file. The files are
+    found by the in-memory index of hash -> (pack, offset, length) built
+    by scanning the headers of the records on open. The deleted file is
+    marked by the tombstone record, the compactor rewrites the live files
+    of sparse packs into the active one and removes them.
+
+    :param path_store: directory of the store, packs are in its
+    subdirectory
+    :param max_file_size: files larger than this are never packed
+    :param max_pack_size: the new pack is started when the active one
+    reaches this size
+    :param authoritative: the packs are appended by the only process,
+    files missing in the index are missing in the packs. When several
+    processes share the store, the packs are rescanned on misses
+    """
+
+    def __init__(self, path_store: Path, max_file_size: int = 4096,
+                 max_pack_size: int = MAX_PACK_SIZE,
+                 authoritative: bool = True):
+        self.path_packs = path_store / PACKS_DIR
+        self.max_file_size = max_file_size
+        self.max_pack_size = max_pack_size
+        self.authoritative = authoritative
+        self.entries: Dict[str, PackEntry] = {}
+        # The size of the scanned records and live data of each pack
+        self.sizes: Dict[int, int] = {}
+        self.live: Dict[int, int] = {}
+        self._active: Optional[int] = None
+        self._writer: Optional[int] = None
+        self._readers: Dict[int, int] = {}
+        # The descriptors of the full and removed packs are closed when
+        # the reads and the syncs using them are done
+        self._users: Dict[int, int] = {}
+        self._retired: Set[int] = set()
+        self._lock = asyncio.Lock()
+        # Serializes the changes of the sizes, the active pack and
+        # the descriptors made by the executor threads
+        self._state_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(algorithm: str, file_name: str) -> str:
+        """Returns the key of the packed file
+            :param algorithm: the name of the hash algorithm of the file
+            :param file_name: the name of the file: the hash with
+            the suffix of the encoding
+            """
+        return f'{algorithm}/{file_name}'
+
+    def get(self, key: str) -> Optional[PackEntry]:
+        """Returns the location of the packed file
+            :param key: the key of the file
+            :return: PackEntry: the location, None when it's not packed
+            """
+        return self.entries.get(key)
+
+    def get_pack_path(self, pack: int) -> Path:
+        return self.path_packs / f'{pack:08d}{PACK_SUFFIX}'
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def open(self) -> None:
+        """Builds the index by scanning the packs"""
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._create_dir)
+        await self.refresh()
+        logger.info('Pack store contains %d files in %d packs, scanned in '
+                    '%.3f s', len(self), len(self.sizes),
+                    time.monotonic() - started)
+
+    async def close(self) -> None:
+        """Closes the descriptors of the packs"""
+        async with self._lock:
+            with self._state_lock:
+                fds = [self._writer, *self._readers.values()]
+                self._writer = None
+                self._readers.clear()
+            for fd in fds:
+                if fd is not None:
+                    self._retire_fd(fd)
+
+    async def refresh(self) -> None:
+        """Scans the records appended since the last scan, e.g. by other
+        processes"""
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            self._apply(*await loop.run_in_executor(None, self._scan_new))
+
+    async def read(self, key: str) -> bytes:
+        """Reads the packed file by one positional read
+            :param key: the key of the file
+            :return: bytes: the content of the file
+            :raise FileNotFoundError: the file is not packed
+            """
+        for _ in range(2):
+            entry = self.entries.get(key)
+            if entry is None:
+                break
+
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, self._read, entry)
+            except FileNotFoundError:
+                # The pack has been compacted by another process
+                await self.refresh()
+
+        raise FileNotFoundError
+
+    async def put(self, key: str, data: bytes,
+                  group_commit: Optional[GroupCommit] = None) -> bool:
+        """Appends the file to the active pack
+            :param key: the key of the file
+            :param data: the content of the file
+            :param group_commit: syncs the pack to the disk
+            :return: bool: false when the file is already packed
+            """
+        syncing = None
+        async with self._lock:
+            if key in self.entries:
+                return False
+
+            loop = asyncio.get_event_loop()
+            records, writer, created = await loop.run_in_executor(
+                None, self._append, [(0, key, data, time.time())])
+            self._apply(*records)
+            if group_commit is not None:
+                syncing = self._start_sync(writer, group_commit, created)
+
+        if syncing is not None:
+            await asyncio.shield(syncing)
+        return True
+
+    async def delete(self, key: str,
+                     group_commit: Optional[GroupCommit] = None) -> None:
+        """Marks the packed file deleted by the tombstone record
+            :param key: the key of the file
+            :param group_commit: syncs the pack to the disk
+            :raise FileNotFoundError: the file is not packed
+            """
+        syncing = None
+        async with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                raise FileNotFoundError
+
+            loop = asyncio.get_event_loop()
+            records, writer, _ = await loop.run_in_executor(
+                None, self._append, [(FLAG_DELETED, key,
+                                      TOMBSTONE.pack(entry.pack),
+                                      time.time())])
+            self._apply(*records)
+            if group_commit is not None:
+                syncing = self._start_sync(writer, group_commit)
+
+        if syncing is not None:
+            await asyncio.shield(syncing)
+
+    async def compact(self, min_dead_ratio: float = 0.5) -> int:
+        """Rewrites the live files of the sparse packs into the active
+        pack and removes the sparse packs
+            :param min_dead_ratio: the pack is compacted when at least this
+            part of its size is taken by deleted files and tombstones
+            :return: int: the amount of the removed packs
+            """
+        compacted = 0
+        with self._state_lock:
+            packs = sorted(self.sizes)
+        for pack in packs:
+            size = self.sizes.get(pack)
+            if pack == self._active or not size \
+                    or 1 - self.live.get(pack, 0) / size < min_dead_ratio:
+                continue
+
+            await self._compact_pack(pack)
+            compacted += 1
+
+        return compacted
+
+    async def _compact_pack(self, pack: int) -> None:
+        """Moves the live files of the pack into the active one by batches,
+        the pack is removed when they are synced to the disk"""
+        loop = asyncio.get_event_loop()
+        moved = 0
+        # The packs the files are moved into
+        written = set()
+        while True:
+            batch, batch_size = [], 0
+            for key, entry in self.entries.items():
+                if entry.pack == pack:
+                    batch.append((key, entry))
+                    batch_size += entry.length
+                    if batch_size >= COMPACT_BATCH_SIZE:
+                        break
+            if not batch:
+                break
+
+            batch = await loop.run_in_executor(None, self._read_entries,
+                                               batch)
+            async with self._lock:
+                # The files deleted by other processes are not moved
+                self._apply(*await loop.run_in_executor(None,
+                                                        self._scan_new))
+                files = [(0, key, data, entry.mtime)
+                         for key, entry, data in batch
+                         if self.entries.get(key) == entry]
+                if files:
+                    records, _, _ = await loop.run_in_executor(
+                        None, self._append, files)
+                    self._apply(*records)
+                    written.add(self._active)
+                    moved += len(files)
+
+        scanned, _ = await loop.run_in_executor(None, self._scan_pack, pack,
+                                                0)
+        async with self._lock:
+            if any(entry.pack == pack for entry in self.entries.values()):
+                # The file has been appended to the pack by the lagging
+                # process, the pack is compacted again
+                return
+
+            # The tombstones of the files left in the older packs are kept
+            tombstones = [
+                (FLAG_DELETED, record.key, TOMBSTONE.pack(record.ref),
+                 record.mtime)
+                for record in scanned
+                if record.flags & FLAG_DELETED and record.ref != pack
+                and record.ref in self.sizes
+                and record.key not in self.entries
+            ]
+            if tombstones:
+                records, _, _ = await loop.run_in_executor(
+                    None, self._append, tombstones)
+                self._apply(*records)
+                written.add(self._active)
+
+            await loop.run_in_executor(None, self._sync_packs, written)
+            await loop.run_in_executor(None, os.remove,
+                                       self.get_pack_path(pack))
+            with self._state_lock:
+                self.sizes.pop(pack, None)
+            self.live.pop(pack, None)
+            self._retire_reader(pack)
+
+        logger.info('Pack %d was compacted, %d files moved', pack, moved)
+
+    def _apply(self, records: List[Tuple[int, PackRecord]],
+               removed: Sequence[int] = ()) -> None:
+        """Applies the scanned or appended records to the index, the later
+        record of the file takes precedence. The files of the removed
+        packs have been moved by the compactor of another process.
+        """
+        if removed:
+            for key, entry in tuple(self.entries.items()):
+                if entry.pack in removed:
+                    del self.entries[key]
+            for pack in removed:
+                self.live.pop(pack, None)
+                self._retire_reader(pack)
+
+        for pack, record in records:
+            old = self.entries.pop(record.key, None)
+            if old is not None:
+                self.live[old.pack] = self.live.get(old.pack, 0) \
+                    - old.length
+
+            if not record.flags & FLAG_DELETED:
+                self.entries[record.key] = PackEntry(
+                    pack, record.offset, record.length, record.mtime)
+                self.live[pack] = self.live.get(pack, 0) + record.length
+
+    def _start_sync(self, writer: int, group_commit: GroupCommit,
+                    created: bool = False) -> asyncio.Future:
+        """Starts syncing the pack appended by the descriptor, the sync
+        goes on when the caller is cancelled. The descriptor is not closed
+        until the sync is done
+        """
+        self._use_fd(writer)
+
+        async def sync():
+            try:
+                await group_commit.sync_file(writer)
+                if created:
+                    await group_commit.sync_dirs({self.path_packs})
+            finally:
+                self._release_fd(writer)
+
+        return asyncio.ensure_future(sync())
+
+    def _use_fd(self, fd: int) -> None:
+        """Marks the descriptor used, it's not closed until it's
+        released"""
+        with self._state_lock:
+            self._users[fd] = self._users.get(fd, 0) + 1
+
+    def _release_fd(self, fd: int) -> None:
+        """Releases the used descriptor, the retired one is closed by
+        its last user"""
+        with self._state_lock:
+            users = self._users.pop(fd) - 1
+            if users:
+                self._users[fd] = users
+                return
+            if fd not in self._retired:
+                return
+            self._retired.discard(fd)
+        os.close(fd)
+
+    def _retire_fd(self, fd: int) -> None:
+        """Closes the descriptor of the full or removed pack when it's
+        not used"""
+        with self._state_lock:
+            if self._users.get(fd):
+                self._retired.add(fd)
+                return
+        os.close(fd)
+
+    def _retire_reader(self, pack: int) -> None:
+        """Closes the descriptor reading the removed pack when the reads
+        in progress are done"""
+        with self._state_lock:
+            reader = self._readers.pop(pack, None)
+        if reader is not None:
+            self._retire_fd(reader)
+
+    def _create_dir(self) -> None:
+        self.path_packs.mkdir(parents=True, exist_ok=True)
+
+    def _scan_new(self) -> Tuple[List[Tuple[int, PackRecord]],
+                                 List[int]]:
+        """Scans the records of the packs appended since the last scan.
+        Runs in the executor.
+        :return: tuple: the scanned records and the removed packs
+        """
+        packs = sorted(
+            int(name[:-len(PACK_SUFFIX)])
+            for name in os.listdir(self.path_packs)
+            if name.endswith(PACK_SUFFIX)
+            and name[:-len(PACK_SUFFIX)].isdigit()
+        )
+
+        records, sizes = [], {}
+        for pack in packs:
+            scanned, sizes[pack] = self._scan_pack(pack,
+                                                   self.sizes.get(pack, 0))
+            records.extend((pack, record) for record in scanned)
+
+        with self._state_lock:
+            removed = [pack for pack in self.sizes if pack not in sizes]
+            for pack in removed:
+                del self.sizes[pack]
+            self.sizes.update(sizes)
+            if packs:
+                self._active = packs[-1]
+        return records, removed
+
+    def _scan_pack(self, pack: int, start: int) \
+            -> Tuple[List[PackRecord], int]:
+        """Reads the headers of the records of the pack. The record
+        partially written on crash ends the pack, it's overwritten by
+        the next append. Runs in the executor.
+        :return: tuple: the records and the end of the last one
+        """
+        records = []
+        offset = start
+        try:
+            file = open(self.get_pack_path(pack), 'rb')
+        except FileNotFoundError:
+            return records, offset
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            file.seek(offset)
+            while offset + HEADER.size <= size:
+                magic, flags, key_length, length, mtime = HEADER.unpack(
+                    file.read(HEADER.size))
+                data_offset = offset + HEADER.size + key_length
+                if magic != MAGIC or data_offset + length > size:
+                    logger.warning('Pack %d is broken at offset %d', pack,
+                                   offset)
+                    break
+
+                key = file.read(key_length).decode()
+                ref = 0
+                if flags & FLAG_DELETED and length == TOMBSTONE.size:
+                    ref, = TOMBSTONE.unpack(file.read(length))
+                records.append(PackRecord(flags, key, data_offset, length,
+                                          mtime, ref))
+                offset = data_offset + length
+                file.seek(offset)
+
+        return records, offset
+
+    def _append(self, files: List[Tuple[int, str, bytes, float]]) \
+            -> Tuple[List[Tuple[int, PackRecord]], int, bool]:
+        """Appends the records to the active pack, the new pack is started
+        when it's full. The pack is locked, the records appended by other
+        processes since the last scan are scanned first. Runs in
+        the executor.
+        :return: tuple: the scanned and the appended records, the
+        descriptor of the pack and whether the pack was created
+        """
+        chunks, appended = [], []
+        length = 0
+        for flags, key, data, mtime in files:
+            key_bytes = key.encode()
+            chunks += [HEADER.pack(MAGIC, flags, len(key_bytes), len(data),
+                                   mtime), key_bytes, data]
+            appended.append((flags, key, length + HEADER.size
+                             + len(key_bytes), len(data), mtime))
+            length += HEADER.size + len(key_bytes) + len(data)
+
+        created = False
+        if self._writer is None:
+            created = self._open_writer(self._active or 1)
+
+        while True:
+            fcntl.flock(self._writer, fcntl.LOCK_EX)
+            size = os.fstat(self._writer).st_size
+            if size + length <= self.max_pack_size or size == 0:
+                break
+
+            fcntl.flock(self._writer, fcntl.LOCK_UN)
+            created = self._open_writer(self._active + 1) or created
+
+        try:
+            scanned = [], []
+            if size != self.sizes.get(self._active, 0) \
+                    or self.get_pack_path(self._active + 1).exists():
+                scanned = self._scan_new()
+
+            if size > self.sizes.get(self._active, 0):
+                # The tail of the record partially written on crash
+                size = self.sizes.get(self._active, 0)
+                os.ftruncate(self._writer, size)
+
+            os.write(self._writer, b''.join(chunks))
+            with self._state_lock:
+                self.sizes[self._active] = size + length
+        finally:
+            fcntl.flock(self._writer, fcntl.LOCK_UN)
+
+        records, removed = scanned
+        records.extend(
+            (self._active, PackRecord(flags, key, size + offset, length,
+                                      mtime))
+            for flags, key, offset, length, mtime in appended
+        )
+        return (records, removed), self._writer, created
+
+    def _open_writer(self, pack: int) -> bool:
+        """Opens the pack for appending. Runs in the executor.
+        :return: bool: whether the pack was created
+        """
+        path = self.get_pack_path(pack)
+        created = not path.exists()
+        writer = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_APPEND,
+                         0o666)
+        with self._state_lock:
+            retired, self._writer = self._writer, writer
+            self._active = pack
+        if retired is not None:
+            # The syncs of the full pack may still be waiting
+            self._retire_fd(retired)
+        return created
+
+    def _sync_packs(self, packs: Iterable[int]) -> None:
+        """Syncs the packs to the disk, the full ones are not open for
+        appending anymore. Runs in the executor."""
+        for pack in packs:
+            fd = os.open(self.get_pack_path(pack), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _read(self, entry: PackEntry) -> bytes:
+        """Reads the data of the entry. Runs in the executor."""
+        reader = self._use_reader(entry.pack)
+        try:
+            return os.pread(reader, entry.length, entry.offset)
+        finally:
+            self._release_fd(reader)
+
+    def _use_reader(self, pack: int) -> int:
+        """Returns the descriptor reading the pack, it's open on the first
+        read. The descriptor is used until it's released. Runs in the
+        executor."""
+        with self._state_lock:
+            reader = self._readers.get(pack)
+            if reader is not None:
+                self._users[reader] = self._users.get(reader, 0) + 1
+                return reader
+
+        opened = os.open(self.get_pack_path(pack), os.O_RDONLY)
+        with self._state_lock:
+            reader = self._readers.setdefault(pack, opened)
+            self._users[reader] = self._users.get(reader, 0) + 1
+        if reader != opened:
+            os.close(opened)
+        return reader
+
+    def _read_entries(self, entries: List[Tuple[str, PackEntry]]) \
+            -> List[Tuple[str, PackEntry, bytes]]:
+        """Reads the data of the entries. Runs in the executor."""
+        return [(key, entry, self._read(entry)) for key, entry in entries]
@@ -0,0 +1,531 @@
+import asyncio
+import errno
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from file_loader.storage.cache import FileCache
+from file_loader.storage.commit import TMP_PREFIX, GroupCommit
+from file_loader.storage.compression import ENCODINGS, Encoding
+from file_loader.storage.hashing import ALGORITHMS, DEFAULT_ALGORITHM, \
+    HashAlgorithm
+from file_loader.storage.index import StorageIndex
+from file_loader.storage.layout import FILE_NAME_PATTERN, SHARD_PATTERN
+from file_loader.storage.packs import PACKS_DIR, PackStore
+from file_loader.storage.tiers import get_tier_path
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = 'quarantine'
+DB_NAME = 'verified.sqlite3'
+TMP_FILE_PATTERN = re.compile(re.escape(TMP_PREFIX) + r'[0-9a-f-]{36}')
+# Temporary files of the saved files not modified for this many seconds
+# are left by interrupted uploads
+TMP_MAX_AGE = 3600.0
+READ_BLOCK_SIZE = 1024 * 1024
+# The verifications are saved and the ones of other processes are loaded
+# this often
+SYNC_INTERVAL = 60.0
+# The amount of files hashed by each process at once, the next file is
+# read while the current one is hashed
+FILES_PER_PROCESS = 2
+
+
+class CorruptFileError(Exception):
+    """
+    Exception raised when the content of the stored file doesn't hash to
+    its name. The file is quarantined.
+    """
+    pass
+
+
+class ScrubbedFile(NamedTuple):
+    """The stored file checked by the scrubber
+    :param path: path of the file
+    :param algorithm: the hash algorithm of the file
+    :param file_hash: the hash the file is named by
+    :param encoding: the encoding of the file stored compressed
+    :param size: size of the file in bytes
+    """
+    path: Path
+    algorithm: HashAlgorithm
+    file_hash: str
+    encoding: Optional[Encoding]
+    size: int
+
+
+class VerificationLog:
+    """When each stored file was last verified to hash to its name, saved
+    to the store. The files are identified by their paths relative to
+    the tier, so the file moved between the tiers stays verified.
+    The packed files are identified by their keys in the packs directory.
+    Several processes share the log, each one loads the verifications of
+    the others when it syncs.
+
+    :param path_store: directory of the store
+    :param cold_paths: the root directories of the colder tiers
+    """
+
+    def __init__(self, path_store: Path, cold_paths: Sequence[Path] = ()):
+        self.path_store = path_store
+        self.tier_paths = (path_store, *cold_paths)
+        self.db_path = path_store / DB_NAME
+        self.verified: Dict[str, float] = {}
+        self._recorded: Dict[str, float] = {}
+        self._forgotten: Set[str] = set()
+        self._synced = 0.0
+
+    def get_key(self, file_path: Path, pack_key: Optional[str] = None) \
+            -> str:
+        """Returns the key of the stored file in the log
+            :param file_path: path of the file, the pack of the packed file
+            :param pack_key: the key of the packed file
+            """
+        if pack_key is not None:
+            return f'{PACKS_DIR}/{pack_key}'
+        return file_path.relative_to(
+            get_tier_path(self.tier_paths, file_path)).as_posix()
+
+    def get(self, key: str) -> Optional[float]:
+        """Returns the timestamp of the last verification of the file,
+        None when it has never been verified"""
+        return self.verified.get(key)
+
+    def is_verified(self, key: str, max_age: float) -> bool:
+        """Checks that the file was verified within max_age seconds"""
+        verified = self.verified.get(key)
+        return verified is not None and time.time() - verified < max_age
+
+    def record(self, key: str) -> None:
+        """Records the file has been verified now"""
+        self.verified[key] = self._recorded[key] = time.time()
+        self._forgotten.discard(key)
+
+    def forget(self, key: str) -> None:
+        """Forgets the file which is not stored anymore"""
+        self.verified.pop(key, None)
+        self._recorded.pop(key, None)
+        self._forgotten.add(key)
+
+    async def open(self) -> None:
+        """Loads the log"""
+        await self.sync()
+        logger.info('Verification log contains %d files',
+                    len(self.verified))
+
+    async def close(self) -> None:
+        """Saves the recent verifications"""
+        await self.sync()
+
+    async def sync(self) -> None:
+        """Saves the recent verifications, loads the ones of other
+        processes"""
+        recorded, self._recorded = self._recorded, {}
+        forgotten, self._forgotten = self._forgotten, set()
+        loop = asyncio.get_event_loop()
+        started = time.time()
+        try:
+            loaded = await loop.run_in_executor(
+                None, self._sync, recorded, forgotten, self._synced)
+        except BaseException:
+            # Saved by the next sync
+            self._recorded = {**recorded, **self._recorded}
+            self._forgotten |= forgotten
+            raise
+
+        self._synced = started
+        for key, verified in loaded:
+            if key not in self._forgotten \
+                    and verified > self.verified.get(key, 0.0):
+                self.verified[key] = verified
+
+    def _sync(self, recorded: Dict[str, float], forgotten: Set[str],
+              since: float) -> List[Tuple[str, float]]:
+        """Writes and reads the verifications. Runs in the executor.
+        :return: list: keys and timestamps of the verifications saved
+        since the timestamp
+        """
+        saved = time.time()
+        with sqlite3.connect(str(self.db_path), timeout=30.0) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS verified ('
+                       'key TEXT PRIMARY KEY, verified REAL, saved REAL)')
+            db.executemany('INSERT OR REPLACE INTO verified VALUES (?, ?, ?)',
+                           ((key, verified, saved)
+                            for key, verified in recorded.items()))
+            db.executemany('DELETE FROM verified WHERE key = ?',
+                           ((key,) for key in forgotten))
+            return db.execute('SELECT key, verified FROM verified '
+                              'WHERE saved >= ?', (since,)).fetchall()
+
+
+class RateLimiter:
+    """Limits the rate of the I/O by the token bucket, a burst of one
+    second of the rate is allowed
+    :param rate: bytes per second, not limited when it's 0
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    async def acquire(self, amount: int) -> None:
+        """Waits until the amount of bytes may be read"""
+        if not self.rate:
+            return
+
+        now = time.monotonic()
+        self._tokens = min(self.rate,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # The debt of the large read is paid by the waits of the next ones
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def hash_file(file_path: str, algorithm: str,
+              encoding: Optional[str] = None,
+              block_size: int = READ_BLOCK_SIZE) -> str:
+    """Hashes the content of the file, the file stored compressed is
+    decompressed. Runs in the process pool.
+    :param file_path: path of the file
+    :param algorithm: the name of the hash algorithm
+    :param encoding: the name of the encoding of the file
+    :param block_size: the size of the blocks the file is read by
+    :return: str: the hex digest of the content
+    :raise CorruptFileError: the file can't be decompressed
+    """
+    hasher = ALGORITHMS[algorithm].factory()
+    decompressor = ENCODINGS[encoding].decompressor() if encoding else None
+    with open(file_path, 'rb', buffering=0) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            if decompressor is not None:
+                block = _decompress(decompressor, block)
+            hasher.update(block)
+
+    if decompressor is not None:
+        hasher.update(_decompress(decompressor))
+    return hasher.hexdigest()
+
+
+def hash_content(content: bytes, algorithm: str,
+                 encoding: Optional[str] = None) -> str:
+    """Hashes the content of the file held in memory, the content stored
+    compressed is decompressed
+    :raise CorruptFileError: the content can't be decompressed
+    """
+    if encoding:
+        decompressor = ENCODINGS[encoding].decompressor()
+        content = _decompress(decompressor, content) \
+            + _decompress(decompressor)
+    return ALGORITHMS[algorithm].factory(content).hexdigest()
+
+
+def _decompress(decompressor, data: Optional[bytes] = None) -> bytes:
+    """Decompresses the data, flushes the decompressor if it's None"""
+    try:
+        if data is None:
+            return decompressor.flush()
+        return decompressor.decompress(data)
+    except Exception as e:
+        # zlib and zstd raise their own errors
+        raise CorruptFileError(f'Content can\'t be decompressed: {e}')
+
+
+def quarantine_file(tier_path: Path, file_path: Path) -> Path:
+    """Moves the corrupt file out of the store into the quarantine
+    directory of its tier, its path in the tier is kept. Runs in
+    the executor.
+    :return: Path: the path of the quarantined file
+    """
+    target = _get_quarantine_path(tier_path, file_path.relative_to(
+        tier_path).as_posix())
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.rename(file_path, target)
+    return target
+
+
+def quarantine_content(path_store: Path, key: str, content: bytes) -> Path:
+    """Writes the content of the corrupt file held in memory, e.g.
+    the packed one, into the quarantine directory. Runs in the executor.
+    :return: Path: the path of the quarantined file
+    """
+    target = _get_quarantine_path(path_store, key)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_bytes(content)
+    return target
+
+
+def _get_quarantine_path(path_store: Path, key: str) -> Path:
+    # The same file may be quarantined again after it's uploaded again
+    return path_store / QUARANTINE_DIR / f'{key}.{int(time.time())}'
+
+
+def sweep_temp_files(path_store: Path, max_age: float = TMP_MAX_AGE) \
+        -> int:
+    """Removes the temporary files left by the interrupted uploads and
+    moves between the tiers, they are not modified for max_age seconds.
+    Runs in the executor.
+    :return: int: the amount of the removed files
+    """
+    removed = 0
+    deadline = time.time() - max_age
+    with os.scandir(path_store) as entries:
+        for entry in entries:
+            if not TMP_FILE_PATTERN.fullmatch(entry.name) \
+                    or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                if entry.stat().st_mtime > deadline:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+
+    return removed
+
+
+class Scrubber:
+    """Verifies that the stored files still hash to their names, so bit
+    rot and truncated writes are found before they are downloaded.
+    The files are hashed in the process pool under the I/O rate limit,
+    the corrupt ones are moved to the quarantine directory, so they are
+    not found anymore and may be uploaded again. The temporary files left
+    by interrupted uploads are removed on each pass.
+
+    :param path_store: directory of the store
+    :param log: records when each file was last verified
+    :param max_age: files verified within this many seconds are skipped
+    :param processes: the amount of processes hashing the files
+    :param rate: bytes read per second, not limited when it's 0
+    :param index: the index of the store
+    :param cache: the memory cache of small files
+    :param packs: the store of packed files, they are verified as well
+    :param group_commit: syncs the deletions of the packed files
+    :param cold_paths: the root directories of the colder tiers, their
+    files are verified as well
+    """
+
+    def __init__(self, path_store: Path, log: VerificationLog,
+                 max_age: float, processes: int = 1, rate: float = 0,
+                 index: Optional[StorageIndex] = None,
+                 cache: Optional[FileCache] = None,
+                 packs: Optional[PackStore] = None,
+                 group_commit: Optional[GroupCommit] = None,
+                 cold_paths: Sequence[Path] = ()):
+        self.path_store = path_store
+        self.tier_paths = (path_store, *cold_paths)
+        self.log = log
+        self.max_age = max_age
+        self.processes = processes
+        self.rate = RateLimiter(rate)
+        self.index = index
+        self.cache = cache
+        self.packs = packs
+        self.group_commit = group_commit
+        self.verified = 0
+        self.corrupt = 0
+        self.swept = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'verified': self.verified,
+            'corrupt': self.corrupt,
+            'swept': self.swept,
+        }
+
+    async def run(self) -> None:
+        """Verifies the files of the store which were not verified
+        recently, removes the abandoned temporary files"""
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        for tier_path in self.tier_paths:
+            self.swept += await loop.run_in_executor(
+                None, sweep_temp_files, tier_path)
+
+        # Forked processes would inherit the threads and the event loop
+        pool = ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('spawn'))
+        slots = asyncio.Semaphore(self.processes * FILES_PER_PROCESS)
+        tasks: Set[asyncio.Future] = set()
+
+        async def submit(coro):
+            await slots.acquire()
+            task = asyncio.ensure_future(coro)
+            task.add_done_callback(lambda _: slots.release())
+            tasks.add(task)
+
+        try:
+            for path_files, algorithm in self._get_roots():
+                async for scrubbed in self._iter_files(path_files,
+                                                       algorithm):
+                    await self.rate.acquire(scrubbed.size)
+                    await submit(self._verify_file(pool, scrubbed))
+            if self.packs is not None:
+                for key, entry in list(self.packs.entries.items()):
+                    if self.log.is_verified(self.log.get_key(
+                            self.path_store, key), self.max_age):
+                        continue
+                    await self.rate.acquire(entry.length)
+                    await submit(self._verify_packed(pool, key))
+
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await loop.run_in_executor(None, pool.shutdown)
+            await self.log.sync()
+
+        logger.info('Store was scrubbed in %.3f s: %r',
+                    time.monotonic() - started, self.stats)
+
+    def _get_roots(self) -> List[Tuple[Path, HashAlgorithm]]:
+        """Returns the root directories of the files of each algorithm
+        in each tier"""
+        return [
+            (tier_path if name == DEFAULT_ALGORITHM
+             else tier_path / name, algorithm)
+            for tier_path in self.tier_paths
+            for name, algorithm in ALGORITHMS.items()
+        ]
+
+    async def _iter_files(self, path_files: Path, algorithm: HashAlgorithm):
+        """Yields the files of the algorithm which were not verified
+        recently, the directories are listed one by one in the executor
+        """
+        loop = asyncio.get_event_loop()
+        dirs = [path_files]
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                files, subdirs = await loop.run_in_executor(
+                    None, self._list_dir, dir_path, dir_path == path_files,
+                    algorithm)
+            except FileNotFoundError:
+                continue
+
+            dirs.extend(dir_path / name for name in subdirs)
+            for scrubbed in files:
+                if not self.log.is_verified(
+                        self.log.get_key(scrubbed.path), self.max_age):
+                    yield scrubbed
+
+    async def _verify_file(self, pool: Executor,
+                           scrubbed: ScrubbedFile) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            content_hash = await loop.run_in_executor(
+                pool, hash_file, str(scrubbed.path), scrubbed.algorithm.name,
+                scrubbed.encoding.name if scrubbed.encoding else None)
+        except FileNotFoundError:
+            # The file has been deleted or moved
+            return
+        except CorruptFileError as e:
+            content_hash = str(e)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                logger.warning('File %s is not verified: %r',
+                               scrubbed.path, e)
+                return
+            # The disk can't read the file
+            content_hash = str(e)
+
+        key = self.log.get_key(scrubbed.path)
+        if content_hash == scrubbed.file_hash:
+            self.log.record(key)
+            self.verified += 1
+            return
+
+        target = await loop.run_in_executor(
+            None, quarantine_file,
+            get_tier_path(self.tier_paths, scrubbed.path), scrubbed.path)
+        if self.index is not None:
+            self.index.remove(scrubbed.path)
+        if self.cache is not None:
+            self.cache.invalidate(scrubbed.path)
+        self.log.forget(key)
+        self.corrupt += 1
+        logger.error('File %s hashes to %s, it was quarantined to %s',
+                     scrubbed.path, content_hash, target)
+
+    async def _verify_packed(self, pool: Executor, key: str) -> None:
+        algorithm, _, name = key.partition('/')
+        match = FILE_NAME_PATTERN.fullmatch(name)
+        encoding = _get_encoding_by_suffix(match.group(2)) \
+            if match is not None else None
+        try:
+            content = await self.packs.read(key)
+        except FileNotFoundError:
+            # The file has been deleted
+            return
+
+        loop = asyncio.get_event_loop()
+        try:
+            content_hash = await loop.run_in_executor(
+                pool, hash_content, content, algorithm,
+                encoding.name if encoding else None)
+        except CorruptFileError as e:
+            content_hash = str(e)
+
+        log_key = self.log.get_key(self.path_store, key)
+        if match is not None and content_hash == match.group(1):
+            self.log.record(log_key)
+            self.verified += 1
+            return
+
+        target = await loop.run_in_executor(None, quarantine_content,
+                                            self.path_store, key, content)
+        await self.packs.delete(key, self.group_commit)
+        self.log.forget(log_key)
+        self.corrupt += 1
+        logger.error('Packed file %s hashes to %s, it was quarantined to '
+                     '%s', key, content_hash, target)
+
+    @staticmethod
+    def _list_dir(dir_path: Path, is_root: bool, algorithm: HashAlgorithm) \
+            -> Tuple[List[ScrubbedFile], List[str]]:
+        """Lists the stored files of the algorithm and the shard
+        subdirectories of the directory. Runs in the executor."""
+        files, subdirs = [], []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # The directories of other hash algorithms are
+                    # scrubbed separately
+                    if SHARD_PATTERN.fullmatch(entry.name):
+                        subdirs.append(entry.name)
+                    continue
+
+                match = FILE_NAME_PATTERN.fullmatch(entry.name)
+                if is_root or match is None \
+                        or len(match.group(1)) != algorithm.hex_length \
+                        or not entry.is_file(follow_symlinks=False):
+                    continue
+                encoding = _get_encoding_by_suffix(match.group(2))
+                if match.group(2) and encoding is None:
+                    continue
+                files.append(ScrubbedFile(
+                    Path(entry.path), algorithm, match.group(1), encoding,
+                    entry.stat(follow_symlinks=False).st_size))
+
+        return files, subdirs
+
+
+def _get_encoding_by_suffix(suffix: Optional[str]) -> Optional[Encoding]:
+    for encoding in ENCODINGS.values():
+        if encoding.suffix == suffix:
+            return encoding
+    return None
@@ -0,0 +1,420 @@
+import asyncio
+import errno
+import logging
+import os
+import shutil
+import time
+from contextlib import suppress
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from file_loader.storage.cache import FileCache
+from file_loader.storage.commit import DURABILITY_NONE, TMP_PREFIX, \
+    GroupCommit, link_file
+from file_loader.storage.hashing import ALGORITHMS
+from file_loader.storage.index import FileRecord, StorageIndex
+from file_loader.storage.layout import FILE_NAME_PATTERN, SHARD_PATTERN, \
+    UNLINK_DELAY
+
+logger = logging.getLogger(__name__)
+
+# The path, the size and the timestamp of the last access of the file
+TieredFile = Tuple[Path, int, float]
+
+
+def get_tier_path(tier_paths: Sequence[Path], file_path: Path) -> Path:
+    """Returns the root directory of the tier the file is stored in
+    :param tier_paths: the root directories of the tiers
+    :param file_path: path of the file
+    :raise ValueError: the file is not in any tier
+    """
+    for tier_path in tier_paths:
+        if tier_path in file_path.parents:
+            return tier_path
+    raise ValueError(f'{file_path} is not in the store')
+
+
+class TieredIndex:
+    """Index of the tiered store made of the indexes of its tiers, each
+    file is looked up in the index of the tier it's stored in. It serves
+    the same methods as StorageIndex.
+
+    :param indexes: the indexes of the tiers, the fastest tier first
+    """
+
+    def __init__(self, indexes: Sequence[StorageIndex]):
+        self.indexes = tuple(indexes)
+
+    @property
+    def authoritative(self) -> bool:
+        return all(index.authoritative for index in self.indexes)
+
+    def get(self, file_path: Path) -> Optional[FileRecord]:
+        return self._get_index(file_path).get(file_path)
+
+    def add(self, file_path: Path, size: int,
+            mtime: Optional[float] = None) -> FileRecord:
+        return self._get_index(file_path).add(file_path, size, mtime)
+
+    def remove(self, file_path: Path) -> None:
+        self._get_index(file_path).remove(file_path)
+
+    def remove_dir(self, dir_path: Path) -> None:
+        self._get_index(dir_path).remove_dir(dir_path)
+
+    def touch(self, file_path: Path) -> None:
+        self._get_index(file_path).touch(file_path)
+
+    def has_dir(self, dir_path: Path) -> bool:
+        return self._get_index(dir_path).has_dir(dir_path)
+
+    def __len__(self) -> int:
+        return sum(len(index) for index in self.indexes)
+
+    @property
+    def total_size(self) -> int:
+        return sum(index.total_size for index in self.indexes)
+
+    def iter_files(self) -> Iterator[Tuple[Path, FileRecord]]:
+        for index in self.indexes:
+            yield from index.iter_files()
+
+    async def open(self) -> None:
+        await asyncio.gather(*(index.open() for index in self.indexes))
+
+    async def close(self) -> None:
+        await asyncio.gather(*(index.close() for index in self.indexes))
+
+    def _get_index(self, path: Path) -> StorageIndex:
+        for index in self.indexes:
+            if index.path_store == path or index.path_store in path.parents:
+                return index
+        # The path out of the store is rejected by the index of the store
+        return self.indexes[0]
+
+
+class StorageTiers:
+    """Tiers of the store from the fastest to the slowest one, e.g. NVMe
+    and HDD. New files are saved into the first tier, which is the store.
+    Files not read for the idle time are demoted to the next tier in
+    the background, files read often in the colder tiers are promoted
+    back into the first one. The packed files stay in the store.
+
+    The moved file is copied into the other tier and linked into its
+    place there when it's complete, it's unlinked from the old tier after
+    the delay. Lookups search the tiers in order, so the file is always
+    found in one of them and the requests which have found it in the old
+    tier can still open it.
+
+    :param tier_paths: the root directories of the tiers, the first one
+    is the store. The file keeps its path relative to the tier
+    :param idle_time: files not read for this many seconds are demoted
+    :param promote_reads: the file read this many times within the idle
+    time is promoted
+    :param max_usage: the part of the disk of the tier which may be used,
+    the least recently read files are demoted while it's exceeded. Files
+    are not promoted into the tier using more
+    :param index: the index of the store updated with the moved files,
+    its records of the last reads are used besides the access times
+    :param cache: the memory cache of small files
+    :param group_commit: syncs the moved files to the disk before they
+    are unlinked from the old tier
+    """
+
+    def __init__(self, tier_paths: Sequence[Path], idle_time: float,
+                 promote_reads: int = 2, max_usage: float = 0.9,
+                 index: Optional[TieredIndex] = None,
+                 cache: Optional[FileCache] = None,
+                 group_commit: Optional[GroupCommit] = None):
+        if len(set(tier_paths)) != len(tier_paths):
+            raise ValueError('Tiers should be different directories')
+        for tier_path in tier_paths:
+            for other in tier_paths:
+                if tier_path in other.parents:
+                    raise ValueError(f'Tier {other} is inside the tier '
+                                     f'{tier_path}')
+
+        self.paths = tuple(tier_paths)
+        self.idle_time = idle_time
+        self.promote_reads = promote_reads
+        self.max_usage = max_usage
+        self.index = index
+        self.cache = cache
+        self.group_commit = group_commit
+        self.demoted = 0
+        self.promoted = 0
+        # The amount of reads of the cold files since the first one
+        self._reads: Dict[Path, Tuple[int, float]] = {}
+        self._promoting: Dict[Path, asyncio.Future] = {}
+        self._unlinking: List[Tuple[float, Path, Path]] = []
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'demoted': self.demoted,
+            'promoted': self.promoted,
+        }
+
+    def is_cold(self, file_path: Path) -> bool:
+        """Checks that the file is stored out of the first tier"""
+        return self.paths[0] not in file_path.parents
+
+    def get_copies(self, file_path: Path) -> List[Path]:
+        """Returns the paths of the file in the other tiers, the file
+        being moved is there until it's unlinked from the old tier"""
+        relative = file_path.relative_to(
+            get_tier_path(self.paths, file_path))
+        return [tier_path / relative for tier_path in self.paths
+                if tier_path / relative != file_path]
+
+    def record_read(self, file_path: Path) -> None:
+        """Counts the read of the file, the cold file read often enough
+        is promoted in the background
+            :param file_path: path of the read file
+            """
+        if not self.is_cold(file_path) or file_path in self._promoting:
+            return
+
+        now = time.time()
+        count, first = self._reads.get(file_path, (0, now))
+        if now - first > self.idle_time:
+            count, first = 0, now
+        count += 1
+        if count < self.promote_reads:
+            self._reads[file_path] = (count, first)
+            return
+
+        self._reads.pop(file_path, None)
+        promotion = asyncio.ensure_future(self.promote(file_path))
+        self._promoting[file_path] = promotion
+        promotion.add_done_callback(
+            lambda _: self._promoting.pop(file_path, None))
+
+    async def open(self) -> None:
+        """Creates the root directories of the tiers"""
+        loop = asyncio.get_event_loop()
+        for tier_path in self.paths:
+            await loop.run_in_executor(
+                None, partial(tier_path.mkdir, parents=True, exist_ok=True))
+
+    async def close(self) -> None:
+        """Cancels the promotions, unlinks the moved files"""
+        for promotion in list(self._promoting.values()):
+            promotion.cancel()
+            with suppress(asyncio.CancelledError):
+                await promotion
+        await self._unlink_moved(force=True)
+        logger.info('Storage tiers stats: %r', self.stats)
+
+    async def promote(self, file_path: Path) -> bool:
+        """Moves the cold file into the first tier unless it's full
+            :param file_path: path of the file in the cold tier
+            :return: bool: true when the file is moved
+            """
+        if await self._is_full(self.paths[0]):
+            return False
+
+        target = self.paths[0] / file_path.relative_to(
+            get_tier_path(self.paths, file_path))
+        try:
+            if not await self._move(file_path, target):
+                return False
+            if self.index is not None:
+                self.index.touch(target)
+            await asyncio.sleep(UNLINK_DELAY)
+            await self._unlink_moved()
+        except Exception:
+            logger.exception('Promotion of the file %s has failed',
+                             file_path)
+            return False
+
+        self.promoted += 1
+        logger.info('File %s was promoted', file_path)
+        return True
+
+    async def demote(self) -> int:
+        """Moves the files not read for the idle time into the next
+        tier, then the least recently read ones while the tier uses too
+        much of its disk. The files of the last tier stay there
+            :return: int: the amount of the demoted files
+            """
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        demoted = self.demoted
+        now = time.time()
+        for path, (_, first) in list(self._reads.items()):
+            if now - first > self.idle_time:
+                del self._reads[path]
+
+        for tier_path, next_path in zip(self.paths, self.paths[1:]):
+            files = await loop.run_in_executor(None, self._list_files,
+                                               tier_path)
+            # The least recently read files are demoted first
+            files = sorted(
+                ((file_path, size, self._get_last_access(file_path, atime))
+                 for file_path, size, atime in files),
+                key=lambda file: file[2])
+
+            usage = await loop.run_in_executor(None, shutil.disk_usage,
+                                               tier_path)
+            excess = usage.used - self.max_usage * usage.total
+            deadline = now - self.idle_time
+            for file_path, size, last_access in files:
+                if last_access > deadline and excess <= 0:
+                    # The rest of the files were read later
+                    break
+                target = next_path / file_path.relative_to(tier_path)
+                try:
+                    moved = await self._move(file_path, target)
+                except OSError as e:
+                    logger.warning('File %s is not demoted: %r',
+                                   file_path, e)
+                    if e.errno == errno.ENOSPC:
+                        break
+                    continue
+                if moved:
+                    self.demoted += 1
+                    excess -= size
+                await self._unlink_moved()
+
+        await self._unlink_moved(force=True)
+        logger.info('Storage tiers were migrated in %.3f s, %d files '
+                    'demoted', time.monotonic() - started,
+                    self.demoted - demoted)
+        return self.demoted - demoted
+
+    def _get_last_access(self, file_path: Path, atime: float) -> float:
+        """The file system may not update the access time on each read,
+        the index records the reads served by the process"""
+        record = self.index.get(file_path) \
+            if self.index is not None else None
+        return max(atime, record.last_access) if record is not None \
+            else atime
+
+    async def _is_full(self, tier_path: Path) -> bool:
+        loop = asyncio.get_event_loop()
+        usage = await loop.run_in_executor(None, shutil.disk_usage,
+                                           tier_path)
+        return usage.used >= self.max_usage * usage.total
+
+    async def _move(self, source: Path, target: Path) -> bool:
+        """Copies the file into the other tier and adds it to the index,
+        it's unlinked from the old tier after the delay
+        :return: bool: false when the file has been deleted
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            stat, created = await loop.run_in_executor(
+                None, self._copy_file, source, target)
+        except FileNotFoundError:
+            return False
+
+        if self.group_commit is not None:
+            await self.group_commit.sync_dirs({target.parent, *created})
+        if self.index is not None:
+            record = self.index.add(target, stat.st_size, stat.st_mtime)
+            record.last_access = self._get_last_access(source,
+                                                       stat.st_atime)
+
+        self._unlinking.append((time.monotonic() + UNLINK_DELAY,
+                                source, target))
+        return True
+
+    async def _unlink_moved(self, force: bool = False) -> None:
+        """Unlinks the files moved before the delay from the old tier,
+        all of them after waiting for the delay when it's forced"""
+        if force and self._unlinking:
+            deadline, _, _ = self._unlinking[-1]
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+        loop = asyncio.get_event_loop()
+        now = time.monotonic()
+        while self._unlinking and self._unlinking[0][0] <= now:
+            _, source, target = self._unlinking.pop(0)
+            await loop.run_in_executor(None, self._unlink_file, source,
+                                       target)
+            if self.index is not None:
+                self.index.remove(source)
+            if self.cache is not None:
+                self.cache.invalidate(source)
+
+    def _copy_file(self, source: Path, target: Path) \
+            -> Tuple[os.stat_result, List[Path]]:
+        """Copies the file keeping its times, the copy is linked into its
+        place when it's complete. Runs in the executor.
+        :return: the stat of the file and the directories created for it
+        :raise FileNotFoundError: the file has been deleted
+        """
+        path_tmp = get_tier_path(self.paths, target) \
+            / f'{TMP_PREFIX}{uuid4()}'
+        try:
+            stat = source.stat()
+            shutil.copyfile(source, path_tmp)
+            # The modification time is a part of the ETag of the file
+            os.utime(path_tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            if self.group_commit is not None \
+                    and self.group_commit.durability != DURABILITY_NONE:
+                fd = os.open(path_tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            try:
+                created = link_file(path_tmp, target)
+            except FileExistsError:
+                # The same file has been saved into the tier
+                created = []
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(path_tmp)
+
+        if not source.exists():
+            # The file has been deleted while it was copied
+            with suppress(FileNotFoundError):
+                os.remove(target)
+            raise FileNotFoundError(source)
+        return stat, created
+
+    @staticmethod
+    def _unlink_file(source: Path, target: Path) -> None:
+        """Unlinks the moved file from the old tier, it's kept when
+        the copy has gone meanwhile. Runs in the executor."""
+        if not target.exists():
+            return
+        with suppress(FileNotFoundError):
+            os.remove(source)
+
+    @staticmethod
+    def _list_files(tier_path: Path) -> List[TieredFile]:
+        """Lists the stored files of the tier with their sizes and access
+        times. Runs in the executor."""
+        roots = {tier_path, *(tier_path / name for name in ALGORITHMS)}
+        dirs = list(roots)
+        files = []
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            # The directories of other hash algorithms are
+                            # listed from the root
+                            if SHARD_PATTERN.fullmatch(entry.name):
+                                dirs.append(Path(entry.path))
+                            continue
+
+                        if dir_path in roots \
+                                or not FILE_NAME_PATTERN.fullmatch(
+                                    entry.name) \
+                                or not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((Path(entry.path), stat.st_size,
+                                      stat.st_atime))
+            except FileNotFoundError:
+                continue
+
+        return files
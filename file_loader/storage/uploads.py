@@ -0,0 +1,324 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+from uuid import uuid4
+
+from file_loader.storage.commit import GroupCommit, write_all
+from file_loader.storage.hashing import Hasher, get_algorithm
+from file_loader.storage.io_engine import IOEngine
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_DIR = 'uploads'
+PART_SUFFIX = '.part'
+META_SUFFIX = '.json'
+# The uploaded part is hashed by blocks of this size when the hash state
+# is rebuilt
+READ_BLOCK_SIZE = 1024 * 1024
+# Seconds between the checks of the expired sessions
+EXPIRE_INTERVAL = 60.0
+
+
+class UploadNotFoundError(Exception):
+    """The upload session doesn't exist or has expired"""
+
+
+class UploadLockedError(Exception):
+    """The upload session is used by another request"""
+
+
+class OffsetMismatchError(Exception):
+    """The data is appended not at the end of the uploaded part
+
+    Attributes:
+        offset -- the size of the uploaded part
+    """
+
+    def __init__(self, offset: int):
+        self.offset = offset
+        super().__init__(f'Upload offset is {offset}')
+
+
+class UploadLengthError(Exception):
+    """The uploaded data exceeds the declared length of the file"""
+
+
+class UploadSession(NamedTuple):
+    """The upload of the file by several requests
+    :param upload_id: the identifier of the session
+    :param algorithm: the name of the algorithm hashing the file
+    :param expected_hash: hash the uploaded file should have
+    :param length: the declared length of the file
+    :param created: timestamp of the session creation
+    """
+    upload_id: str
+    algorithm: str
+    expected_hash: Optional[str] = None
+    length: Optional[int] = None
+    created: float = 0.0
+
+
+class HashState:
+    """The hash of the uploaded part kept between the requests
+    :param hasher: the hasher of the uploaded part
+    :param offset: the amount of hashed bytes
+    """
+    __slots__ = ('hasher', 'offset')
+
+    def __init__(self, hasher: Hasher, offset: int = 0):
+        self.hasher = hasher
+        self.offset = offset
+
+
+class UploadSessions:
+    """Sessions uploading the files by several requests, the interrupted
+    upload is resumed from the received offset. The parts are stored in
+    the directory of the store, the hash of each part is kept in memory
+    between the requests and rebuilt from the part when it's lost (e.g.
+    the request is served by another worker). Sessions without uploads
+    for longer than the ttl expire.
+
+    :param path_store: directory of the store
+    :param ttl: seconds of inactivity after which the session expires
+    :param io_engine: does the disk I/O of the uploaded parts
+    """
+
+    def __init__(self, path_store: Path, ttl: float,
+                 io_engine: Optional[IOEngine] = None):
+        self.path_uploads = path_store / UPLOADS_DIR
+        self.ttl = ttl
+        self.io_engine = io_engine or IOEngine()
+        self.hash_states: Dict[str, HashState] = {}
+
+    async def open(self) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: self.path_uploads.mkdir(
+            parents=True, exist_ok=True))
+
+    async def create(self, algorithm: str,
+                     expected_hash: Optional[str] = None,
+                     length: Optional[int] = None) -> UploadSession:
+        """Creates the upload session
+            :param algorithm: the name of the algorithm hashing the file
+            :param expected_hash: hash the uploaded file should have
+            :param length: the declared length of the file
+            :return: UploadSession: the created session
+            """
+        session = UploadSession(uuid4().hex, algorithm, expected_hash,
+                                length, time.time())
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._create, session)
+        logger.info('Upload session %s was created', session.upload_id)
+        return session
+
+    def use(self, upload_id: str) -> 'OpenUpload':
+        """Opens the session for the request, the session is locked until
+        it's closed
+            :param upload_id: the identifier of the session
+            :return: OpenUpload: the asynchronous context manager of
+            the open session
+            """
+        return OpenUpload(self, upload_id)
+
+    async def remove(self, upload_id: str) -> None:
+        """Removes the session and its uploaded part
+            :param upload_id: the identifier of the session
+            """
+        self.hash_states.pop(upload_id, None)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._remove, upload_id)
+
+    async def expire(self) -> int:
+        """Removes the sessions inactive for longer than the ttl
+            :return: int: the amount of the removed sessions
+            """
+        loop = asyncio.get_event_loop()
+        expired = await loop.run_in_executor(None, self._expire)
+        for upload_id in expired:
+            self.hash_states.pop(upload_id, None)
+        if expired:
+            logger.info('%d upload sessions have expired', len(expired))
+        return len(expired)
+
+    def get_part_path(self, upload_id: str) -> Path:
+        return self.path_uploads / f'{upload_id}{PART_SUFFIX}'
+
+    def get_meta_path(self, upload_id: str) -> Path:
+        return self.path_uploads / f'{upload_id}{META_SUFFIX}'
+
+    def _create(self, session: UploadSession) -> None:
+        """Creates the empty part and the metadata of the session. Runs in
+        the executor."""
+        self.get_part_path(session.upload_id).touch(exist_ok=False)
+        path_tmp = self.path_uploads / f'{session.upload_id}.tmp'
+        with open(path_tmp, 'w') as file:
+            json.dump(session._asdict(), file)
+        os.replace(path_tmp, self.get_meta_path(session.upload_id))
+
+    def _load(self, upload_id: str) -> UploadSession:
+        """Loads the metadata of the session. Runs in the executor.
+        :raise UploadNotFoundError: the session doesn't exist
+        """
+        try:
+            with open(self.get_meta_path(upload_id)) as file:
+                return UploadSession(**json.load(file))
+        except FileNotFoundError:
+            raise UploadNotFoundError(upload_id)
+
+    def _remove(self, upload_id: str) -> None:
+        """Removes the files of the session. Runs in the executor."""
+        for path in (self.get_meta_path(upload_id),
+                     self.get_part_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _expire(self):
+        """Removes the files of the expired sessions. Runs in the executor.
+        :return: list: the identifiers of the removed sessions
+        """
+        deadline = time.time() - self.ttl
+        expired = []
+        with os.scandir(self.path_uploads) as entries:
+            for entry in entries:
+                upload_id, suffix = os.path.splitext(entry.name)
+                if suffix != META_SUFFIX:
+                    continue
+
+                try:
+                    updated = max(
+                        entry.stat().st_mtime,
+                        self.get_part_path(upload_id).stat().st_mtime)
+                except FileNotFoundError:
+                    updated = 0
+                if updated < deadline:
+                    expired.append(upload_id)
+
+        for upload_id in expired:
+            self._remove(upload_id)
+        return expired
+
+
+class OpenUpload:
+    """The upload session used by the request. The uploaded part is
+    locked, so the session is used by one request at a time.
+
+    :param sessions: the upload sessions
+    :param upload_id: the identifier of the session
+    """
+
+    def __init__(self, sessions: UploadSessions, upload_id: str):
+        self.sessions = sessions
+        self.upload_id = upload_id
+        self.session: Optional[UploadSession] = None
+        self.offset = 0
+        self.path = sessions.get_part_path(upload_id)
+        self._fd: Optional[int] = None
+
+    async def __aenter__(self) -> 'OpenUpload':
+        """
+        :raise UploadNotFoundError: the session doesn't exist
+        :raise UploadLockedError: the session is used by another request
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._open)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    async def append(self, stream, offset: int, chunk_size: int,
+                     group_commit: Optional[GroupCommit] = None) -> int:
+        """Appends the data of the stream to the uploaded part, the data
+        received before the stream is broken is kept
+            :param stream: the reader of the request body
+            :param offset: the offset of the data in the file
+            :param chunk_size: the size of the read chunks
+            :param group_commit: syncs the part to the disk
+            :return: int: the size of the uploaded part
+            :raise OffsetMismatchError: the offset is not the end of
+            the uploaded part
+            :raise UploadLengthError: the data exceeds the declared length
+            """
+        if offset != self.offset:
+            raise OffsetMismatchError(self.offset)
+
+        io_engine = self.sessions.io_engine
+        state = await self._get_hash_state()
+        try:
+            while True:
+                chunk = await stream.read_chunk(size=chunk_size)
+                if not chunk:
+                    break
+
+                length = self.session.length
+                if length is not None and self.offset + len(chunk) > length:
+                    raise UploadLengthError(
+                        f'Upload exceeds the length of {length} bytes')
+
+                # The chunk is written and hashed at the same time
+                await asyncio.gather(
+                    io_engine.run_write(write_all, self._fd, chunk),
+                    state.hasher.update(chunk))
+                self.offset += len(chunk)
+                state.offset = self.offset
+        except BaseException:
+            # The hash may miss the written data, it's rebuilt
+            self.sessions.hash_states.pop(self.upload_id, None)
+            raise
+        finally:
+            if group_commit is not None:
+                await group_commit.sync_file(self._fd)
+
+        return self.offset
+
+    async def hexdigest(self) -> str:
+        """Returns the hash of the uploaded part"""
+        state = await self._get_hash_state()
+        return await state.hasher.hexdigest()
+
+    async def _get_hash_state(self) -> HashState:
+        """Returns the hash of the uploaded part, the part is hashed from
+        the last hashed offset when the hash is lost or outdated"""
+        state = self.sessions.hash_states.get(self.upload_id)
+        if state is None or state.offset > self.offset:
+            algorithm = get_algorithm(self.session.algorithm)
+            state = HashState(Hasher(algorithm))
+            self.sessions.hash_states[self.upload_id] = state
+
+        if state.offset < self.offset:
+            logger.info('Hash of upload %s is rebuilt from offset %d',
+                        self.upload_id, state.offset)
+            while state.offset < self.offset:
+                size = min(READ_BLOCK_SIZE, self.offset - state.offset)
+                block = await self.sessions.io_engine.run_read(
+                    os.pread, self._fd, size, state.offset)
+                await state.hasher.update(block)
+                state.offset += len(block)
+
+        return state
+
+    def _open(self) -> None:
+        """Opens and locks the uploaded part. Runs in the executor."""
+        self.session = self.sessions._load(self.upload_id)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        except FileNotFoundError:
+            raise UploadNotFoundError(self.upload_id)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise UploadLockedError(self.upload_id)
+
+        self._fd = fd
+        self.offset = os.fstat(fd).st_size
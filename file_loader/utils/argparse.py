@@ -21,6 +21,10 @@ def create_dirs(path: Path):
 
 
 positive_int = validate(int, constrain=lambda x: x > 0)
+non_negative_int = validate(int, constrain=lambda x: x >= 0)
+non_negative_float = validate(float, constrain=lambda x: x >= 0)
+positive_float = validate(float, constrain=lambda x: x > 0)
+fraction = validate(float, constrain=lambda x: 0 < x <= 1)
 
 
 def clear_environ(rule: Callable):
@@ -42,9 +42,13 @@ setup(
         'Programming Language :: Python :: Implementation :: CPython'
     ],
     python_requires='>=3.8',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     install_requires=load_requirements('requirements.txt'),
-    extras_require={'dev': load_requirements('requirements.dev.txt')},
+    extras_require={
+        'dev': load_requirements('requirements.dev.txt'),
+        'xxhash': ['xxhash'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             '{0} = {0}.__main__:main'.format(module_name),
@@ -0,0 +1,50 @@
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import pytest
+from aiohttp import hdrs
+from aiohttp.test_utils import TestClient
+from aiohttp.web_app import Application
+
+from file_loader.api.app import create_app
+from tests.utils import upload_file
+
+
+@pytest.fixture
+def make_app(tmp_path: Path) -> Callable[..., Application]:
+    """Creates the app with the options overriding its defaults, the store
+    is in the temporary directory unless it's passed"""
+    def make(storage_path: Path = tmp_path, **options) -> Application:
+        app = create_app()
+        app['storage_path'] = storage_path
+        for key, value in options.items():
+            app[key] = value
+        return app
+
+    return make
+
+
+@pytest.fixture
+def app_options() -> dict:
+    """The options of the app, tests override it by parametrize"""
+    return {}
+
+
+@pytest.fixture
+async def client(aiohttp_client, make_app, app_options) -> TestClient:
+    return await aiohttp_client(make_app(**app_options))
+
+
+@pytest.fixture
+def upload(client: TestClient) -> Callable[..., Awaitable[str]]:
+    """Uploads the file to the app of the client"""
+    async def upload(data: bytes, filename: str = 'file') -> str:
+        return await upload_file(client, data, filename)
+
+    return upload
+
+
+@pytest.fixture
+def identity() -> dict:
+    """Headers of the request asking for the files as they are"""
+    return {hdrs.ACCEPT_ENCODING: 'identity'}
@@ -0,0 +1,74 @@
+import asyncio
+import os
+from http import HTTPStatus
+
+import pytest
+from aiohttp import hdrs
+
+from file_loader.api.admission import AdmissionPool, OverloadedError
+from file_loader.api.file_manager import FileManager
+
+
+async def test_queue():
+    pool = AdmissionPool('download', concurrency=1, queue_size=1,
+                         timeout=10.0)
+    served = []
+
+    async def serve(number):
+        async with pool.admit():
+            served.append(number)
+            await asyncio.sleep(0.01)
+
+    first = asyncio.ensure_future(serve(1))
+    await asyncio.sleep(0)
+    second = asyncio.ensure_future(serve(2))
+    await asyncio.sleep(0)
+    assert pool.active == 1 and pool.queued == 1
+
+    # The request finding the queue full is shed
+    with pytest.raises(OverloadedError):
+        await serve(3)
+    await asyncio.gather(first, second)
+    assert served == [1, 2]
+    assert pool.stats['shed'] == 1
+    assert pool.active == 0
+
+
+async def test_timeout():
+    pool = AdmissionPool('download', concurrency=1, queue_size=1,
+                         timeout=0.01)
+    async with pool.admit():
+        with pytest.raises(OverloadedError) as e:
+            async with pool.admit():
+                pass
+    assert e.value.retry_after >= 1
+    assert pool.queued == 0 and pool.active == 0
+
+
+@pytest.mark.parametrize('app_options', [{'download_concurrency': 1,
+                                          'download_queue_size': 0}])
+async def test_shed(client, upload):
+    file_hash = await upload(os.urandom(1000))
+    async with client.app['admission_pools']['download'].admit():
+        response = await client.get(f'/files/{file_hash}')
+        assert response.status == HTTPStatus.SERVICE_UNAVAILABLE
+        assert response.headers[hdrs.RETRY_AFTER] == '1'
+
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.OK
+
+
+async def test_deleted_while_sent(client, upload, monkeypatch):
+    file_hash = await upload(os.urandom(1000))
+    get_file_path = FileManager.get_file_path
+
+    async def get_deleted_path(self, file_hash):
+        file_path = await get_file_path(self, file_hash)
+        # The file is deleted by another request before it's opened
+        os.remove(file_path)
+        return file_path
+    monkeypatch.setattr(FileManager, 'get_file_path', get_deleted_path)
+
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
+    assert client.app['admission_pools']['download'].active == 0
@@ -0,0 +1,73 @@
+import io
+import os
+import tarfile
+import zipfile
+from http import HTTPStatus
+
+import pytest
+from aiohttp import hdrs
+
+FILES = [b'small file', os.urandom(100000), b'compressible text ' * 10000]
+
+
+@pytest.fixture
+async def files(upload) -> dict:
+    return {await upload(data): data for data in FILES}
+
+
+@pytest.mark.parametrize('app_options', [
+    {},
+    # The names of the hashes longer than 100 bytes take extra blocks
+    {'hash_algorithm': 'blake2b'},
+    # The sizes of the files stored compressed are found by decompressing
+    {'compression': 'gzip'},
+    {'sendfile': False},
+    {'cache_size': 1024 * 1024, 'cache_max_file_size': 1024 * 1024},
+])
+async def test_tar(client, files):
+    response = await client.post(
+        '/files/archive.tar',
+        json={'hashes': list(files),
+              'hash_algorithm': client.app['hash_algorithm']})
+    assert response.status == HTTPStatus.OK
+    assert response.content_type == 'application/x-tar'
+    body = await response.read()
+    assert int(response.headers[hdrs.CONTENT_LENGTH]) == len(body)
+
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        assert archive.getnames() == list(files)
+        for name, data in files.items():
+            assert archive.extractfile(name).read() == data
+
+
+@pytest.mark.parametrize('app_options', [{}, {'compression': 'gzip'}])
+async def test_zip(client, files):
+    response = await client.post('/files/archive.zip',
+                                 json={'hashes': list(files)})
+    assert response.status == HTTPStatus.OK
+    assert response.content_type == 'application/zip'
+    # The size of the archive is known when it's written
+    assert response.headers[hdrs.TRANSFER_ENCODING] == 'chunked'
+    body = await response.read()
+
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == list(files)
+        for name, data in files.items():
+            assert archive.read(name) == data
+
+
+async def test_duplicates(client, files):
+    hashes = list(files)
+    response = await client.post('/files/archive.tar',
+                                 json={'hashes': hashes + hashes[:1]})
+    body = await response.read()
+    assert int(response.headers[hdrs.CONTENT_LENGTH]) == len(body)
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        assert archive.getnames() == hashes
+
+
+async def test_missing_file(client, files):
+    response = await client.post('/files/archive.tar',
+                                 json={'hashes': [*files, '0' * 32]})
+    assert response.status == HTTPStatus.NOT_FOUND
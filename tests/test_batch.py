@@ -0,0 +1,78 @@
+import hashlib
+import os
+from http import HTTPStatus
+
+import pytest
+
+from file_loader.api.handlers.batch import MAX_BATCH_SIZE
+
+MISSING = hashlib.md5(b'missing').hexdigest()
+# The files are found by the index, on the disk and in the packs
+BATCH_OPTIONS = [
+    {},
+    {'index_mode': 'off'},
+    {'pack_max_file_size': 4096},
+]
+
+
+@pytest.fixture
+async def file_hashes(upload) -> list:
+    return [await upload(os.urandom(1000 + number))
+            for number in range(3)]
+
+
+@pytest.mark.parametrize('app_options', BATCH_OPTIONS)
+async def test_stat(client, file_hashes):
+    response = await client.post('/files/batch/stat', json={
+        'hashes': [*file_hashes, MISSING, 'malformed']})
+    assert response.status == HTTPStatus.MULTI_STATUS
+    files = (await response.json())['files']
+
+    assert [file['file_hash'] for file in files] \
+        == [*file_hashes, MISSING, 'malformed']
+    assert [file['code'] for file in files] == [HTTPStatus.OK] * 3 + [
+        HTTPStatus.NOT_FOUND, HTTPStatus.BAD_REQUEST]
+    assert [file['size'] for file in files[:3]] == [1000, 1001, 1002]
+    assert not files[3]['exists']
+
+
+@pytest.mark.parametrize('app_options', BATCH_OPTIONS)
+async def test_delete(client, file_hashes):
+    response = await client.post('/files/batch/delete', json={
+        'hashes': [*file_hashes[:2], MISSING]})
+    assert response.status == HTTPStatus.MULTI_STATUS
+    files = (await response.json())['files']
+    assert [file['code'] for file in files] == [
+        HTTPStatus.NO_CONTENT, HTTPStatus.NO_CONTENT, HTTPStatus.NOT_FOUND]
+
+    for file_hash, status in zip(file_hashes, (
+            HTTPStatus.NOT_FOUND, HTTPStatus.NOT_FOUND, HTTPStatus.OK)):
+        response = await client.get(f'/files/{file_hash}')
+        assert response.status == status
+
+
+async def test_other_algorithm(client):
+    response = await client.post('/files/sha256/', data=b'data', headers={
+        'Content-Type': 'application/octet-stream'})
+    assert response.status == HTTPStatus.CREATED
+    file_hash = (await response.json())['file_hash']
+
+    # The hashes are normalized
+    response = await client.post('/files/batch/stat', json={
+        'hashes': [file_hash.upper()], 'hash_algorithm': 'sha256'})
+    file, = (await response.json())['files']
+    assert file['file_hash'] == file_hash
+    assert file['size'] == 4
+
+
+@pytest.mark.parametrize('body', [
+    b'not json',
+    b'[]',
+    b'{"hashes": "abc"}',
+    b'{"hashes": [1]}',
+    b'{"hashes": [], "hash_algorithm": "unknown"}',
+    ('{"hashes": [%s]}' % ','.join(['"a"'] * (MAX_BATCH_SIZE + 1))).encode(),
+])
+async def test_malformed(client, body):
+    response = await client.post('/files/batch/stat', data=body)
+    assert response.status == HTTPStatus.BAD_REQUEST
@@ -0,0 +1,69 @@
+import os
+from http import HTTPStatus
+from pathlib import Path
+
+import pytest
+
+from file_loader.storage.cache import FileCache
+
+CACHE_OPTIONS = {'cache_size': 1024 * 1024, 'cache_max_file_size': 1024}
+
+
+def test_lru():
+    cache = FileCache(max_size=300, max_file_size=200)
+    for name in 'abc':
+        cache.put(Path(name), name.encode() * 100)
+    assert cache.get(Path('a')) == b'a' * 100
+
+    # The least recently used file is evicted
+    cache.put(Path('d'), b'd' * 100)
+    assert cache.get(Path('b')) is None
+    assert cache.get(Path('a')) == b'a' * 100
+    assert cache.size == 300
+    assert cache.stats == {'files': 3, 'size': 300, 'hits': 2,
+                           'misses': 1, 'evictions': 1}
+
+
+def test_large_file():
+    cache = FileCache(max_size=300, max_file_size=200)
+    cache.put(Path('a'), b'a' * 201)
+    assert cache.get(Path('a')) is None
+    assert len(cache) == 0
+
+
+def test_invalidate():
+    cache = FileCache(max_size=300)
+    cache.put(Path('a'), b'a' * 100)
+    cache.put(Path('a'), b'b' * 50)
+    assert cache.size == 50
+
+    cache.invalidate(Path('a'))
+    assert cache.get(Path('a')) is None
+    assert cache.size == 0
+
+
+@pytest.mark.parametrize('app_options', [CACHE_OPTIONS])
+async def test_cached_download(client, upload, identity):
+    data = os.urandom(1000)
+    file_hash = await upload(data)
+    for _ in range(3):
+        response = await client.get(f'/files/{file_hash}', headers=identity)
+        assert await response.read() == data
+
+    cache = client.app['file_cache']
+    assert cache.stats['misses'] == 1
+    assert cache.stats['hits'] == 2
+
+    # The cache is observed while the service is running
+    response = await client.get('/metrics')
+    text = await response.text()
+    assert 'file_loader_file_cache_requests_total{result="hit"} 2' in text
+    assert 'file_loader_file_cache_requests_total{result="miss"} 1' in text
+    assert 'file_loader_file_cache_bytes 1000' in text
+    assert 'file_loader_file_cache_files 1' in text
+
+    # The deleted file is not served from the cache
+    response = await client.delete(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NO_CONTENT
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
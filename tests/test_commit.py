@@ -0,0 +1,96 @@
+import asyncio
+import os
+
+import pytest
+
+from file_loader.storage.commit import DURABILITY_GROUP, DURABILITY_NONE, \
+    DURABILITY_SYNC, GroupCommit, StagedFile
+
+
+@pytest.fixture(params=['tmpfile', 'named'])
+def staging(request, monkeypatch):
+    """Files are staged as anonymous files or as named temporary files
+    where the file system doesn't support them"""
+    if request.param == 'named':
+        monkeypatch.delattr(os, 'O_TMPFILE', raising=False)
+    return request.param
+
+
+async def test_commit(tmp_path, staging):
+    file_path = tmp_path / 'ab' / 'cd' / 'abcd'
+    group_commit = GroupCommit()
+    async with StagedFile(tmp_path) as staged:
+        await staged.write(b'data' * 1000)
+        assert await staged.commit(file_path, group_commit)
+    assert file_path.read_bytes() == b'data' * 1000
+    # The file, its new directories and the store directory are synced
+    assert group_commit.synced == 4
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['ab']
+
+    async with StagedFile(tmp_path) as staged:
+        await staged.write(b'other')
+        assert not await staged.commit(file_path, group_commit)
+    assert file_path.read_bytes() == b'data' * 1000
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['ab']
+
+
+async def test_aborted(tmp_path, staging):
+    with pytest.raises(RuntimeError):
+        async with StagedFile(tmp_path) as staged:
+            await staged.write(b'data')
+            raise RuntimeError('The upload is aborted')
+    assert not list(tmp_path.iterdir())
+
+
+async def test_spooled(tmp_path):
+    file_path = tmp_path / 'ab' / 'abcd'
+    async with StagedFile(tmp_path, spool_size=100) as staged:
+        await staged.write(b'x' * 60)
+        assert staged.spooled
+        assert staged.getvalue() == b'x' * 60
+
+        # The file is created when the data exceeds the spool size
+        await staged.write(b'y' * 60)
+        assert not staged.spooled
+        assert await staged.commit(file_path)
+    assert file_path.read_bytes() == b'x' * 60 + b'y' * 60
+
+
+async def test_preallocated(tmp_path):
+    file_path = tmp_path / 'ab' / 'abcd'
+    # The sent size is larger than the received data
+    async with StagedFile(tmp_path, size=10000) as staged:
+        await staged.write(b'data')
+        assert await staged.commit(file_path)
+    assert file_path.read_bytes() == b'data'
+
+
+async def test_group_commit(tmp_path):
+    group_commit = GroupCommit(DURABILITY_GROUP)
+    fds = [os.open(tmp_path / str(number), os.O_CREAT | os.O_WRONLY)
+           for number in range(10)]
+    try:
+        await asyncio.gather(*(group_commit.sync_file(fd) for fd in fds),
+                             group_commit.sync_dirs({tmp_path}))
+    finally:
+        for fd in fds:
+            os.close(fd)
+    await group_commit.close()
+
+    # The concurrent syncs are done by one batch
+    assert group_commit.batches == 1
+    assert group_commit.synced == 11
+
+
+@pytest.mark.parametrize('durability', [DURABILITY_GROUP, DURABILITY_SYNC])
+async def test_sync_error(tmp_path, durability):
+    group_commit = GroupCommit(durability)
+    with pytest.raises(FileNotFoundError):
+        await group_commit.sync_dirs({tmp_path / 'missing'})
+    await group_commit.close()
+
+
+async def test_no_durability(tmp_path):
+    group_commit = GroupCommit(DURABILITY_NONE)
+    await group_commit.sync_dirs({tmp_path / 'missing'})
+    assert group_commit.synced == 0
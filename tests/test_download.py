@@ -0,0 +1,181 @@
+import os
+from http import HTTPStatus
+
+import pytest
+from aiohttp import MultipartReader, hdrs
+
+DATA = os.urandom(300000)
+# Files are sent by sendfile, read by chunks and from the memory cache
+SENDING_OPTIONS = [
+    {},
+    {'sendfile': False},
+    {'cache_size': 1024 * 1024, 'cache_max_file_size': 1024 * 1024},
+]
+
+
+@pytest.fixture
+async def file_hash(upload) -> str:
+    return await upload(DATA)
+
+
+@pytest.mark.parametrize('app_options', SENDING_OPTIONS)
+async def test_download(client, file_hash, identity):
+    response = await client.get(f'/files/{file_hash}', headers=identity)
+    assert response.status == HTTPStatus.OK
+    assert response.headers[hdrs.ETAG] == f'"{file_hash}"'
+    assert response.headers[hdrs.ACCEPT_RANGES] == 'bytes'
+    assert await response.read() == DATA
+
+
+async def test_download_missing(client):
+    response = await client.get(f'/files/{"0" * 32}')
+    assert response.status == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.parametrize('app_options', SENDING_OPTIONS)
+@pytest.mark.parametrize('byte_range, start, end', [
+    ('bytes=100-199', 100, 200),
+    ('bytes=-10', len(DATA) - 10, len(DATA)),
+    ('bytes=299990-', 299990, len(DATA)),
+    ('bytes=0-999999', 0, len(DATA)),
+])
+async def test_range(client, file_hash, identity, byte_range, start, end):
+    response = await client.get(f'/files/{file_hash}',
+                                headers={**identity, hdrs.RANGE: byte_range})
+    assert response.status == HTTPStatus.PARTIAL_CONTENT
+    assert response.headers[hdrs.CONTENT_RANGE] == \
+        f'bytes {start}-{end - 1}/{len(DATA)}'
+    assert await response.read() == DATA[start:end]
+
+
+async def test_range_not_satisfiable(client, file_hash, identity):
+    response = await client.get(f'/files/{file_hash}',
+                                headers={**identity,
+                                         hdrs.RANGE: 'bytes=400000-'})
+    assert response.status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers[hdrs.CONTENT_RANGE] == f'bytes */{len(DATA)}'
+
+
+async def test_malformed_range(client, file_hash, identity):
+    response = await client.get(f'/files/{file_hash}',
+                                headers={**identity, hdrs.RANGE: 'garbage'})
+    assert response.status == HTTPStatus.OK
+    assert await response.read() == DATA
+
+
+@pytest.mark.parametrize('app_options', SENDING_OPTIONS)
+async def test_multiple_ranges(client, file_hash, identity):
+    headers = {**identity, hdrs.RANGE: 'bytes=0-9,20-29,1000-1099'}
+    response = await client.get(f'/files/{file_hash}', headers=headers)
+    assert response.status == HTTPStatus.PARTIAL_CONTENT
+    assert response.content_type == 'multipart/byteranges'
+    body = await response.read()
+    assert int(response.headers[hdrs.CONTENT_LENGTH]) == len(body)
+
+    response = await client.get(f'/files/{file_hash}', headers=headers)
+    reader = MultipartReader.from_response(response)
+    parts = []
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        parts.append((part.headers[hdrs.CONTENT_RANGE],
+                      await part.read()))
+    assert parts == [
+        (f'bytes 0-9/{len(DATA)}', DATA[0:10]),
+        (f'bytes 20-29/{len(DATA)}', DATA[20:30]),
+        (f'bytes 1000-1099/{len(DATA)}', DATA[1000:1100]),
+    ]
+
+
+@pytest.mark.parametrize('if_range, status', [
+    ('"{file_hash}"', HTTPStatus.PARTIAL_CONTENT),
+    ('"other"', HTTPStatus.OK),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', HTTPStatus.OK),
+    ('Wed, 21 Oct 2099 07:28:00 GMT', HTTPStatus.PARTIAL_CONTENT),
+])
+async def test_if_range(client, file_hash, identity, if_range, status):
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.RANGE: 'bytes=0-9',
+                 hdrs.IF_RANGE: if_range.format(file_hash=file_hash)})
+    assert response.status == status
+    body = await response.read()
+    assert body == (DATA[:10] if status == HTTPStatus.PARTIAL_CONTENT
+                    else DATA)
+
+
+async def test_if_none_match(client, file_hash, identity):
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.IF_NONE_MATCH: f'"other", W/"{file_hash}"'})
+    assert response.status == HTTPStatus.NOT_MODIFIED
+    assert response.headers[hdrs.ETAG] == f'"{file_hash}"'
+    assert await response.read() == b''
+
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.IF_NONE_MATCH: '"other"'})
+    assert response.status == HTTPStatus.OK
+    assert await response.read() == DATA
+
+
+async def test_if_modified_since(client, file_hash, identity):
+    response = await client.get(f'/files/{file_hash}', headers=identity)
+    last_modified = response.headers[hdrs.LAST_MODIFIED]
+
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.IF_MODIFIED_SINCE: last_modified})
+    assert response.status == HTTPStatus.NOT_MODIFIED
+
+    # If-None-Match takes precedence
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.IF_MODIFIED_SINCE: last_modified,
+                 hdrs.IF_NONE_MATCH: '"other"'})
+    assert response.status == HTTPStatus.OK
+
+    response = await client.get(
+        f'/files/{file_hash}',
+        headers={**identity,
+                 hdrs.IF_MODIFIED_SINCE: 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    assert response.status == HTTPStatus.OK
+    assert await response.read() == DATA
+
+
+@pytest.mark.parametrize('app_options', [{'compression': 'gzip'}])
+async def test_compressed_file(client, upload, identity):
+    data = b'compressible text ' * 10000
+    file_hash = await upload(data)
+
+    response = await client.get(f'/files/{file_hash}',
+                                headers={hdrs.ACCEPT_ENCODING: 'gzip'})
+    assert response.headers[hdrs.CONTENT_ENCODING] == 'gzip'
+    assert response.headers[hdrs.ETAG] == f'"{file_hash}-gzip"'
+    assert await response.read() == data
+
+    response = await client.get(f'/files/{file_hash}', headers=identity)
+    assert hdrs.CONTENT_ENCODING not in response.headers
+    assert await response.read() == data
+
+    # The decompressed file is sent without ranges
+    response = await client.head(f'/files/{file_hash}', headers=identity)
+    assert response.status == HTTPStatus.OK
+    assert response.headers[hdrs.ACCEPT_RANGES] == 'none'
+    assert response.headers[hdrs.CONTENT_LENGTH] == str(len(data))
+
+    response = await client.head(f'/files/{file_hash}',
+                                 headers={hdrs.ACCEPT_ENCODING: 'gzip'})
+    assert int(response.headers[hdrs.CONTENT_LENGTH]) < len(data)
+
+
+async def test_head(client, file_hash, identity):
+    response = await client.head(f'/files/{file_hash}', headers=identity)
+    assert response.status == HTTPStatus.OK
+    assert response.headers[hdrs.CONTENT_LENGTH] == str(len(DATA))
+
+    response = await client.head(
+        f'/files/{file_hash}',
+        headers={**identity, hdrs.IF_NONE_MATCH: f'"{file_hash}"'})
+    assert response.status == HTTPStatus.NOT_MODIFIED
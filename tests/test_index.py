@@ -0,0 +1,69 @@
+import os
+import time
+from http import HTTPStatus
+
+from file_loader.storage.index import DB_NAME, INDEX_PERSISTENT, \
+    StorageIndex
+from tests.utils import upload_file
+
+
+def make_file(path, size: int = 10):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    return path
+
+
+async def test_scan(tmp_path):
+    first = make_file(tmp_path / 'ab' / 'abc', 10)
+    second = make_file(tmp_path / 'sha256' / 'cd' / 'cde', 20)
+    make_file(tmp_path / 'excluded' / 'ef' / 'efg')
+    # The files in the root are not part of the layout
+    make_file(tmp_path / 'root_file')
+
+    index = StorageIndex(tmp_path, excluded=('excluded',))
+    await index.open()
+    assert index.get(first).size == 10
+    assert index.get(second).size == 20
+    assert len(index) == 2
+    assert index.total_size == 30
+    assert sorted(path for path, _ in index.iter_files()) \
+        == sorted([first, second])
+
+    index.remove(first)
+    assert index.get(first) is None
+    index.remove_dir(second.parent)
+    assert not index.has_dir(second.parent)
+    assert len(index) == 0
+
+
+async def test_persistent(tmp_path):
+    kept = make_file(tmp_path / 'ab' / 'abc')
+    removed = make_file(tmp_path / 'cd' / 'cde')
+    index = StorageIndex(tmp_path, persistent=True)
+    await index.open()
+    last_access = time.time() + 100
+    index.get(kept).last_access = last_access
+    await index.close()
+    assert (tmp_path / DB_NAME).exists()
+
+    # The store is changed while the service is stopped
+    added = make_file(tmp_path / 'ab' / 'abd')
+    os.remove(removed)
+
+    reopened = StorageIndex(tmp_path, persistent=True)
+    await reopened.open()
+    assert reopened.get(kept).last_access == last_access
+    assert reopened.get(added) is not None
+    assert reopened.get(removed) is None
+    assert len(reopened) == 2
+
+
+async def test_restarted_app(aiohttp_client, make_app):
+    client = await aiohttp_client(make_app(index_mode=INDEX_PERSISTENT))
+    file_hash = await upload_file(client, os.urandom(1000))
+    await client.close()
+
+    client = await aiohttp_client(make_app(index_mode=INDEX_PERSISTENT))
+    assert len(client.app['storage_index']) == 1
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.OK
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from file_loader.storage.io_engine import IOEngine
+
+DATA = os.urandom(1000000)
+
+
+@pytest.fixture
+async def io_engine():
+    io_engine = IOEngine(read_threads=2, write_threads=1,
+                         min_buffer_size=4096, max_buffer_size=65536)
+    io_engine.open()
+    yield io_engine
+    await io_engine.close()
+
+
+@pytest.fixture
+def file_path(tmp_path):
+    file_path = tmp_path / 'file'
+    file_path.write_bytes(DATA)
+    return file_path
+
+
+def test_buffer_size():
+    io_engine = IOEngine(min_buffer_size=4096, max_buffer_size=65536)
+    assert io_engine.get_buffer_size() == 4096
+    assert io_engine.get_buffer_size(1000) == 4096
+    assert io_engine.get_buffer_size(4096 * 16 * 4) == 4096 * 4
+    assert io_engine.get_buffer_size(10 ** 9) == 65536
+
+
+@pytest.mark.parametrize('offset, length', [
+    (0, None),
+    (100, 5000),
+    (len(DATA) - 10, None),
+    (500, 10 ** 9),
+])
+async def test_read_file(io_engine, file_path, offset, length):
+    # The chunks are kept while the next ones are read
+    chunks = [chunk async for chunk in io_engine.read_file(
+        file_path, offset, length)]
+    end = len(DATA) if length is None else offset + length
+    assert b''.join(chunks) == DATA[offset:end]
+    assert all(len(chunk) <= 65536 for chunk in chunks)
+
+
+async def test_read_file_stopped(io_engine, file_path):
+    reader = io_engine.read_file(file_path)
+    first = await reader.__anext__()
+    await reader.aclose()
+    assert first == DATA[:len(first)]
+
+    # The buffer of the stopped read is reused
+    chunks = [chunk async for chunk in io_engine.read_file(file_path)]
+    assert b''.join(chunks) == DATA
+
+
+async def test_read_missing_file(io_engine, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        async for _ in io_engine.read_file(tmp_path / 'missing'):
+            pass
@@ -0,0 +1,86 @@
+import os
+from http import HTTPStatus
+
+import pytest
+
+from file_loader.storage import layout as layout_module
+from file_loader.storage.index import StorageIndex
+from file_loader.storage.layout import DEFAULT_LAYOUT, LayoutMigration, \
+    StoreLayout, load_layouts, save_layouts
+from tests.utils import upload_file, wait_for
+
+HASH = 'abcdef' + '0' * 26
+
+
+def test_get_path(tmp_path):
+    assert DEFAULT_LAYOUT.get_path(tmp_path, HASH) == tmp_path / 'ab' / HASH
+    assert StoreLayout(2, 3).get_path(tmp_path, HASH, '.gz') \
+        == tmp_path / 'abc' / 'def' / f'{HASH}.gz'
+    assert StoreLayout(2, 3).is_shard(('abc',))
+    assert not StoreLayout(2, 3).is_shard(('ab',))
+
+
+def test_layouts(tmp_path):
+    # The store created before the layout was configurable
+    assert load_layouts(tmp_path) == [DEFAULT_LAYOUT]
+    layouts = [StoreLayout(2, 2), DEFAULT_LAYOUT]
+    save_layouts(tmp_path, layouts)
+    assert load_layouts(tmp_path) == layouts
+
+
+async def test_migration(tmp_path, monkeypatch):
+    monkeypatch.setattr(layout_module, 'UNLINK_DELAY', 0.0)
+    new_layout = StoreLayout(1, 3)
+    files = {}
+    for number in range(10):
+        file_hash = f'{number:02x}' * 16
+        for path_files, suffix in ((tmp_path, ''),
+                                   (tmp_path / 'sha256', '.gz')):
+            path = DEFAULT_LAYOUT.get_path(path_files, file_hash, suffix)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(os.urandom(100))
+            files[path] = new_layout.get_path(path_files, file_hash, suffix)
+
+    index = StorageIndex(tmp_path)
+    await index.open()
+    migration = LayoutMigration(tmp_path, new_layout, index=index)
+    assert await migration.run() == len(files)
+
+    for old_path, new_path in files.items():
+        assert not old_path.exists() and new_path.exists()
+        assert index.get(old_path) is None
+        assert index.get(new_path) is not None
+    # The shards of the old layout are removed
+    assert sorted(path.name for path in tmp_path.iterdir()) \
+        == [f'0{number}0' for number in range(10)] + ['sha256']
+
+    # The migrated store is not changed again
+    assert await LayoutMigration(tmp_path, new_layout).run() == 0
+
+
+@pytest.mark.parametrize('migrate_layout', [True, False])
+async def test_changed_layout(aiohttp_client, make_app, tmp_path,
+                              migrate_layout):
+    client = await aiohttp_client(make_app())
+    data = os.urandom(1000)
+    file_hash = await upload_file(client, data)
+    await client.close()
+
+    # The files are served from the old layout while they're moved
+    client = await aiohttp_client(make_app(shard_depth=2,
+                                           migrate_layout=migrate_layout))
+    response = await client.get(f'/files/{file_hash}')
+    assert await response.read() == data
+
+    if not migrate_layout:
+        assert client.app['fallback_layouts'] == (DEFAULT_LAYOUT,)
+        return
+
+    async def is_migrated():
+        return not client.app['fallback_layouts']
+    assert await wait_for(is_migrated)
+    assert load_layouts(tmp_path) == [StoreLayout(2, 2)]
+    assert StoreLayout(2, 2).get_path(tmp_path, file_hash).exists()
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.OK
+    assert await response.read() == data
@@ -0,0 +1,82 @@
+import os
+from http import HTTPStatus
+
+from file_loader.api.metrics import CONTENT_TYPE, Counter, Gauge, \
+    Histogram, Metrics
+from tests.utils import wait_for
+
+
+def test_counter():
+    counter = Counter('requests_total', 'Requests', ('method',))
+    counter.inc(labels=('GET',))
+    counter.inc(2, labels=('GET',))
+    counter.inc(labels=('say "hi"\n',))
+    assert counter.render() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{method="GET"} 3',
+        'requests_total{method="say \\"hi\\"\\n"} 1',
+    ]
+
+
+def test_collected():
+    values = {('a',): 1.5}
+    gauge = Gauge('queued', 'Queued', ('pool',), collect=lambda: values)
+    assert gauge.render()[2:] == ['queued{pool="a"} 1.5']
+
+    values = {('b',): 2}
+    assert gauge.render()[2:] == ['queued{pool="b"} 2']
+
+
+def test_histogram():
+    histogram = Histogram('duration_seconds', 'Duration', buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.render()[2:] == [
+        'duration_seconds_bucket{le="1"} 2',
+        'duration_seconds_bucket{le="5"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        'duration_seconds_sum 14.5',
+        'duration_seconds_count 4',
+    ]
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.add_counter('collected_total', 'Collected', (),
+                        lambda: {(): 7})
+    metrics.record_hashing(100, 0.25)
+    text = metrics.render()
+    assert text.endswith('\n')
+    assert 'collected_total 7\n' in text
+    assert 'file_loader_hashed_bytes_total 100\n' in text
+    assert 'file_loader_hash_seconds_total 0.25\n' in text
+
+
+async def test_served(client, upload):
+    data = os.urandom(1000)
+    file_hash = await upload(data)
+    downloaded = client.app['metrics'].downloaded_bytes.values[()]
+    response = await client.get(f'/files/{file_hash}')
+    assert await response.read() == data
+
+    async def is_counted():
+        # The file sent by sendfile is counted after it's sent
+        return client.app['metrics'].downloaded_bytes.values[()] \
+            == downloaded + len(data)
+    assert await wait_for(is_counted)
+    response = await client.get('/files/' + '0' * 32)
+    assert response.status == HTTPStatus.NOT_FOUND
+
+    response = await client.get('/metrics')
+    assert response.headers['Content-Type'] == CONTENT_TYPE
+    text = await response.text()
+    assert 'file_loader_requests_total{method="GET",handler="FilesView",' \
+           'status="200"} 1\n' in text
+    assert 'file_loader_requests_total{method="GET",handler="FilesView",' \
+           'status="404"} 1\n' in text
+    assert 'file_loader_requests_total{method="POST",handler="FilesView",' \
+           'status="201"} 1\n' in text
+    assert 'file_loader_hashed_bytes_total 1000\n' in text
+    # The request of the metrics is in flight
+    assert 'file_loader_requests_in_flight{method="GET"} 1\n' in text
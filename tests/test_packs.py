@@ -0,0 +1,158 @@
+import asyncio
+import os
+
+import pytest
+
+from file_loader.storage.commit import GroupCommit
+from file_loader.storage.packs import PackStore
+
+
+class SlowGroupCommit(GroupCommit):
+    """Group commit which syncs the files when it's released"""
+
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+        self.fds = []
+
+    async def sync_file(self, fd: int) -> None:
+        self.fds.append(fd)
+        await self.released.wait()
+        os.fsync(fd)
+
+    async def sync_dirs(self, dir_paths) -> None:
+        pass
+
+
+def is_open(fd: int) -> bool:
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+@pytest.fixture
+async def packs(tmp_path):
+    packs = PackStore(tmp_path, max_file_size=1024, max_pack_size=4096)
+    await packs.open()
+    yield packs
+    await packs.close()
+
+
+def make_files(amount: int, size: int = 500) -> dict:
+    return {f'md5/{number:032x}': os.urandom(size)
+            for number in range(amount)}
+
+
+async def test_put(packs, tmp_path):
+    files = make_files(20)
+    for key, data in files.items():
+        assert await packs.put(key, data)
+    assert not await packs.put(next(iter(files)), b'other')
+
+    # The full packs are rolled over
+    assert len(packs.sizes) > 1
+    for key, data in files.items():
+        assert await packs.read(key) == data
+
+    # The index is rebuilt by scanning the packs
+    reopened = PackStore(tmp_path, max_file_size=1024, max_pack_size=4096)
+    await reopened.open()
+    try:
+        assert reopened.entries == packs.entries
+    finally:
+        await reopened.close()
+
+
+async def test_delete(packs, tmp_path):
+    files = make_files(3)
+    for key, data in files.items():
+        await packs.put(key, data)
+
+    key = next(iter(files))
+    await packs.delete(key)
+    assert packs.get(key) is None
+    with pytest.raises(FileNotFoundError):
+        await packs.read(key)
+    with pytest.raises(FileNotFoundError):
+        await packs.delete(key)
+
+    reopened = PackStore(tmp_path, max_file_size=1024, max_pack_size=4096)
+    await reopened.open()
+    try:
+        assert reopened.get(key) is None
+        assert len(reopened) == 2
+    finally:
+        await reopened.close()
+
+
+async def test_compact(packs, tmp_path):
+    files = make_files(20)
+    for key, data in files.items():
+        await packs.put(key, data)
+    first_pack = min(packs.sizes)
+
+    deleted = [key for key, entry in packs.entries.items()
+               if entry.pack == first_pack][1:]
+    for key in deleted:
+        await packs.delete(key)
+
+    assert await packs.compact(min_dead_ratio=0.5) >= 1
+    assert first_pack not in packs.sizes
+    assert not packs.get_pack_path(first_pack).exists()
+    for key, data in files.items():
+        if key in deleted:
+            assert packs.get(key) is None
+        else:
+            assert await packs.read(key) == data
+
+    reopened = PackStore(tmp_path, max_file_size=1024, max_pack_size=4096)
+    await reopened.open()
+    try:
+        assert set(reopened.entries) == set(files) - set(deleted)
+    finally:
+        await reopened.close()
+
+
+async def test_retired_writer_is_synced(packs):
+    group_commit = SlowGroupCommit()
+    saving = []
+    for key, data in make_files(20).items():
+        saving.append(asyncio.ensure_future(
+            packs.put(key, data, group_commit)))
+        while len(group_commit.fds) < len(saving):
+            await asyncio.sleep(0.01)
+        if group_commit.fds[-1] != group_commit.fds[0]:
+            break
+
+    # The full pack is not closed while its sync is waiting
+    writer = group_commit.fds[0]
+    assert packs._writer != writer
+    assert is_open(writer)
+
+    group_commit.released.set()
+    await asyncio.gather(*saving)
+    assert not is_open(writer)
+
+
+async def test_cancelled_put_is_synced(packs):
+    group_commit = SlowGroupCommit()
+    saving = asyncio.ensure_future(packs.put('md5/' + '0' * 32, b'data',
+                                             group_commit))
+    while not group_commit.fds:
+        await asyncio.sleep(0.01)
+    saving.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await saving
+
+    # The pack is closed after the sync the upload was waiting for
+    writer, = group_commit.fds
+    await packs.close()
+    assert is_open(writer)
+    group_commit.released.set()
+    for _ in range(100):
+        if not is_open(writer):
+            break
+        await asyncio.sleep(0.01)
+    assert not is_open(writer)
@@ -0,0 +1,43 @@
+import pytest
+
+from file_loader.api.ranges import ByteRange, MAX_RANGES, \
+    RangeNotSatisfiableError, parse_range
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('header, ranges', [
+    ('bytes=0-99', [ByteRange(0, 99)]),
+    ('bytes=900-', [ByteRange(900, 999)]),
+    ('bytes=-100', [ByteRange(900, 999)]),
+    ('bytes=-5000', [ByteRange(0, 999)]),
+    ('bytes=500-5000', [ByteRange(500, 999)]),
+    ('Bytes = 0-9 , 20-29', [ByteRange(0, 9), ByteRange(20, 29)]),
+    # The overlapping and adjacent ranges are merged
+    ('bytes=50-99,0-49,90-120', [ByteRange(0, 120)]),
+    # The ranges out of the file are skipped
+    ('bytes=0-9,5000-,-0', [ByteRange(0, 9)]),
+])
+def test_parse_range(header, ranges):
+    assert parse_range(header, SIZE) == ranges
+
+
+@pytest.mark.parametrize('header', [
+    'bytes',
+    'bytes=',
+    'items=0-9',
+    'bytes=-',
+    'bytes=9-0',
+    'bytes=a-b',
+    'bytes=0-9,garbage',
+    'bytes=' + ','.join(['0-0'] * (MAX_RANGES + 1)),
+])
+def test_malformed_range(header):
+    assert parse_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=-0',
+                                    'bytes=2000-3000,-0'])
+def test_range_not_satisfiable(header):
+    with pytest.raises(RangeNotSatisfiableError):
+        parse_range(header, SIZE)
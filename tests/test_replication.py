@@ -0,0 +1,123 @@
+import hashlib
+import os
+from http import HTTPStatus
+from typing import Tuple
+
+import pytest
+from aiohttp.test_utils import TestClient
+
+from file_loader.replication.replicator import REPLICA_HEADER
+from tests.utils import upload_file, wait_for
+
+# The requests reading the store of the node only
+REPLICA = {REPLICA_HEADER: '1'}
+
+
+@pytest.fixture
+async def nodes(tmp_path, make_app, aiohttp_server, aiohttp_client,
+                aiohttp_unused_port) -> Tuple[TestClient, TestClient]:
+    """Two nodes replicating the files to each other"""
+    ports = aiohttp_unused_port(), aiohttp_unused_port()
+    clients = []
+    for number, (port, peer_port) in enumerate(zip(ports, ports[::-1])):
+        path = tmp_path / str(number)
+        path.mkdir()
+        app = make_app(path, replication_peers=(
+            f'http://127.0.0.1:{peer_port}',))
+        clients.append(
+            await aiohttp_client(await aiohttp_server(app, port=port)))
+    return clients[0], clients[1]
+
+
+async def is_stored(client: TestClient, path: str,
+                    data: bytes = None) -> bool:
+    response = await client.get(path, headers=REPLICA)
+    body = await response.read()
+    return response.status == HTTPStatus.OK \
+        and (data is None or body == data)
+
+
+async def is_missing(client: TestClient, path: str) -> bool:
+    response = await client.get(path, headers=REPLICA)
+    return response.status == HTTPStatus.NOT_FOUND
+
+
+async def is_replicated(client: TestClient) -> bool:
+    journal = client.app['replication_journal']
+    for peer in journal.peers:
+        if await journal.count(peer):
+            return False
+    return True
+
+
+async def test_upload_is_replicated(nodes):
+    first, second = nodes
+    data = os.urandom(100000)
+    file_hash = await upload_file(first, data)
+    assert await wait_for(
+        lambda: is_stored(second, f'/files/{file_hash}', data))
+    assert await wait_for(lambda: is_replicated(first))
+
+    # The replica is not sent back
+    assert await is_replicated(second)
+    assert second.app['replicator'].stats['sent'] == 0
+
+
+async def test_put_is_replicated(nodes):
+    first, second = nodes
+    data = os.urandom(5000)
+    file_hash = hashlib.sha256(data).hexdigest()
+    response = await first.put(f'/files/sha256/{file_hash}', data=data)
+    assert response.status == HTTPStatus.CREATED
+    assert await wait_for(
+        lambda: is_stored(second, f'/files/sha256/{file_hash}', data))
+
+
+async def test_delete_is_replicated(nodes):
+    first, second = nodes
+    hashes = [await upload_file(first, os.urandom(1000)) for _ in range(3)]
+    for file_hash in hashes:
+        assert await wait_for(
+            lambda: is_stored(second, f'/files/{file_hash}'))
+
+    response = await first.delete(f'/files/{hashes[0]}')
+    assert response.status == HTTPStatus.NO_CONTENT
+    response = await first.post('/files/batch/delete',
+                                json={'hashes': hashes[1:]})
+    assert response.status == HTTPStatus.MULTI_STATUS
+
+    for file_hash in hashes:
+        assert await wait_for(
+            lambda: is_missing(second, f'/files/{file_hash}'))
+
+
+async def test_read_repair(nodes):
+    first, second = nodes
+    data = os.urandom(3000)
+    file_hash = hashlib.md5(data).hexdigest()
+    # The file is stored on the second node only
+    response = await second.put(f'/files/{file_hash}', data=data,
+                                headers=REPLICA)
+    assert response.status == HTTPStatus.CREATED
+    assert await is_missing(first, f'/files/{file_hash}')
+
+    response = await first.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.OK
+    assert await response.read() == data
+    assert await is_stored(first, f'/files/{file_hash}', data)
+    assert first.app['replicator'].stats['repaired'] == 1
+
+
+async def test_deleted_file_is_not_repaired(nodes):
+    first, second = nodes
+    data = os.urandom(3000)
+    file_hash = await upload_file(first, data)
+    assert await wait_for(lambda: is_stored(second, f'/files/{file_hash}'))
+
+    # The deletion is not replicated while the peer is down
+    await second.close()
+    response = await first.delete(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NO_CONTENT
+
+    response = await first.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
@@ -0,0 +1,123 @@
+import gzip
+import os
+import time
+from http import HTTPStatus
+from pathlib import Path
+
+import pytest
+from aiohttp import ClientPayloadError
+
+from file_loader.storage.scrubber import QUARANTINE_DIR, CorruptFileError, \
+    Scrubber, VerificationLog, hash_content, sweep_temp_files
+
+TMP_NAMES = ('id12345678-1234-1234-1234-123456789abc',
+             'id12345678-1234-1234-1234-123456789abd')
+
+
+def corrupt(file_path: Path) -> None:
+    """Flips a bit of the stored file, its size is kept"""
+    data = bytearray(file_path.read_bytes())
+    data[100] ^= 1
+    file_path.write_bytes(bytes(data))
+
+
+def is_quarantined(tmp_path: Path, file_hash: str) -> bool:
+    return any((tmp_path / QUARANTINE_DIR).rglob(f'{file_hash}.*'))
+
+
+def test_hash_content():
+    compressed = gzip.compress(b'data')
+    assert hash_content(compressed, 'md5', 'gzip') \
+        == hash_content(b'data', 'md5')
+    with pytest.raises(CorruptFileError):
+        hash_content(b'not compressed', 'md5', 'gzip')
+
+
+def test_sweep(tmp_path):
+    stale, fresh = (tmp_path / name for name in TMP_NAMES)
+    for path in (stale, fresh, tmp_path / 'other'):
+        path.write_bytes(b'x')
+    old = time.time() - 7200
+    os.utime(stale, (old, old))
+
+    assert sweep_temp_files(tmp_path) == 1
+    assert not stale.exists() and fresh.exists()
+    assert (tmp_path / 'other').exists()
+
+
+async def test_log(tmp_path):
+    log = VerificationLog(tmp_path)
+    await log.open()
+    log.record('ab/abc')
+    log.record('ab/abd')
+    assert log.is_verified('ab/abc', 60.0)
+    assert not log.is_verified('ab/abc', 0.0)
+    await log.sync()
+
+    # The verifications are shared by the processes of the store
+    other = VerificationLog(tmp_path)
+    await other.open()
+    assert other.get('ab/abc') == log.get('ab/abc')
+    other.forget('ab/abd')
+    await other.close()
+
+    reopened = VerificationLog(tmp_path)
+    await reopened.open()
+    assert reopened.get('ab/abd') is None
+    assert reopened.get('ab/abc') is not None
+
+
+async def test_scrub(client, upload, tmp_path):
+    good, bad = os.urandom(200000), os.urandom(300000)
+    good_hash, bad_hash = await upload(good), await upload(bad)
+    corrupt(tmp_path / bad_hash[:2] / bad_hash)
+
+    log = client.app['verification_log']
+    scrubber = Scrubber(tmp_path, log, 3600.0,
+                        index=client.app['storage_index'])
+    await scrubber.run()
+    assert scrubber.stats == {'verified': 1, 'corrupt': 1, 'swept': 0}
+    assert is_quarantined(tmp_path, bad_hash)
+
+    response = await client.get(f'/files/{bad_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
+    response = await client.get(f'/files/{good_hash}')
+    assert await response.read() == good
+
+    # The files verified recently are skipped
+    scrubber = Scrubber(tmp_path, log, 3600.0)
+    await scrubber.run()
+    assert scrubber.stats['verified'] == 0
+
+    # The quarantined file may be uploaded again
+    assert await upload(bad) == bad_hash
+
+
+@pytest.mark.parametrize('app_options', [{'verify_reads': True}])
+async def test_verified_read(client, upload, tmp_path):
+    data = os.urandom(300000)
+    file_hash = await upload(data)
+    corrupt(tmp_path / file_hash[:2] / file_hash)
+
+    # The corrupt file is found when it's sent whole, the response is
+    # aborted
+    response = await client.get(f'/files/{file_hash}')
+    with pytest.raises(ClientPayloadError):
+        await response.read()
+    assert is_quarantined(tmp_path, file_hash)
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.parametrize('app_options', [{
+    'verify_reads': True,
+    'cache_size': 1024 * 1024, 'cache_max_file_size': 1024 * 1024,
+}])
+async def test_verified_cached_read(client, upload, tmp_path):
+    file_hash = await upload(os.urandom(1000))
+    corrupt(tmp_path / file_hash[:2] / file_hash)
+
+    # The file read into memory is verified before it's sent
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert is_quarantined(tmp_path, file_hash)
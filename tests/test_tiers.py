@@ -0,0 +1,83 @@
+import os
+import threading
+from http import HTTPStatus
+from pathlib import Path
+
+import pytest
+
+from file_loader.storage.index import INDEX_MEMORY, INDEX_OFF
+from tests.utils import wait_for
+
+
+@pytest.fixture(params=[INDEX_MEMORY, INDEX_OFF])
+def app_options(request, tmp_path_factory) -> dict:
+    return {'cold_storage_paths': (tmp_path_factory.mktemp('cold'),),
+            'tier_promote_reads': 2,
+            'index_mode': request.param}
+
+
+def find_file(tier_path: Path, file_hash: str) -> bool:
+    return any(tier_path.rglob(file_hash))
+
+
+async def demote(app) -> int:
+    """Demotes all the files as if they have not been read for long"""
+    tiers = app['storage_tiers']
+    idle_time, tiers.idle_time = tiers.idle_time, -1.0
+    try:
+        return await tiers.demote()
+    finally:
+        tiers.idle_time = idle_time
+
+
+async def test_demote_and_promote(client, upload, identity, tmp_path):
+    cold_path, = client.app['cold_storage_paths']
+    data = os.urandom(100000)
+    file_hash = await upload(data)
+
+    assert await demote(client.app) == 1
+    assert not find_file(tmp_path, file_hash)
+    assert find_file(cold_path, file_hash)
+
+    # The cold file is served, it's promoted after it's read again
+    for _ in range(2):
+        response = await client.get(f'/files/{file_hash}', headers=identity)
+        assert await response.read() == data
+
+    async def is_promoted():
+        return find_file(tmp_path, file_hash) \
+            and not find_file(cold_path, file_hash)
+    assert await wait_for(is_promoted)
+    response = await client.get(f'/files/{file_hash}', headers=identity)
+    assert await response.read() == data
+
+
+async def test_delete_cold(client, upload):
+    cold_path, = client.app['cold_storage_paths']
+    file_hash = await upload(os.urandom(1000))
+    await demote(client.app)
+
+    response = await client.delete(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NO_CONTENT
+    assert not find_file(cold_path, file_hash)
+    response = await client.get(f'/files/{file_hash}')
+    assert response.status == HTTPStatus.NOT_FOUND
+
+
+async def test_lookup_off_loop(client, upload, identity, monkeypatch):
+    file_hash = await upload(os.urandom(1000))
+    await demote(client.app)
+
+    threads = set()
+    stat = Path.stat
+
+    def record_stat(self, *args, **kwargs):
+        if file_hash in self.name:
+            threads.add(threading.current_thread())
+        return stat(self, *args, **kwargs)
+    monkeypatch.setattr(Path, 'stat', record_stat)
+
+    # The paths of the file are checked in the executor
+    response = await client.get(f'/files/{file_hash}', headers=identity)
+    assert response.status == HTTPStatus.OK
+    assert threading.main_thread() not in threads
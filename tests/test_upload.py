@@ -0,0 +1,162 @@
+import hashlib
+import os
+from http import HTTPStatus
+
+import pytest
+from aiohttp import MultipartWriter, hdrs
+
+from file_loader.api.handlers.files import FILE_HASH_HEADER
+
+DATA = os.urandom(100000)
+DATA_HASH = hashlib.md5(DATA).hexdigest()
+
+
+def make_form(*files: bytes, part_hash: str = None) -> MultipartWriter:
+    """Returns multipart data of the files, each part declares the hash
+    when it's passed"""
+    form = MultipartWriter('form-data')
+    for number, data in enumerate(files):
+        part = form.append(
+            data, {hdrs.CONTENT_TYPE: 'application/octet-stream'})
+        part.set_content_disposition('form-data', name=f'file{number}',
+                                     filename=f'file{number}')
+        if part_hash is not None:
+            part.headers[FILE_HASH_HEADER] = part_hash
+    return form
+
+
+@pytest.mark.parametrize('app_options', [
+    {},
+    {'compression': 'gzip'},
+    {'pack_max_file_size': 1024 * 1024},
+])
+async def test_upload(client, identity):
+    response = await client.post('/files/', data=make_form(DATA))
+    assert response.status == HTTPStatus.CREATED
+    assert await response.json() == {'file_hash': DATA_HASH,
+                                     'hash_algorithm': 'md5'}
+    assert response.headers[hdrs.LOCATION] == f'/files/{DATA_HASH}'
+
+    response = await client.get(f'/files/{DATA_HASH}', headers=identity)
+    assert await response.read() == DATA
+
+    # The file received again is stored once
+    response = await client.post('/files/', data=make_form(DATA))
+    assert response.status == HTTPStatus.CREATED
+    assert (await response.json())['file_hash'] == DATA_HASH
+
+    response = await client.delete(f'/files/{DATA_HASH}')
+    assert response.status == HTTPStatus.NO_CONTENT
+    response = await client.get(f'/files/{DATA_HASH}')
+    assert response.status == HTTPStatus.NOT_FOUND
+
+
+async def test_upload_raw(client):
+    response = await client.post(
+        '/files/', data=DATA,
+        headers={hdrs.CONTENT_TYPE: 'application/octet-stream'})
+    assert response.status == HTTPStatus.CREATED
+    assert (await response.json())['file_hash'] == DATA_HASH
+
+
+async def test_put(client):
+    response = await client.put(f'/files/{DATA_HASH}', data=DATA)
+    assert response.status == HTTPStatus.CREATED
+
+    response = await client.put(f'/files/{DATA_HASH}', data=DATA)
+    assert response.status == HTTPStatus.OK
+
+    response = await client.put(f'/files/{"0" * 32}', data=DATA)
+    assert response.status == HTTPStatus.BAD_REQUEST
+
+
+async def test_put_algorithm(client):
+    file_hash = hashlib.sha256(DATA).hexdigest()
+    response = await client.put(f'/files/sha256/{file_hash}', data=DATA)
+    assert response.status == HTTPStatus.CREATED
+    assert response.headers[hdrs.LOCATION] == f'/files/sha256/{file_hash}'
+
+    response = await client.get(f'/files/sha256/{file_hash}')
+    assert await response.read() == DATA
+
+
+async def test_declared_hash(client, upload):
+    response = await client.post('/files/', data=make_form(DATA),
+                                 headers={FILE_HASH_HEADER: '0' * 32})
+    assert response.status == HTTPStatus.BAD_REQUEST
+
+    response = await client.post('/files/', data=make_form(DATA),
+                                 headers={FILE_HASH_HEADER: 'malformed'})
+    assert response.status == HTTPStatus.BAD_REQUEST
+
+    await upload(DATA)
+    # The body of the stored file is not read
+    response = await client.post('/files/', data=make_form(b'not read'),
+                                 headers={FILE_HASH_HEADER: DATA_HASH})
+    assert response.status == HTTPStatus.OK
+    assert (await response.json())['file_hash'] == DATA_HASH
+
+
+async def test_several_files(client):
+    other = b'other file'
+    response = await client.post('/files/', data=make_form(DATA, other, b''))
+    assert response.status == HTTPStatus.MULTI_STATUS
+    files = (await response.json())['files']
+    assert [file['code'] for file in files] == [
+        HTTPStatus.CREATED, HTTPStatus.CREATED, HTTPStatus.BAD_REQUEST]
+    assert [file.get('file_hash') for file in files] == [
+        DATA_HASH, hashlib.md5(other).hexdigest(), None]
+
+
+async def test_several_files_declared_hash(client):
+    # The hash declared by the request is the hash of its only file
+    response = await client.post('/files/',
+                                 data=make_form(DATA, b'other file'),
+                                 headers={FILE_HASH_HEADER: DATA_HASH})
+    assert response.status == HTTPStatus.BAD_REQUEST
+
+    response = await client.post(
+        '/files/', data=make_form(DATA, b'other file', part_hash=DATA_HASH))
+    files = (await response.json())['files']
+    assert [file['code'] for file in files] == [
+        HTTPStatus.CREATED, HTTPStatus.BAD_REQUEST]
+
+
+async def test_empty_file(client):
+    response = await client.post('/files/', data=make_form(b''))
+    assert response.status == HTTPStatus.BAD_REQUEST
+
+
+async def test_resumable_upload(client):
+    file_hash = hashlib.sha256(DATA).hexdigest()
+    response = await client.post('/uploads/', headers={
+        'Upload-Length': str(len(DATA)), 'X-Hash-Algorithm': 'sha256',
+        FILE_HASH_HEADER: file_hash})
+    assert response.status == HTTPStatus.CREATED
+    upload_id = (await response.json())['upload_id']
+
+    response = await client.patch(f'/uploads/{upload_id}', data=DATA[:1000],
+                                  headers={'Upload-Offset': '0'})
+    assert response.status == HTTPStatus.NO_CONTENT
+    assert response.headers['Upload-Offset'] == '1000'
+
+    response = await client.patch(f'/uploads/{upload_id}', data=b'x',
+                                  headers={'Upload-Offset': '5'})
+    assert response.status == HTTPStatus.CONFLICT
+    assert response.headers['Upload-Offset'] == '1000'
+
+    response = await client.head(f'/uploads/{upload_id}')
+    assert response.headers['Upload-Offset'] == '1000'
+
+    response = await client.patch(f'/uploads/{upload_id}', data=DATA[1000:],
+                                  headers={'Upload-Offset': '1000'})
+    assert response.status == HTTPStatus.NO_CONTENT
+
+    response = await client.post(f'/uploads/{upload_id}')
+    assert response.status == HTTPStatus.CREATED
+    assert (await response.json())['file_hash'] == file_hash
+
+    response = await client.get(response.headers[hdrs.LOCATION])
+    assert await response.read() == DATA
+    response = await client.get(f'/uploads/{upload_id}')
+    assert response.status == HTTPStatus.NOT_FOUND
@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+import pytest
+
+from file_loader.storage.io_engine import IOEngine
+from file_loader.storage.uploads import OffsetMismatchError, \
+    UploadLengthError, UploadLockedError, UploadNotFoundError, \
+    UploadSessions
+
+DATA = os.urandom(100000)
+
+
+class ChunkStream:
+    """The request body read by chunks"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read_chunk(self, size: int) -> bytes:
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+@pytest.fixture
+async def sessions(tmp_path):
+    io_engine = IOEngine(read_threads=1, write_threads=1)
+    io_engine.open()
+    sessions = UploadSessions(tmp_path, ttl=3600, io_engine=io_engine)
+    await sessions.open()
+    yield sessions
+    await io_engine.close()
+
+
+async def test_upload(sessions):
+    session = await sessions.create('sha256', length=len(DATA))
+    async with sessions.use(session.upload_id) as upload:
+        assert await upload.append(ChunkStream(DATA[:1000]), 0, 256) == 1000
+        with pytest.raises(OffsetMismatchError) as e:
+            await upload.append(ChunkStream(b'x'), 5, 256)
+        assert e.value.offset == 1000
+
+    async with sessions.use(session.upload_id) as upload:
+        assert upload.offset == 1000
+        await upload.append(ChunkStream(DATA[1000:]), 1000, 4096)
+        assert await upload.hexdigest() == hashlib.sha256(DATA).hexdigest()
+    assert sessions.get_part_path(session.upload_id).read_bytes() == DATA
+
+
+async def test_short_write(sessions, monkeypatch):
+    write = os.write
+    # The disk takes a few bytes of each write
+    monkeypatch.setattr(os, 'write', lambda fd, data: write(fd, data[:7]))
+
+    session = await sessions.create('md5')
+    async with sessions.use(session.upload_id) as upload:
+        await upload.append(ChunkStream(DATA[:3000]), 0, 1000)
+        assert upload.offset == 3000
+    monkeypatch.undo()
+
+    assert sessions.get_part_path(session.upload_id).read_bytes() \
+        == DATA[:3000]
+
+
+async def test_hash_is_rebuilt(sessions):
+    session = await sessions.create('md5')
+    async with sessions.use(session.upload_id) as upload:
+        await upload.append(ChunkStream(DATA[:5000]), 0, 1000)
+
+    # The next request is served by another worker
+    sessions.hash_states.clear()
+    async with sessions.use(session.upload_id) as upload:
+        await upload.append(ChunkStream(DATA[5000:]), 5000, 1000)
+        assert await upload.hexdigest() == hashlib.md5(DATA).hexdigest()
+
+
+async def test_length_exceeded(sessions):
+    session = await sessions.create('md5', length=100)
+    async with sessions.use(session.upload_id) as upload:
+        with pytest.raises(UploadLengthError):
+            await upload.append(ChunkStream(DATA[:150]), 0, 64)
+        # The data received before is kept
+        assert upload.offset == 64
+
+
+async def test_locked(sessions):
+    session = await sessions.create('md5')
+    async with sessions.use(session.upload_id):
+        with pytest.raises(UploadLockedError):
+            async with sessions.use(session.upload_id):
+                pass
+
+
+async def test_remove(sessions):
+    session = await sessions.create('md5')
+    await sessions.remove(session.upload_id)
+    with pytest.raises(UploadNotFoundError):
+        async with sessions.use(session.upload_id):
+            pass
+
+
+async def test_expire(sessions):
+    session = await sessions.create('md5')
+    assert await sessions.expire() == 0
+
+    sessions.ttl = -1
+    assert await sessions.expire() == 1
+    assert not sessions.get_part_path(session.upload_id).exists()
+    with pytest.raises(UploadNotFoundError):
+        async with sessions.use(session.upload_id):
+            pass
@@ -0,0 +1,63 @@
+import os
+import signal
+import time
+
+import pytest
+
+from file_loader.daemon import WorkerSupervisor
+
+
+@pytest.fixture(autouse=True)
+def signal_handlers():
+    """The supervisor replaces the handlers of the termination signals"""
+    handlers = {signum: signal.getsignal(signum)
+                for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_started():
+    started = []
+
+    def on_started():
+        started.append(time.monotonic())
+        # The workers are stopped as by the daemon stopping
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def target(number):
+        time.sleep(0.3 * number)
+        supervisor.notify_started()
+        time.sleep(30)
+
+    supervisor = WorkerSupervisor(3, target, on_started=on_started)
+    begin = time.monotonic()
+    supervisor.run()
+
+    # Readiness waits for the slowest worker
+    assert len(started) == 1
+    assert started[0] - begin >= 0.6
+    assert supervisor.stopping
+    assert not supervisor.children
+
+
+def test_failed_start():
+    started = []
+
+    def target(number):
+        if number == 1:
+            raise RuntimeError('The app has failed to start')
+        supervisor.notify_started()
+        time.sleep(30)
+
+    supervisor = WorkerSupervisor(2, target,
+                                  on_started=lambda: started.append(True))
+    begin = time.monotonic()
+    with pytest.raises(SystemExit) as e:
+        supervisor.run()
+
+    # The worker started is stopped, the failed one is not restarted
+    assert e.value.code == 1
+    assert not started
+    assert not supervisor.children
+    assert time.monotonic() - begin < 10
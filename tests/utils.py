@@ -0,0 +1,30 @@
+import asyncio
+from http import HTTPStatus
+from typing import Awaitable, Callable
+
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient
+
+
+async def upload_file(client: TestClient, data: bytes,
+                      filename: str = 'file') -> str:
+    """Uploads the file as multipart data
+    :return: str: the hash of the stored file
+    """
+    form = FormData()
+    form.add_field('file', data, filename=filename)
+    response = await client.post('/files/', data=form)
+    assert response.status == HTTPStatus.CREATED, await response.text()
+    return (await response.json())['file_hash']
+
+
+async def wait_for(check: Callable[[], Awaitable[bool]],
+                   timeout: float = 15.0) -> bool:
+    """Repeats the check until it passes or the timeout expires"""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not await check():
+        if loop.time() > deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True